@@ -0,0 +1,184 @@
+"""Shape a large text corpus against many fonts, using multiple processes.
+
+    for result in shapeCorpus(fontPaths, lines):
+        print(result.fontKey, result.lineIndex, result.glyphNames)
+
+Work is split into (font, chunk of lines) units, which are distributed over
+a process pool. Each worker process opens fonts through getOpener() and keeps
+recently used fonts loaded. Results are yielded in order: all lines for the
+first font, then all lines for the second font, etc.
+"""
+
+import argparse
+import asyncio
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+import multiprocessing
+import multiprocessing.util
+import os
+import pathlib
+import sys
+from typing import NamedTuple
+import numpy
+from .compile.compilerPool import getCompilerPool
+from .font import getOpener, iterFontPathsAndNumbers
+
+
+class ShapedLine(NamedTuple):
+    fontKey: tuple
+    lineIndex: int
+    glyphNames: list
+    clusters: numpy.ndarray
+    advances: numpy.ndarray  # (n, 2) array of (ax, ay)
+
+
+def shapeCorpus(fonts, lines, *, features=None, varLocation=None,
+                direction=None, language=None, script=None,
+                chunkSize=1000, maxWorkers=None):
+    """Shape all `lines` with all `fonts`, and yield a ShapedLine for each
+    (font, line) combination. `fonts` can be a Project, or a list of font
+    paths and/or (fontPath, fontNumber) font keys. Font paths may point to
+    folders or font collections, which will be expanded.
+    """
+    fontKeys = getFontKeys(fonts)
+    lines = list(lines)
+    shapeSettings = dict(features=features, varLocation=varLocation,
+                         direction=direction, language=language, script=script)
+    workUnits = ((fontKey, firstLineIndex, lines[firstLineIndex:firstLineIndex + chunkSize], shapeSettings)
+                 for fontKey in fontKeys
+                 for firstLineIndex in range(0, len(lines), chunkSize))
+
+    if maxWorkers is None:
+        maxWorkers = os.cpu_count() or 1
+    # Limit the number of submitted units, so we don't hold all results in memory
+    maxPending = 2 * maxWorkers
+
+    executor = ProcessPoolExecutor(maxWorkers, mp_context=multiprocessing.get_context("spawn"))
+    try:
+        pending = deque()
+        for workUnit in workUnits:
+            pending.append(executor.submit(_shapeWorkUnit, *workUnit))
+            if len(pending) >= maxPending:
+                yield from pending.popleft().result()
+        while pending:
+            yield from pending.popleft().result()
+    finally:
+        executor.shutdown(cancel_futures=True)
+
+
+def getFontKeys(fonts):
+    if hasattr(fonts, "fonts"):
+        # A Project
+        return [fontItemInfo.fontKey for fontItemInfo in fonts.fonts]
+    fontKeys = []
+    for item in fonts:
+        if isinstance(item, tuple):
+            fontKeys.append(item)
+        else:
+            path = pathlib.Path(item)
+            fontKeys.extend((fontPath, fontNumber)
+                            for fontPath, fontNumber, getSortInfo in iterFontPathsAndNumbers([path]))
+    return fontKeys
+
+
+def readCorpusLines(textPath):
+    with open(textPath, "r", encoding="utf-8", errors="replace") as f:
+        return f.read().splitlines()
+
+
+#
+# The following runs in the worker processes
+#
+
+maxWarmFonts = 8
+# UFO and designspace sources are compiled by each worker process's own
+# compiler pool. There already is a worker process per CPU, so each one
+# only gets a single compiler worker.
+maxCompilerWorkers = 1
+
+_warmFonts = {}  # fontKey: font, in order of use
+_workerLoop = None
+
+
+def _getWarmFont(fontKey):
+    font = _warmFonts.pop(fontKey, None)
+    if font is None:
+        fontPath, fontNumber = fontKey
+        numFonts, opener, getSortInfo = getOpener(fontPath)
+        font = opener(fontPath, fontNumber)
+        _getWorkerLoop().run_until_complete(font.load(sys.stderr.write))
+    _warmFonts[fontKey] = font
+    if len(_warmFonts) > maxWarmFonts:
+        while len(_warmFonts) > maxWarmFonts:
+            _warmFonts.pop(next(iter(_warmFonts))).close()
+        # The compiler pool's idle timeout only fires while the loop runs,
+        # which it mostly doesn't
+        _workerLoop.run_until_complete(_stopCompilerWorkers())
+    return font
+
+
+def _getWorkerLoop():
+    global _workerLoop
+    if _workerLoop is None:
+        # Keep one loop, so the compiler pool can be reused between fonts
+        _workerLoop = asyncio.new_event_loop()
+        _workerLoop.run_until_complete(_limitCompilerWorkers())
+        multiprocessing.util.Finalize(None, _closeWorkerLoop, exitpriority=10)
+    return _workerLoop
+
+
+def _closeWorkerLoop():
+    global _workerLoop
+    if _workerLoop is None:
+        return
+    _workerLoop.run_until_complete(_stopCompilerWorkers())
+    _workerLoop.close()
+    _workerLoop = None
+
+
+async def _limitCompilerWorkers():
+    getCompilerPool().setLimits(maxWorkers=maxCompilerWorkers, minWorkers=0)
+
+
+async def _stopCompilerWorkers():
+    await getCompilerPool().stopIdleWorkers()
+
+
+def _shapeWorkUnit(fontKey, firstLineIndex, lines, shapeSettings):
+    font = _getWarmFont(fontKey)
+    font.setVarLocation(shapeSettings["varLocation"])
+    glyphOrder = font.shaper.glyphOrder
+    results = []
+    shapeResults = font.shaper.shapeMany(lines, **shapeSettings)
+    for lineIndex, (gids, clusters, positions) in enumerate(shapeResults, firstLineIndex):
+        glyphNames = [glyphOrder[gid] for gid in gids.tolist()]
+        results.append(ShapedLine(fontKey, lineIndex, glyphNames, clusters, positions[:, 2:]))
+    return results
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(
+        description="Shape all lines of a text file with one or more fonts, "
+                    "and print the resulting glyph names.")
+    parser.add_argument("textFile", help="a UTF-8 text file")
+    parser.add_argument("fonts", nargs="+", help="font files or folders")
+    parser.add_argument("--features", default="",
+                        help="comma-separated feature tags, prefix with '-' to disable")
+    parser.add_argument("--workers", type=int, default=None, help="number of worker processes")
+    parser.add_argument("--chunk-size", type=int, default=1000, help="number of lines per work unit")
+    args = parser.parse_args(args)
+
+    features = {}
+    for tag in args.features.split(","):
+        if tag:
+            features[tag.lstrip("-")] = not tag.startswith("-")
+
+    lines = readCorpusLines(args.textFile)
+    for result in shapeCorpus(args.fonts, lines, features=features,
+                              chunkSize=args.chunk_size, maxWorkers=args.workers):
+        fontPath, fontNumber = result.fontKey
+        print(f"{os.path.basename(fontPath)}#{fontNumber}\t{result.lineIndex}\t{'|'.join(result.glyphNames)}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,276 @@
+"""A persistent, content-addressed cache for compiled font binaries.
+
+Cache keys are hashes of all source data that influences the compiled
+result, plus the versions of the compiling code, so a cached binary can be
+used as-is when a source hasn't changed, for example when a project is
+re-opened. Entries also hold the compiler output, so warnings are reported
+again on a cache hit.
+"""
+
+import hashlib
+import os
+import pathlib
+import pickle
+import sys
+import tempfile
+import time
+import fontTools
+import ufo2ft
+import fontgoggles
+
+
+cacheFormatVersion = 2
+cacheFileExtension = ".fgcache"
+defaultMaxCacheSize = 500 * 1024 * 1024  # bytes
+tempFilePrefix = "fontgoggles_temp"
+tempFileMaxAge = 60 * 60  # seconds
+
+
+class CompileCache:
+
+    """A folder with cached compile results. Once the total size of the cache
+    files exceeds `maxSize`, the least recently used entries are removed.
+    """
+
+    fileExtension = cacheFileExtension
+
+    def __init__(self, folder, maxSize=defaultMaxCacheSize):
+        self.folder = pathlib.Path(folder)
+        self.maxSize = maxSize
+
+    def _getPath(self, cacheKey):
+        return self.folder / (cacheKey + self.fileExtension)
+
+    def get(self, cacheKey):
+        """Return a (fontData, output) tuple, or None if `cacheKey` is not
+        in the cache.
+        """
+        return self._read(cacheKey)
+
+    def put(self, cacheKey, fontData, output):
+        self._write(cacheKey, (fontData, output))
+
+    def _read(self, cacheKey):
+        path = self._getPath(cacheKey)
+        try:
+            with open(path, "rb") as f:
+                value = pickle.load(f)
+            os.utime(path)  # mark as recently used
+        except (OSError, EOFError, pickle.UnpicklingError, ValueError):
+            return None
+        return value
+
+    def _write(self, cacheKey, value):
+        self.folder.mkdir(parents=True, exist_ok=True)
+        # Write to a temp file first, so other processes never see partial data
+        fd, tempPath = tempfile.mkstemp(dir=self.folder, prefix=tempFilePrefix)
+        try:
+            with os.fdopen(fd, "wb") as f:
+                pickle.dump(value, f, pickle.HIGHEST_PROTOCOL)
+            os.replace(tempPath, self._getPath(cacheKey))
+        except OSError:
+            if os.path.exists(tempPath):
+                os.remove(tempPath)
+            raise
+        self.prune()
+
+    def prune(self):
+        entries = []
+        # Temp files that are old enough are left over from interrupted
+        # writes, younger ones may still be written by another process
+        tempFileTime = time.time() - tempFileMaxAge
+        for entry in os.scandir(self.folder):
+            if entry.name.endswith(self.fileExtension):
+                st = entry.stat()
+                entries.append((st.st_mtime, st.st_size, entry.path))
+            elif entry.name.startswith(tempFilePrefix):
+                try:
+                    if entry.stat().st_mtime < tempFileTime:
+                        os.remove(entry.path)
+                except FileNotFoundError:
+                    pass  # Renamed or removed by another process
+        totalSize = sum(size for mtime, size, path in entries)
+        entries.sort()
+        for mtime, size, path in entries:
+            if totalSize <= self.maxSize:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass  # Removed by another process
+            totalSize -= size
+
+    def clear(self):
+        if not self.folder.exists():
+            return
+        for entry in os.scandir(self.folder):
+            if entry.name.endswith(self.fileExtension):
+                os.remove(entry.path)
+
+
+def getUserCacheFolder():
+    if sys.platform == "darwin":
+        folder = pathlib.Path("~/Library/Caches/FontGoggles")
+    else:
+        folder = pathlib.Path(os.environ.get("XDG_CACHE_HOME", "~/.cache")) / "fontgoggles"
+    return folder.expanduser()
+
+
+def getCacheFolder():
+    """Return the folder for FontGoggles' persistent caches, or None if caching
+    is disabled via the FONTGOGGLES_CACHE_DIR environment variable.
+    """
+    folder = os.environ.get("FONTGOGGLES_CACHE_DIR")
+    if folder is None:
+        return getUserCacheFolder()
+    return pathlib.Path(folder) if folder else None
+
+
+_compileCache = None
+_compileCacheInitialized = False
+
+
+def getCompileCache():
+    """Return the CompileCache instance to use, or None if caching is disabled.
+    By default, the cache lives in the user's cache folder. The FONTGOGGLES_CACHE_DIR
+    environment variable can be used to specify a different folder, or to
+    disable caching by setting it to an empty string.
+    """
+    global _compileCache, _compileCacheInitialized
+    if not _compileCacheInitialized:
+        folder = getCacheFolder()
+        if folder is not None:
+            _compileCache = CompileCache(folder / "compiled")
+        _compileCacheInitialized = True
+    return _compileCache
+
+
+def setCompileCache(compileCache):
+    """Set the CompileCache instance to use. Pass None to disable caching."""
+    global _compileCache, _compileCacheInitialized
+    _compileCache = compileCache
+    _compileCacheInitialized = True
+
+
+#
+# Cache keys
+#
+
+# These are read by the UFO compiler, the glyph files are handled separately
+ufoFilesToHash = [
+    "metainfo.plist",
+    "fontinfo.plist",
+    "groups.plist",
+    "kerning.plist",
+    "features.fea",
+    "lib.plist",
+    "layercontents.plist",
+]
+
+
+def _newHash(kind, *args):
+    h = hashlib.blake2b(digest_size=20)
+    header = (cacheFormatVersion, fontgoggles.__version__, fontTools.version,
+              ufo2ft.__version__, kind) + args
+    h.update(repr(header).encode("utf-8"))
+    return h
+
+
+def _hashFile(h, path, name):
+    h.update(os.fspath(name).encode("utf-8", "surrogateescape"))
+    try:
+        with open(path, "rb") as f:
+            data = f.read()
+    except FileNotFoundError:
+        h.update(b"\0missing")
+    else:
+        h.update(len(data).to_bytes(8, "little"))
+        h.update(data)
+
+
+def _hashUFO(h, ufoPath, includeGlyphs, includeLayerGlyphs=False):
+    ufoPath = pathlib.Path(ufoPath)
+    if not ufoPath.is_dir():
+        # .ufoz
+        _hashFile(h, ufoPath, ufoPath.name)
+    else:
+        for fileName in ufoFilesToHash:
+            _hashFile(h, ufoPath / fileName, fileName)
+        glyphsFolders = sorted(entry.name for entry in os.scandir(ufoPath)
+                               if entry.name.startswith("glyphs") and entry.is_dir())
+        for glyphsFolder in glyphsFolders:
+            if glyphsFolder == "glyphs" and includeGlyphs or glyphsFolder != "glyphs" and includeLayerGlyphs:
+                # Normally only the default layer is compiled
+                _hashGlyphsFolder(h, ufoPath / glyphsFolder, glyphsFolder)
+            else:
+                _hashFile(h, ufoPath / glyphsFolder / "contents.plist", f"{glyphsFolder}/contents.plist")
+    from ..font.ufoFont import extractIncludedFeatureFiles
+    for path in extractIncludedFeatureFiles(ufoPath):
+        _hashFile(h, path, path)
+
+
+def _hashGlyphsFolder(h, glyphsFolder, name):
+    # Reading all .glif files would cost about as much as the scan we're
+    # trying to avoid, so the digests of the files are kept in an index,
+    # along with their modification time and size. Only files that changed
+    # are read again. The index lives next to the glyph info index.
+    from .glyphInfoCache import getGlyphInfoCache
+    cache = getGlyphInfoCache()
+    index = {} if cache is None else cache.getDigestIndex(glyphsFolder)
+    newIndex = {}
+    for entry in sorted(os.scandir(glyphsFolder), key=lambda entry: entry.name):
+        h.update(f"{name}/{entry.name}".encode("utf-8", "surrogateescape"))
+        try:
+            st = entry.stat()
+        except FileNotFoundError:
+            h.update(b"\0missing")
+            continue
+        fileStamp = (st.st_mtime_ns, st.st_size)
+        indexEntry = index.get(entry.name)
+        if indexEntry is not None and indexEntry[0] == fileStamp:
+            digest = indexEntry[1]
+        else:
+            fileHash = hashlib.blake2b(digest_size=20)
+            _hashFile(fileHash, entry.path, "")
+            digest = fileHash.digest()
+        newIndex[entry.name] = (fileStamp, digest)
+        h.update(digest)
+    if cache is not None and newIndex != index:
+        try:
+            cache.putDigestIndex(glyphsFolder, newIndex)
+        except OSError:
+            pass  # We'll read the files again next time
+
+
+def getUFOCacheKey(ufoPath, shouldCompileFeatures, shouldAddMetrics=False):
+    h = _newHash("ufo", bool(shouldCompileFeatures), bool(shouldAddMetrics))
+    _hashUFO(h, ufoPath, True)
+    return h.hexdigest()
+
+
+def getDSCacheKey(dsPath, fontNumber, ttFolder, shouldCompileFeatures, shouldAddMetrics=False):
+    from fontTools.designspaceLib import DesignSpaceDocument
+    from fontTools.designspaceLib.split import splitVariableFonts
+    from .dsCompiler import getTTPaths
+    from .transport import readTransferData
+    h = _newHash("designspace", int(fontNumber), bool(shouldCompileFeatures), bool(shouldAddMetrics))
+    _hashFile(h, dsPath, "designspace")
+    _, doc = list(splitVariableFonts(DesignSpaceDocument.fromfile(dsPath)))[int(fontNumber)]
+    # The compiled masters contain everything we need from the glyphs
+    for index, (ufoPath, ttPath) in enumerate(sorted(getTTPaths(doc, ttFolder).items())):
+        data = readTransferData(ttPath)
+        h.update(f"master_{index}".encode("utf-8"))
+        h.update(len(data).to_bytes(8, "little"))
+        h.update(data)
+    # The variable features are compiled from the sources directly, as are
+    # the advances of sparse layer sources
+    layerSourcePaths = {source.path for source in doc.sources if source.layerName is not None}
+    for sourcePath in sorted({source.path for source in doc.sources}):
+        _hashUFO(h, sourcePath, False, shouldAddMetrics and sourcePath in layerSourcePaths)
+    return h.hexdigest()
+
+
+def getTTXCacheKey(ttxPath):
+    h = _newHash("ttx")
+    _hashFile(h, ttxPath, "ttx")
+    return h.hexdigest()
@@ -1,74 +1,154 @@
 import asyncio
+import contextvars
+import functools
+import io
+import itertools
+import logging
 import os
-import shlex
-import signal
+import pickle
 import sys
-import tempfile
-from .workServer import ERROR_MARKER, SUCCESS_MARKER
+from typing import Any, NamedTuple
+from ..misc.decorators import asyncTask
+from .compileCache import getCompileCache, getDSCacheKey, getTTXCacheKey, getUFOCacheKey
+from .transport import TransferFolder, readTransferData, transferPath, writeTransferData
+from . import workServer
 
 
-async def compileUFOToPath(ufoPath, ttPath, shouldCompileFeatures, outputWriter):
-    pool = getCompilerPool()
+logger = logging.getLogger(__name__)
+
+
+# Compile requests made while this is set are identified by its value, which
+# CompilerPool uses to look up their priority
+compileRequestKey = contextvars.ContextVar("compileRequestKey", default=None)
+
+
+async def compileUFOToPath(ufoPath, ttPath, shouldCompileFeatures, outputWriter, shouldAddMetrics=False):
+    getCacheKey = functools.partial(getUFOCacheKey, ufoPath, shouldCompileFeatures, shouldAddMetrics)
     func = "fontgoggles.compile.ufoCompiler.compileUFOToPath"
     args = [
         os.fspath(ufoPath),
         os.fspath(ttPath),
-        "true" if shouldCompileFeatures else "",
+        bool(shouldCompileFeatures),
+        bool(shouldAddMetrics),
     ]
-    return await pool.callFunction(func, args, outputWriter)
+    return await _callCachedFunction(getCacheKey, ttPath, func, args, outputWriter)
+
 
+async def compileUFOToBytes(ufoPath, shouldCompileFeatures, outputWriter, shouldAddMetrics=False):
+    with TransferFolder() as folder:
+        ttPath = transferPath(folder, "font.ttf")
+        await compileUFOToPath(ufoPath, ttPath, shouldCompileFeatures, outputWriter, shouldAddMetrics)
+        fontData = readTransferData(ttPath)
+    return fontData or None
 
-async def compileUFOToBytes(ufoPath, shouldCompileFeatures, outputWriter):
-    with tempfile.NamedTemporaryFile(prefix="fontgoggles_temp", suffix=".ttf") as tmp:
-        await compileUFOToPath(ufoPath, tmp.name, shouldCompileFeatures, outputWriter)
-        with open(tmp.name, "rb") as f:
-            fontData = f.read()
-            if not fontData:
-                fontData = None
-    return fontData
 
+async def compileUFOFeaturesToBytes(ufoPath, baseFontData, widths, revCmap, anchors, outputWriter):
+    # Recompile only the features, see ufoCompiler.compileUFOFeaturesToFont().
+    # This is not cached: the result depends on the base font and glyph info.
+    if outputWriter is None:
+        outputWriter = sys.stderr.write
+    func = "fontgoggles.compile.ufoCompiler.compileUFOFeaturesToPath"
+    with TransferFolder() as folder:
+        baseFontPath = transferPath(folder, "base.ttf")
+        ttPath = transferPath(folder, "font.ttf")
+        writeTransferData(baseFontPath, baseFontData)
+        args = [os.fspath(ufoPath), baseFontPath, ttPath, widths, revCmap, anchors]
+        await getCompilerPool().callFunction(func, args, outputWriter)
+        fontData = readTransferData(ttPath)
+    return fontData or None
 
-async def compileDSToPath(dsPath, fontNumber, ttFolder, ttPath, shouldCompileFeatures, outputWriter):
-    pool = getCompilerPool()
+
+async def compileDSToPath(dsPath, fontNumber, ttFolder, ttPath, shouldCompileFeatures, outputWriter,
+                          shouldAddMetrics=False):
+    getCacheKey = functools.partial(getDSCacheKey, dsPath, fontNumber, ttFolder, shouldCompileFeatures,
+                                    shouldAddMetrics)
     func = "fontgoggles.compile.dsCompiler.compileDSToPath"
     args = [
         os.fspath(dsPath),
-        str(fontNumber),
+        int(fontNumber),
         os.fspath(ttFolder),
         os.fspath(ttPath),
-        "true" if shouldCompileFeatures else ""
+        bool(shouldCompileFeatures),
+        bool(shouldAddMetrics),
     ]
-    return await pool.callFunction(func, args, outputWriter)
+    return await _callCachedFunction(getCacheKey, ttPath, func, args, outputWriter)
 
 
-async def compileDSToBytes(dsPath, fontNumber, ttFolder, shouldCompileFeatures, outputWriter):
-    with tempfile.NamedTemporaryFile(prefix="fontgoggles_temp", suffix=".ttf") as tmp:
-        await compileDSToPath(dsPath, fontNumber, ttFolder, tmp.name, shouldCompileFeatures, outputWriter)
-        with open(tmp.name, "rb") as f:
-            fontData = f.read()
-            if not fontData:
-                fontData = None
-    return fontData
+async def compileDSToBytes(dsPath, fontNumber, ttFolder, shouldCompileFeatures, outputWriter,
+                           shouldAddMetrics=False):
+    with TransferFolder() as folder:
+        ttPath = transferPath(folder, "font.ttf")
+        await compileDSToPath(dsPath, fontNumber, ttFolder, ttPath, shouldCompileFeatures, outputWriter,
+                              shouldAddMetrics)
+        fontData = readTransferData(ttPath)
+    return fontData or None
 
 
 async def compileTTXToPath(ttxPath, ttPath, outputWriter):
-    pool = getCompilerPool()
+    getCacheKey = functools.partial(getTTXCacheKey, ttxPath)
     func = "fontgoggles.compile.ttxCompiler.compileTTXToPath"
     args = [
         os.fspath(ttxPath),
         os.fspath(ttPath),
     ]
-    return await pool.callFunction(func, args, outputWriter)
+    return await _callCachedFunction(getCacheKey, ttPath, func, args, outputWriter)
 
 
 async def compileTTXToBytes(ttxPath, outputWriter):
-    with tempfile.NamedTemporaryFile(prefix="fontgoggles_temp", suffix=".ttf") as tmp:
-        await compileTTXToPath(ttxPath, tmp.name, outputWriter)
-        with open(tmp.name, "rb") as f:
-            fontData = f.read()
-            if not fontData:
-                fontData = None
-    return fontData
+    with TransferFolder() as folder:
+        ttPath = transferPath(folder, "font.ttf")
+        await compileTTXToPath(ttxPath, ttPath, outputWriter)
+        fontData = readTransferData(ttPath)
+    return fontData or None
+
+
+async def _callCachedFunction(getCacheKey, ttPath, func, args, outputWriter):
+    # Call a compile function that writes a font to ttPath, unless the result
+    # is found in the compile cache. The compiler output is cached as well.
+    if outputWriter is None:
+        outputWriter = sys.stderr.write
+    cache = getCompileCache()
+    if cache is None:
+        return await getCompilerPool().callFunction(func, args, outputWriter)
+
+    loop = asyncio.get_running_loop()
+    try:
+        cacheKey = await loop.run_in_executor(None, getCacheKey)
+    except Exception:
+        # Don't use the cache, let the compiler report the problem
+        cacheKey = None
+    if cacheKey is not None:
+        cachedResult = await loop.run_in_executor(None, cache.get, cacheKey)
+        if cachedResult is not None:
+            fontData, output = cachedResult
+            if output:
+                outputWriter(output)
+            writeTransferData(ttPath, fontData)
+            return
+
+    output = io.StringIO()
+
+    def writeOutput(text):
+        output.write(text)
+        outputWriter(text)
+
+    await getCompilerPool().callFunction(func, args, writeOutput)  # Raises CompilerError upon failure
+
+    if cacheKey is not None:
+        fontData = readTransferData(ttPath)
+        if fontData:
+            try:
+                await loop.run_in_executor(None, cache.put, cacheKey, fontData, output.getvalue())
+            except OSError as e:
+                outputWriter(f"Could not write to the compile cache: {e}\n")
+
+
+@asyncTask
+async def prewarmCompilerPool(numWorkers=None):
+    """Schedule the start of compiler workers, see CompilerPool.prewarm().
+    Must be called with a running event loop. Returns the task.
+    """
+    await getCompilerPool().prewarm(numWorkers)
 
 
 def getCompilerPool():
@@ -86,76 +166,359 @@ class CompilerError(Exception):
 
 class CompilerPool:
 
-    def __init__(self, maxWorkers=5):
+    """A pool of compile worker processes. Workers are added when requests
+    come in and no worker is available, up to `maxWorkers`, which defaults
+    to the number of CPUs. Workers that have been idle for `idleTimeout`
+    seconds are stopped, but `minWorkers` workers are kept around.
+
+    When all workers are busy, requests wait in a queue. The request with
+    the highest priority gets the next available worker. A request's
+    priority is determined by its request key, which is taken from the
+    `compileRequestKey` context variable at the time of the request; see
+    setPriority().
+    """
+
+    numPrewarmWorkers = 2
+
+    def __init__(self, maxWorkers=None, minWorkers=1, idleTimeout=60):
         self.loop = asyncio.get_running_loop()
+        if maxWorkers is None:
+            maxWorkers = os.cpu_count() or 1
         self.maxWorkers = maxWorkers
+        self.minWorkers = minWorkers
+        self.idleTimeout = idleTimeout
         self.workers = []
-        self.availableWorkers = asyncio.Queue()
+        # Used as a stack: this keeps the busy workers busy, so the others
+        # become idle and can be retired
+        self.idleWorkers = []
+        self.numStartingWorkers = 0
+        # Starting workers that will go to a specific request, as opposed to
+        # the ones started by prewarm()
+        self.numAssignedStartingWorkers = 0
+        self._startTasks = set()
+        self.pendingRequests = []
+        self.priorities = {}
+        self._requestCounter = itertools.count()
+        self._idleCheckHandle = None
 
-    async def getWorker(self):
-        if self.availableWorkers.empty() and len(self.workers) < self.maxWorkers:
-            # Add a worker process
-            worker = CompilerWorker()
-            self.workers.append(worker)
-            assert len(self.workers) <= self.maxWorkers
-            await worker.start()
-            return worker
+    def setLimits(self, maxWorkers=None, minWorkers=None, idleTimeout=None):
+        """Change the pool limits. Arguments that are None are left unchanged.
+        If the new maximum is lower than the current number of workers,
+        idle workers are stopped immediately, busy workers when they're done.
+        """
+        if maxWorkers is not None:
+            self.maxWorkers = maxWorkers
+        if minWorkers is not None:
+            self.minWorkers = minWorkers
+        if idleTimeout is not None:
+            self.idleTimeout = idleTimeout
+        if self._idleCheckHandle is not None:
+            self._idleCheckHandle.cancel()
+            self._idleCheckHandle = None
+        self._retireWorkers()
+        self._startWorkersForPendingRequests()
+
+    def setPriority(self, requestKey, priority):
+        """Set the priority for all current and future requests with
+        `requestKey`. Higher values are dispatched first. The default
+        priority is 0.
+        """
+        if priority:
+            self.priorities[requestKey] = priority
         else:
-            return await self.availableWorkers.get()
+            self.priorities.pop(requestKey, None)
+
+    def cancelPendingRequests(self, requestKey):
+        """Cancel all requests with `requestKey` that are waiting for a worker.
+        The callers will receive a CancelledError.
+        """
+        for request in self.pendingRequests:
+            if request.requestKey == requestKey:
+                request.future.cancel()
+
+    @property
+    def occupancy(self):
+        numIdleWorkers = len(self.idleWorkers)
+        numBusyWorkers = len(self.workers) - numIdleWorkers - self.numStartingWorkers
+        return dict(workers=len(self.workers), busy=numBusyWorkers, idle=numIdleWorkers,
+                    starting=self.numStartingWorkers, waiting=len(self.pendingRequests),
+                    maxWorkers=self.maxWorkers)
+
+    @property
+    def numReadyWorkers(self):
+        return sum(worker.isReady for worker in self.workers)
+
+    @property
+    def isReady(self):
+        """True if at least one worker is ready to accept requests."""
+        return self.numReadyWorkers > 0
+
+    async def prewarm(self, numWorkers=None):
+        """Start worker processes ahead of time, so the first compile
+        requests don't have to wait for a worker to start up and import the
+        compiler modules. Starts at most `numWorkers` (the default is
+        `numPrewarmWorkers`) minus the number of existing workers. Returns
+        when the new workers are ready.
+        """
+        if numWorkers is None:
+            numWorkers = self.numPrewarmWorkers
+        numNewWorkers = min(numWorkers, self.maxWorkers) - len(self.workers)
+        # Add the workers right away, so overlapping calls don't start more
+        # workers than asked for
+        newWorkers = [self._addWorker() for i in range(numNewWorkers)]
+        results = await asyncio.gather(*(self._startWorker(worker) for worker in newWorkers),
+                                       return_exceptions=True)
+        errors = [result for result in results if isinstance(result, BaseException)]
+        for worker in results:
+            if not isinstance(worker, BaseException):
+                self._releaseWorker(worker)
+        if errors:
+            raise errors[0]
+
+    async def stopIdleWorkers(self):
+        """Stop all idle workers right away, regardless of `minWorkers`, and
+        wait for their processes to exit. This is for clients that only run
+        the event loop now and then, so the idle timeout can't be relied on.
+        """
+        workers, self.idleWorkers = self.idleWorkers, []
+        for worker in workers:
+            self._stopWorker(worker)
+        await asyncio.gather(*(worker.process.wait() for worker in workers))
+
+    def _addWorker(self):
+        # Reserve a place in the pool for a worker that is about to start
+        worker = CompilerWorker()
+        self.workers.append(worker)
+        self.numStartingWorkers += 1
+        return worker
+
+    async def _startWorker(self, worker=None):
+        if worker is None:
+            worker = self._addWorker()
+        try:
+            await worker.start()
+        except BaseException:
+            self.workers.remove(worker)
+            raise
+        finally:
+            self.numStartingWorkers -= 1
+        return worker
+
+    async def getWorker(self):
+        while self.idleWorkers:
+            worker = self.idleWorkers.pop()
+            if worker.isAlive:
+                return worker
+            self._stopWorker(worker)  # It died while idle
+        # Only add a worker process if the workers that are starting up
+        # have already been claimed by other requests
+        if (len(self.workers) < self.maxWorkers and
+                self.numStartingWorkers - self.numAssignedStartingWorkers <= len(self.pendingRequests)):
+            # The new worker is ours, other requests shouldn't wait for it
+            self.numAssignedStartingWorkers += 1
+            try:
+                return await self._startWorker()
+            finally:
+                self.numAssignedStartingWorkers -= 1
+        request = _PendingRequest(compileRequestKey.get(), next(self._requestCounter),
+                                  self.loop.create_future())
+        self.pendingRequests.append(request)
+        try:
+            return await request.future
+        except asyncio.CancelledError:
+            if request.future.done() and not request.future.cancelled():
+                # We were cancelled after a worker was assigned to us
+                self._releaseWorker(request.future.result())
+            raise
+        finally:
+            if request in self.pendingRequests:
+                self.pendingRequests.remove(request)
 
     async def callFunction(self, func, args, outputWriter):
         if outputWriter is None:
             outputWriter = sys.stderr.write
         worker = await self.getWorker()
         try:
-            error = await worker.callFunction(func, args, outputWriter)
+            response = await worker.callFunction(func, args, outputWriter)
         finally:
-            await self.availableWorkers.put(worker)
-        if error:
+            self._releaseWorker(worker)
+        logger.debug("%s took %.3f seconds", func, response["duration"])
+        if not response["ok"]:
             raise CompilerError(func)
+        return response["result"]
+
+    def _releaseWorker(self, worker):
+        if not worker.isAlive or len(self.workers) > self.maxWorkers:
+            self._stopWorker(worker)
+            self._startWorkersForPendingRequests()
+            return
+        request = self._popPendingRequest()
+        if request is not None:
+            request.future.set_result(worker)
+            return
+        worker.lastUsed = self.loop.time()
+        self.idleWorkers.append(worker)
+        if self._idleCheckHandle is None and len(self.workers) > self.minWorkers:
+            self._idleCheckHandle = self.loop.call_later(self.idleTimeout, self._retireWorkers)
+
+    def _popPendingRequest(self):
+        # Return the pending request with the highest priority, or the oldest
+        # one if there are several
+        requests = [request for request in self.pendingRequests if not request.future.done()]
+        if not requests:
+            return None
+        priorities = self.priorities
+        request = max(requests, key=lambda request: (priorities.get(request.requestKey, 0), -request.order))
+        self.pendingRequests.remove(request)
+        return request
+
+    def _startWorkersForPendingRequests(self):
+        # Waiting requests are normally served by workers that are released,
+        # but after a worker was stopped or maxWorkers was raised there may
+        # be room for new ones
+        while len(self.workers) < self.maxWorkers:
+            request = self._popPendingRequest()
+            if request is None:
+                break
+            self.numAssignedStartingWorkers += 1
+            task = asyncio.create_task(self._startWorkerForRequest(self._addWorker(), request))
+            self._startTasks.add(task)
+            task.add_done_callback(self._startTasks.discard)
+
+    async def _startWorkerForRequest(self, worker, request):
+        try:
+            worker = await self._startWorker(worker)
+        except asyncio.CancelledError:
+            request.future.cancel()
+            raise
+        except Exception as e:
+            if not request.future.done():
+                request.future.set_exception(e)
+            # Give the next request a chance
+            self._startWorkersForPendingRequests()
+            return
+        finally:
+            self.numAssignedStartingWorkers -= 1
+        if request.future.done():
+            # The request was cancelled in the meantime
+            self._releaseWorker(worker)
+        else:
+            request.future.set_result(worker)
+
+    def _stopWorker(self, worker):
+        self.workers.remove(worker)
+        worker.stop()
+
+    def _retireWorkers(self):
+        # Stop workers that have been idle for too long, or that exceed maxWorkers
+        self._idleCheckHandle = None
+        idleWorkers = sorted(self.idleWorkers, key=lambda worker: worker.lastUsed)
+        now = self.loop.time()
+        keepWorkers = []
+        for worker in idleWorkers:
+            if len(self.workers) > self.maxWorkers or (
+                    len(self.workers) > self.minWorkers and now - worker.lastUsed >= self.idleTimeout):
+                self._stopWorker(worker)
+            else:
+                keepWorkers.append(worker)
+        self.idleWorkers = keepWorkers
+        if keepWorkers and len(self.workers) > self.minWorkers:
+            delay = keepWorkers[0].lastUsed + self.idleTimeout - now
+            self._idleCheckHandle = self.loop.call_later(max(delay, 0), self._retireWorkers)
+
+
+class _PendingRequest(NamedTuple):
+    requestKey: Any
+    order: int
+    future: asyncio.Future
 
 
 class CompilerWorker:
 
+    isReady = False
+    lastUsed = 0
+
     async def start(self):
         env = dict(PYTHONPATH=":".join(sys.path), PYTHONHOME=sys.prefix)
+        if "FONTGOGGLES_CACHE_DIR" in os.environ:
+            # The worker should use the same persistent caches as we do
+            env["FONTGOGGLES_CACHE_DIR"] = os.environ["FONTGOGGLES_CACHE_DIR"]
         args = ["-u", "-m", "fontgoggles.compile.workServer"]
+        # The worker's stderr is our own: any output that isn't captured for
+        # a request ends up there
         self.process = await asyncio.create_subprocess_exec(
             sys.executable, *args,
             env=env,
             stdin=asyncio.subprocess.PIPE,
-            stdout=asyncio.subprocess.PIPE,
-            stderr=asyncio.subprocess.STDOUT)
+            stdout=asyncio.subprocess.PIPE)
+        self._pendingCalls = {}
+        self._requestIDs = itertools.count()
+        # Wait for the worker to have imported the compiler modules
+        message = await self._readMessage()
+        if message is None or message["type"] != "ready":
+            raise RuntimeError("broken subprocess")
+        self._readerTask = asyncio.create_task(self._readResponses())
+        self.isReady = True
 
-    async def callFunction(self, func, args, outputWriter):
-        args = [func] + args
-        inData = " ".join(shlex.quote(item) for item in args)
-        self.process.stdin.write((inData + "\n").encode("utf-8"))
-        await self.process.stdin.drain()
-        error = True
-        cancelling = False
+    @property
+    def isAlive(self):
+        """False if the worker process has exited, or its output was closed."""
+        return self.process.returncode is None and not self._readerTask.done()
+
+    def stop(self):
+        # The work server exits when its input is closed
+        self.isReady = False
+        if self.process.returncode is None:
+            self.process.stdin.close()
+
+    async def _readMessage(self):
+        try:
+            header = await self.process.stdout.readexactly(workServer.headerSize)
+            data = await self.process.stdout.readexactly(workServer.unpackHeader(header))
+        except asyncio.IncompleteReadError:
+            return None
+        return pickle.loads(data)
+
+    async def _readResponses(self):
         while True:
-            try:
-                line = await self.process.stdout.readline()
-            except asyncio.CancelledError:
-                self.process.send_signal(signal.SIGINT)
-                # We will re-raise only after we've received all
-                # our expected output, which should not be much as
-                # we just sent SIGINT to the worker process.
-                cancelling = True
-                continue
-            if not line:
-                raise RuntimeError("broken subprocess")
-                break
-            line = line.decode("utf-8")
-            line = line.rstrip('\n')
-            if line == ERROR_MARKER:
-                error = True
+            message = await self._readMessage()
+            if message is None:
                 break
-            if line == SUCCESS_MARKER:
-                error = False
-                break
-            outputWriter(line + "\n")
-        if cancelling:
-            raise asyncio.CancelledError()
-        return error
+            future = self._pendingCalls.pop(message["id"], None)
+            if future is not None and not future.done():
+                future.set_result(message)
+        for future in self._pendingCalls.values():
+            if not future.done():
+                future.set_exception(RuntimeError("broken subprocess"))
+        self._pendingCalls = {}
+
+    def _sendMessage(self, message):
+        self.process.stdin.write(workServer.packMessage(message))
+
+    async def callFunction(self, func, args, outputWriter):
+        """Call `func` (a "module.function" string) with `args` in the worker
+        process. Several calls can be in flight at the same time; they are
+        executed in order. Returns the response dict, see workServer.
+        """
+        if self._readerTask.done():
+            raise RuntimeError("broken subprocess")
+        requestID = next(self._requestIDs)
+        future = asyncio.get_running_loop().create_future()
+        self._pendingCalls[requestID] = future
+        self._sendMessage(dict(type="call", id=requestID, func=func, args=list(args)))
+        try:
+            await self.process.stdin.drain()
+            response = await asyncio.shield(future)
+        except asyncio.CancelledError:
+            # Ask the worker to stop, and only re-raise once it has
+            # responded, so the worker is free when we return.
+            self._sendMessage(dict(type="cancel", id=requestID))
+            try:
+                await future
+            except RuntimeError:
+                pass
+            raise
+        for output in [response["stdout"], response["stderr"], response["error"]]:
+            if output:
+                outputWriter(output)
+        return response
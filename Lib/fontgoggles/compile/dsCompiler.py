@@ -1,3 +1,4 @@
+import io
 import os
 import pickle
 import sys
@@ -5,16 +6,22 @@ from collections import defaultdict
 from fontTools.designspaceLib import DesignSpaceDocument
 from fontTools.designspaceLib.split import splitVariableFonts
 from fontTools.fontBuilder import FontBuilder
+from fontTools.misc.roundTools import otRound
 from fontTools.ttLib import TTFont, newTable
 from fontTools import varLib
 from fontTools.ufoLib import UFOReader
 from fontTools.varLib.errors import VarLibError
 from ufo2ft.featureCompiler import VariableFeatureCompiler
-from .ufoCompiler import MinimalFontObject
+from .transport import readTransferData, saveFont, transferPath
+from .ufoCompiler import MinimalFontObject, fetchGlyphInfo
 
 
-def compileDSToFont(dsPath, fontNumber, ttFolder, shouldCompileFeatures):
-    fontNumber = int(fontNumber)
+def compileDSToFont(dsPath, fontNumber, ttFolder, shouldCompileFeatures, shouldAddMetrics=False):
+    """Build a variable font from the compiled masters in ttFolder. If
+    `shouldAddMetrics` is True, the masters must have been compiled with an
+    'hmtx' table, and an 'HVAR' table is built, so HarfBuzz can resolve the
+    advances at any location by itself.
+    """
     docs = list(splitVariableFonts(DesignSpaceDocument.fromfile(dsPath)))
     _, doc = docs[fontNumber]
 
@@ -23,9 +30,7 @@ def compileDSToFont(dsPath, fontNumber, ttFolder, shouldCompileFeatures):
     for source in doc.sources:
         if source.layerName is None:
             ttPath = ufoPathToTTPath[source.path]
-            if not os.path.exists(ttPath):
-                raise FileNotFoundError(ttPath)
-            source.font = TTFont(ttPath, lazy=False)
+            source.font = TTFont(io.BytesIO(readTransferData(ttPath)), lazy=False)
 
     assert doc.default.font is not None
     if "name" not in doc.default.font:
@@ -39,9 +44,14 @@ def compileDSToFont(dsPath, fontNumber, ttFolder, shouldCompileFeatures):
         font = fb.font
         for source in doc.sources:
             if source.font is None:
-                source.font = font
-
-    exclude = ['HVAR', 'VVAR', 'STAT']
+                if shouldAddMetrics:
+                    source.font = makeSparseMasterFont(doc.default.font, source)
+                else:
+                    source.font = font
+
+    exclude = ['VVAR', 'STAT']
+    if not shouldAddMetrics:
+        exclude.append('HVAR')
     if shouldCompileFeatures:
         exclude.extend(['GSUB', 'GPOS', 'GDEF'])
 
@@ -74,14 +84,28 @@ def compileDSToFont(dsPath, fontNumber, ttFolder, shouldCompileFeatures):
     return ttFont
 
 
-def compileDSToPath(dsPath, fontNumber, ttFolder, ttPath, shouldCompileFeatures):
-    ttFont = compileDSToFont(dsPath, fontNumber, ttFolder, shouldCompileFeatures)
-    ttFont.save(ttPath, reorderTables=False)
+def compileDSToPath(dsPath, fontNumber, ttFolder, ttPath, shouldCompileFeatures, shouldAddMetrics=False):
+    ttFont = compileDSToFont(dsPath, fontNumber, ttFolder, shouldCompileFeatures, shouldAddMetrics)
+    saveFont(ttFont, ttPath)
+
+
+def makeSparseMasterFont(defaultFont, source):
+    # A master font for a sparse layer source: it only has advances for the
+    # glyphs in the layer, the others don't participate in HVAR
+    reader = UFOReader(source.path, validate=False)
+    glyphSet = reader.getGlyphSet(layerName=source.layerName)
+    widths, _, _, _ = fetchGlyphInfo(glyphSet, source.path)
+    fb = FontBuilder(unitsPerEm=defaultFont["head"].unitsPerEm)
+    fb.setupGlyphOrder(defaultFont.getGlyphOrder())
+    fb.setupCharacterMap({})
+    fb.setupPost()
+    fb.setupHorizontalMetrics({glyphName: (otRound(width or 0), 0) for glyphName, width in widths.items()})
+    return fb.font
 
 
 def getTTPaths(doc, ttFolder):
     ufoPaths = sorted({s.path for s in doc.sources if s.layerName is None})
-    return {ufoPath: os.path.join(ttFolder, f"master_{index}.ttf")
+    return {ufoPath: transferPath(ttFolder, f"master_{index}.ttf")
             for index, ufoPath in enumerate(ufoPaths)}
 
 
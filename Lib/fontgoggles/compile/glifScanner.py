@@ -0,0 +1,114 @@
+"""Fast extraction of advance widths, unicodes and anchors from .glif data.
+
+This module is kept light on imports, as it gets imported by the processes
+that scan large glyph sets in parallel.
+"""
+
+import re
+import xml.etree.ElementTree as ET
+from fontTools.ufoLib.glifLib import _BaseParser as BaseGlifParser
+
+
+_tagGLIFPattern = re.compile(rb"(<\s*(advance|anchor|unicode)\s+([^>]+)>)")
+_ufo2AnchorPattern = re.compile(
+    rb"<contour>\s+(<point\s+[^>]+move[^>]+name[^>]+>)\s+</contour>"
+)
+_unicodeAttributeGLIFPattern = re.compile(rb"hex\s*=\s*\"([0-9A-Fa-f]+)\"")
+_widthAttributeGLIFPattern = re.compile(rb"width\s*=\s*\"([0-9A-Fa-f]+)\"")
+
+
+def scanGLIF(data, ufo2=False):
+    """Return a (width, unicodes, anchors) tuple for the .glif `data`."""
+    if b"<!--" in data:
+        # Fall back to proper parser, assuming this to be uncommon
+        # (This does not work for UFO 2)
+        return fetchUnicodesAndAnchors(data)
+    # Fast route with regex
+    width = None
+    unicodes = []
+    glyphAnchors = []
+    for rawElement, tag, rawAttributes in _tagGLIFPattern.findall(data):
+        if tag == b"unicode":
+            m = _unicodeAttributeGLIFPattern.match(rawAttributes)
+            try:
+                unicodes.append(int(m.group(1), 16))
+            except ValueError:
+                pass
+        elif tag == b"anchor":
+            root = ET.fromstring(rawElement)
+            glyphAnchors.append(_parseAnchorAttrs(root.attrib))
+        elif tag == b"advance":
+            m = _widthAttributeGLIFPattern.search(rawAttributes)
+            if m is not None:
+                width = float(m.group(1))
+    if ufo2:
+        for rawElement in _ufo2AnchorPattern.findall(data):
+            root = ET.fromstring(rawElement)
+            glyphAnchors.append(_parseAnchorAttrs(root.attrib))
+    return width, unicodes, glyphAnchors
+
+
+def scanGLIFFiles(paths, ufo2=False):
+    """Read and scan a list of .glif files, and return a list with a
+    (width, unicodes, anchors) tuple for each.
+    """
+    results = []
+    for path in paths:
+        with open(path, "rb") as f:
+            data = f.read()
+        results.append(scanGLIF(data, ufo2))
+    return results
+
+
+def fetchUnicodesAndAnchors(glif):
+    """
+    Get a list of unicodes listed in glif.
+    """
+    parser = FetchUnicodesAndAnchorsParser()
+    parser.parse(glif)
+    return parser.advanceWidth, parser.unicodes, parser.anchors
+
+
+def _parseNumber(s):
+    if not s:
+        return None
+    f = float(s)
+    i = int(f)
+    if i == f:
+        return i
+    return f
+
+
+def _parseAnchorAttrs(attrs):
+    return (
+        attrs.get("name"),
+        _parseNumber(attrs.get("x")),
+        _parseNumber(attrs.get("y")),
+        attrs.get("identifier"),
+    )
+
+
+class FetchUnicodesAndAnchorsParser(BaseGlifParser):
+
+    def __init__(self):
+        self.unicodes = []
+        self.anchors = []
+        self.advanceWidth = None
+        super().__init__()
+
+    def startElementHandler(self, name, attrs):
+        if self._elementStack and self._elementStack[-1] == "glyph":
+            if name == "unicode":
+                value = attrs.get("hex")
+                if value is not None:
+                    try:
+                        value = int(value, 16)
+                        if value not in self.unicodes:
+                            self.unicodes.append(value)
+                    except ValueError:
+                        pass
+            elif name == "anchor":
+                self.anchors.append(_parseAnchorAttrs(attrs))
+            elif name == "advance":
+                self.advanceWidth = _parseNumber(attrs.get("width"))
+        super().startElementHandler(name, attrs)
@@ -0,0 +1,85 @@
+"""A persistent index of the glyph info that is extracted from .glif files:
+advance widths, unicodes and anchors.
+
+There is one index per glyph folder. Entries are keyed by .glif file name,
+and hold the modification time and size of the file, so only new or modified
+.glif files need to be read again, even in a new session. For a large UFO on
+a slow file system, that turns a full scan into a stat pass.
+
+Digest indices work the same way, for the content hashes of the .glif files
+that make up a UFO's compile cache key.
+"""
+
+import hashlib
+import os
+import fontgoggles
+from .compileCache import CompileCache, getCacheFolder
+
+
+indexFormatVersion = 1
+defaultMaxIndexSize = 100 * 1024 * 1024  # bytes
+
+
+class GlyphInfoCache(CompileCache):
+
+    """A folder with glyph info indices. Once the total size of the index
+    files exceeds `maxSize`, the least recently used ones are removed.
+    """
+
+    fileExtension = ".fgindex"
+
+    def __init__(self, folder, maxSize=defaultMaxIndexSize):
+        super().__init__(folder, maxSize)
+
+    def getIndex(self, glyphsFolder, ufo2):
+        """Return a dict with a ((mtime, size), glyphInfo) tuple for each
+        .glif file name, or an empty dict if there is no index for
+        `glyphsFolder` yet. See ufoCompiler.scanGlyphs() for the glyph info.
+        """
+        index = self._read(self._getIndexKey(glyphsFolder, bool(ufo2)))
+        return index if isinstance(index, dict) else {}
+
+    def putIndex(self, glyphsFolder, ufo2, index):
+        self._write(self._getIndexKey(glyphsFolder, bool(ufo2)), index)
+
+    def getDigestIndex(self, glyphsFolder):
+        """Return a dict with a ((mtime, size), digest) tuple for each file
+        name, or an empty dict if there is no digest index for `glyphsFolder`
+        yet. See compileCache.getUFOCacheKey().
+        """
+        index = self._read(self._getIndexKey(glyphsFolder, "digests"))
+        return index if isinstance(index, dict) else {}
+
+    def putDigestIndex(self, glyphsFolder, index):
+        self._write(self._getIndexKey(glyphsFolder, "digests"), index)
+
+    def _getIndexKey(self, glyphsFolder, kind):
+        h = hashlib.blake2b(digest_size=20)
+        header = (indexFormatVersion, fontgoggles.__version__, kind,
+                  os.path.realpath(glyphsFolder))
+        h.update(repr(header).encode("utf-8", "surrogateescape"))
+        return h.hexdigest()
+
+
+_glyphInfoCache = None
+_glyphInfoCacheInitialized = False
+
+
+def getGlyphInfoCache():
+    """Return the GlyphInfoCache instance to use, or None if caching is
+    disabled. See compileCache.getCompileCache().
+    """
+    global _glyphInfoCache, _glyphInfoCacheInitialized
+    if not _glyphInfoCacheInitialized:
+        folder = getCacheFolder()
+        if folder is not None:
+            _glyphInfoCache = GlyphInfoCache(folder / "glyphinfo")
+        _glyphInfoCacheInitialized = True
+    return _glyphInfoCache
+
+
+def setGlyphInfoCache(glyphInfoCache):
+    """Set the GlyphInfoCache instance to use. Pass None to disable caching."""
+    global _glyphInfoCache, _glyphInfoCacheInitialized
+    _glyphInfoCache = glyphInfoCache
+    _glyphInfoCacheInitialized = True
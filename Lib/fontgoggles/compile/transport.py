@@ -0,0 +1,147 @@
+"""Transfer compiled font data between the parent process and the compile
+workers, without going through the file system if possible.
+
+A "transfer path" is either a regular file system path, or a reference to a
+shared memory block, of the form "shm:<name>". Transfer paths are created in
+the context of a TransferFolder, which takes care of cleaning up:
+
+    with TransferFolder() as folder:
+        ttPath = transferPath(folder, "font.ttf")
+        # a compile worker calls saveFont(ttFont, ttPath)
+        fontData = readTransferData(ttPath)
+"""
+
+import io
+import os
+import secrets
+import sys
+import tempfile
+
+try:
+    from multiprocessing import shared_memory
+    from multiprocessing import resource_tracker
+except ImportError:
+    shared_memory = None
+
+
+SHM_PREFIX = "shm:"
+_headerSize = 8  # The size of a shared memory block may be rounded up, so we store the data size
+
+# Shared memory folders that are owned by this process, and the names of the
+# blocks that were handed out for each
+_sharedMemoryFolders = {}
+
+
+class TransferFolder:
+
+    """Context manager that returns a folder for transfer paths. When
+    `useSharedMemory` is True (the default if the platform supports it),
+    the data lives in shared memory blocks, else a temporary directory is
+    used. Either way, everything is cleaned up when the context exits.
+    """
+
+    useSharedMemoryDefault = shared_memory is not None
+
+    def __init__(self, useSharedMemory=None):
+        if useSharedMemory is None:
+            useSharedMemory = self.useSharedMemoryDefault
+        self.useSharedMemory = useSharedMemory
+        self._tempDir = None
+
+    def __enter__(self):
+        if self.useSharedMemory:
+            # Keep the names short: macOS limits them to 31 characters
+            self.folder = SHM_PREFIX + "fg" + secrets.token_hex(4)
+            _sharedMemoryFolders[self.folder] = set()
+        else:
+            self._tempDir = tempfile.TemporaryDirectory(prefix="fontgoggles_temp")
+            self.folder = self._tempDir.name
+        return self.folder
+
+    def __exit__(self, type, value, traceback):
+        if self._tempDir is not None:
+            self._tempDir.cleanup()
+            self._tempDir = None
+        else:
+            for name in _sharedMemoryFolders.pop(self.folder):
+                try:
+                    shm = _openSharedMemory(name)
+                except FileNotFoundError:
+                    continue  # Was never written
+                _unlinkSharedMemory(shm)
+
+
+def isSharedMemoryPath(path):
+    return isinstance(path, str) and path.startswith(SHM_PREFIX)
+
+
+def transferPath(folder, fileName):
+    if not isSharedMemoryPath(folder):
+        return os.path.join(folder, fileName)
+    name = folder[len(SHM_PREFIX):] + "_" + os.path.splitext(fileName)[0]
+    names = _sharedMemoryFolders.get(folder)
+    if names is not None:
+        names.add(name)
+    return SHM_PREFIX + name
+
+
+def readTransferData(path):
+    if not isSharedMemoryPath(path):
+        with open(path, "rb") as f:
+            return f.read()
+    shm = _openSharedMemory(path[len(SHM_PREFIX):])
+    try:
+        size = int.from_bytes(shm.buf[:_headerSize], "little")
+        return bytes(shm.buf[_headerSize:_headerSize + size])
+    finally:
+        shm.close()
+
+
+def writeTransferData(path, data):
+    if not isSharedMemoryPath(path):
+        with open(path, "wb") as f:
+            f.write(data)
+        return
+    name = path[len(SHM_PREFIX):]
+    size = _headerSize + len(data)
+    try:
+        shm = _openSharedMemory(name, create=True, size=size)
+    except FileExistsError:
+        # Overwrite: replace the block
+        _unlinkSharedMemory(_openSharedMemory(name))
+        shm = _openSharedMemory(name, create=True, size=size)
+    try:
+        shm.buf[:_headerSize] = len(data).to_bytes(_headerSize, "little")
+        shm.buf[_headerSize:size] = data
+    finally:
+        shm.close()
+
+
+def saveFont(ttFont, path):
+    """Save `ttFont` to a transfer path."""
+    if not isSharedMemoryPath(path):
+        ttFont.save(path, reorderTables=False)
+    else:
+        f = io.BytesIO()
+        ttFont.save(f, reorderTables=False)
+        writeTransferData(path, f.getvalue())
+
+
+def _openSharedMemory(name, create=False, size=0):
+    # The lifetime of the blocks is managed by TransferFolder, we don't want
+    # the resource tracker to unlink blocks when a worker process exits.
+    if sys.version_info >= (3, 13):
+        return shared_memory.SharedMemory(name, create=create, size=size, track=False)
+    shm = shared_memory.SharedMemory(name, create=create, size=size)
+    if os.name == "posix":
+        resource_tracker.unregister(shm._name, "shared_memory")
+    return shm
+
+
+def _unlinkSharedMemory(shm):
+    shm.close()
+    if sys.version_info < (3, 13) and os.name == "posix":
+        # unlink() unregisters the block, so balance that with a registration
+        # to keep the resource tracker from complaining
+        resource_tracker.register(shm._name, "shared_memory")
+    shm.unlink()
@@ -1,7 +1,8 @@
 from fontTools.ttLib import TTFont
+from .transport import saveFont
 
 
 def compileTTXToPath(ttxPath, ttPath):
     font = TTFont()
     font.importXML(ttxPath)
-    font.save(ttPath, reorderTables=False)
+    saveFont(font, ttPath)
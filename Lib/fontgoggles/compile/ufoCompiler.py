@@ -1,26 +1,37 @@
 """ Tools to compile a UFO's features as quickly as possible."""
 
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+import io
+import itertools
 import logging
+import math
+import multiprocessing
+import os
 import pickle
-import re
 import sys
 import traceback
 from types import SimpleNamespace
-import xml.etree.ElementTree as ET
 from fontTools.feaLib.error import FeatureLibError
 from fontTools.fontBuilder import FontBuilder
-from fontTools.ttLib import newTable
+from fontTools.misc.roundTools import otRound
+from fontTools.ttLib import TTFont, newTable
 from fontTools.ufoLib import UFOReader
-from fontTools.ufoLib.glifLib import _BaseParser as BaseGlifParser
 from ufo2ft.featureCompiler import FeatureCompiler
+from .glyphInfoCache import getGlyphInfoCache
+from .glifScanner import fetchUnicodesAndAnchors, scanGLIF, scanGLIFFiles  # noqa: F401
+from .transport import readTransferData, saveFont
 
 
-def compileUFOToFont(ufoPath, shouldCompileFeatures):
+def compileUFOToFont(ufoPath, shouldCompileFeatures, shouldAddMetrics=False, parallel=False):
     """Compile the source UFO to a TTF with the smallest amount of tables
     needed to let HarfBuzz do its work. That would be 'cmap', 'post' and
     whatever OTL tables are needed for the features. Return the compiled
     font data.
 
+    If `shouldAddMetrics` is True, an 'hmtx' table with the advance widths is
+    added as well, so HarfBuzz doesn't need to ask us for the advances. See
+    scanGlyphs() for the `parallel` argument.
+
     This function may do some redundant work (eg. we need an UFOReader
     elsewhere, too), but having a picklable argument and return value
     allows us to run it in a separate process, enabling parallelism.
@@ -35,7 +46,8 @@ def compileUFOToFont(ufoPath, shouldCompileFeatures):
     if ".notdef" not in glyphOrder:
         # We need a .notdef glyph, so let's make one.
         glyphOrder.insert(0, ".notdef")
-    widths, cmap, revCmap, anchors = fetchGlyphInfo(glyphSet, ufoPath, ufo2=ufo2)
+    widths, cmap, revCmap, anchors = fetchGlyphInfo(glyphSet, ufoPath, ufo2=ufo2, parallel=parallel,
+                                                    useIndex=True)
     fb = FontBuilder(round(info.unitsPerEm))
     fb.setupGlyphOrder(glyphOrder)
     fb.setupCharacterMap(cmap)
@@ -51,82 +63,234 @@ def compileUFOToFont(ufoPath, shouldCompileFeatures):
         ),
         xAvgCharWidth=0,  # To avoid dependency on hmtx table.
     )
+    if shouldAddMetrics:
+        setupHorizontalMetrics(fb, widths, info)
     ttFont = fb.font
-    # Store anchors in the font as a private table: this is valuable
+    # Store anchors and widths in the font as private tables: this is valuable
     # data that our parent process can use to do faster reloading upon
     # changes.
-    ttFont["FGAx"] = newTable("FGAx")
-    ttFont["FGAx"].data = pickle.dumps(anchors)
-    ufo = MinimalFontObject(ufoPath, reader, None, widths, revCmap, anchors)
+    setPrivateGlyphInfo(ttFont, widths, anchors)
 
     error = None
     if shouldCompileFeatures:
-        feaComp = FeatureCompiler(ufo, ttFont)
-        try:
-            feaComp.compile()
-        except FeatureLibError as e:
-            error = f"{e.__class__.__name__}: {e}"
-        except Exception:
-            # This is most likely a bug, and not an input error, so perhaps
-            # we shouldn't even catch it here.
-            error = traceback.format_exc()
+        error = compileFeatures(ufoPath, reader, ttFont, widths, revCmap, anchors)
     return ttFont, error
 
 
-def compileUFOToPath(ufoPath, ttPath, shouldCompileFeatures):
-    ttFont, error = compileUFOToFont(ufoPath, shouldCompileFeatures)
+def compileUFOFeaturesToFont(ufoPath, baseFont, widths, revCmap, anchors):
+    """Recompile the features of the source UFO into `baseFont`, which is a
+    font previously built by compileUFOToFont(). The glyph info is passed in
+    by the caller, so no .glif files need to be read. The 'cmap', 'post' and
+    'OS/2' tables are taken from `baseFont`, an 'hmtx' table is updated.
+    """
+    reader = UFOReader(ufoPath, validate=False)
+    for tableTag in featureTableTags:
+        if tableTag in baseFont:
+            del baseFont[tableTag]
+    if "hmtx" in baseFont:
+        info = SimpleNamespace()
+        reader.readInfo(info)
+        setupHorizontalMetrics(FontBuilder(font=baseFont), widths, info)
+    setPrivateGlyphInfo(baseFont, widths, anchors)
+    error = compileFeatures(ufoPath, reader, baseFont, widths, revCmap, anchors)
+    return baseFont, error
+
+
+# The tables that feature compilation may add to the font
+featureTableTags = ["GDEF", "GSUB", "GPOS", "BASE"]
+
+
+def setupHorizontalMetrics(fb, widths, info):
+    metrics = {}
+    for glyphName in fb.font.getGlyphOrder():
+        width = widths.get(glyphName)
+        if width is None:
+            if glyphName == ".notdef" and glyphName not in widths:
+                # Our generated .notdef, see ufoFont.NotDefGlyph
+                width = round(info.unitsPerEm) // 2
+            else:
+                width = 0
+        metrics[glyphName] = (min(max(otRound(width), 0), 0xFFFF), 0)
+    fb.setupHorizontalMetrics(metrics)
+    fb.setupHorizontalHeader(
+        ascent=round(getattr(info, "ascender", None) or 0),
+        descent=round(getattr(info, "descender", None) or 0),
+    )
+
+
+def setPrivateGlyphInfo(ttFont, widths, anchors):
+    ttFont["FGAx"] = newTable("FGAx")
+    ttFont["FGAx"].data = pickle.dumps(anchors)
+    ttFont["FGWd"] = newTable("FGWd")
+    ttFont["FGWd"].data = pickle.dumps(widths)
+
+
+def compileFeatures(ufoPath, reader, ttFont, widths, revCmap, anchors):
+    ufo = MinimalFontObject(ufoPath, reader, None, widths, revCmap, anchors)
+    error = None
+    feaComp = FeatureCompiler(ufo, ttFont)
+    try:
+        feaComp.compile()
+    except FeatureLibError as e:
+        error = f"{e.__class__.__name__}: {e}"
+    except Exception:
+        # This is most likely a bug, and not an input error, so perhaps
+        # we shouldn't even catch it here.
+        error = traceback.format_exc()
+    return error
+
+
+def compileUFOToPath(ufoPath, ttPath, shouldCompileFeatures, shouldAddMetrics=False):
+    # This runs in a compile worker. There can be a compile worker per CPU,
+    # so scan processes for each of them would oversubscribe the machine:
+    # use threads, which at least overlap the file reads.
+    ttFont, error = compileUFOToFont(ufoPath, shouldCompileFeatures, shouldAddMetrics, parallel="thread")
+    if error:
+        print(error, file=sys.stderr)
+    saveFont(ttFont, ttPath)
+
+
+def compileUFOFeaturesToPath(ufoPath, baseFontPath, ttPath, widths, revCmap, anchors):
+    baseFont = TTFont(io.BytesIO(readTransferData(baseFontPath)))
+    ttFont, error = compileUFOFeaturesToFont(ufoPath, baseFont, widths, revCmap, anchors)
     if error:
         print(error, file=sys.stderr)
-    ttFont.save(ttPath, reorderTables=False)
+    saveFont(ttFont, ttPath)
 
 
-_tagGLIFPattern = re.compile(rb"(<\s*(advance|anchor|unicode)\s+([^>]+)>)")
-_ufo2AnchorPattern = re.compile(
-    rb"<contour>\s+(<point\s+[^>]+move[^>]+name[^>]+>)\s+</contour>"
-)
-_unicodeAttributeGLIFPattern = re.compile(rb"hex\s*=\s*\"([0-9A-Fa-f]+)\"")
-_widthAttributeGLIFPattern = re.compile(rb"width\s*=\s*\"([0-9A-Fa-f]+)\"")
+# When parallel scanning is asked for, only glyph sets with at least this
+# many glyphs are scanned in parallel
+parallelScanThreshold = 4000
+parallelScanChunkSize = 1000
 
 
-def fetchGlyphInfo(glyphSet, ufoPath, glyphNames=None, ufo2=False):
+def fetchGlyphInfo(glyphSet, ufoPath, glyphNames=None, ufo2=False, parallel=False,
+                   useIndex=False):
+    """Return widths, cmap, revCmap and anchors for `glyphNames`, or for all
+    glyphs in `glyphSet`. See scanGlyphs() for the `parallel` and `useIndex`
+    arguments.
+    """
     # This seems about 2.3 times faster than reader.getCharacterMapping()
+    if glyphNames is None:
+        glyphNames = sorted(glyphSet.keys())
+    else:
+        glyphNames = list(glyphNames)
+    glyphInfos = scanGlyphs(glyphSet, glyphNames, ufo2=ufo2, parallel=parallel, useIndex=useIndex)
+    return mergeGlyphInfo(glyphNames, glyphInfos, ufoPath)
+
+
+def scanGlyphs(glyphSet, glyphNames, ufo2=False, parallel=False, useIndex=False):
+    """Return a list with a (width, unicodes, anchors) tuple for each glyph
+    name. `parallel` can be False, "thread" or "process": with the latter two,
+    large glyph sets are scanned by multiple threads or processes. The
+    executor is created once and reused. Only ask for "process" where it's
+    safe to start processes, and where there aren't many other processes
+    doing the same: not in the app itself, nor in its compile workers.
+    Parallel scanning is only supported for UFOs on the file system, others
+    are scanned serially.
+
+    If `useIndex` is True, the results for .glif files that didn't change
+    since a previous scan are taken from the persistent glyph info index,
+    see glyphInfoCache.py.
+    """
+    glifFiles = _getGLIFFiles(glyphSet, glyphNames)
+    if glifFiles is None:
+        return [scanGLIF(glyphSet.getGLIF(glyphName), ufo2) for glyphName in glyphNames]
+    folder, fileEntries, glyphEntries = glifFiles
+    glyphInfoCache = getGlyphInfoCache() if useIndex else None
+    if glyphInfoCache is None:
+        return scanGLIFPaths([entry.path for entry in glyphEntries], ufo2, parallel)
+
+    index = glyphInfoCache.getIndex(folder, ufo2)
+    glyphInfos = [None] * len(glyphEntries)
+    needsScan = []
+    for i, entry in enumerate(glyphEntries):
+        st = entry.stat()
+        fileStamp = (st.st_mtime_ns, st.st_size)
+        indexEntry = index.get(entry.name)
+        if indexEntry is not None and indexEntry[0] == fileStamp:
+            glyphInfos[i] = indexEntry[1]
+        else:
+            needsScan.append((i, fileStamp))
+    if needsScan:
+        paths = [glyphEntries[i].path for i, fileStamp in needsScan]
+        for (i, fileStamp), glyphInfo in zip(needsScan, scanGLIFPaths(paths, ufo2, parallel)):
+            glyphInfos[i] = glyphInfo
+            index[glyphEntries[i].name] = (fileStamp, glyphInfo)
+        # Forget about files that no longer exist
+        index = {fileName: indexEntry for fileName, indexEntry in index.items()
+                 if fileName in fileEntries}
+        try:
+            glyphInfoCache.putIndex(folder, ufo2, index)
+        except OSError as e:
+            logger = logging.getLogger(__name__)
+            logger.warning("Could not write the glyph info index: %s", e)
+    return glyphInfos
+
+
+def scanGLIFPaths(glyphPaths, ufo2=False, parallel=False):
+    """Return a list with a (width, unicodes, anchors) tuple for each .glif
+    path. See scanGlyphs() for the `parallel` argument.
+    """
+    if parallel not in (False, "thread", "process"):
+        raise ValueError(f"invalid value for parallel argument: {parallel!r}")
+    numChunks = math.ceil(len(glyphPaths) / parallelScanChunkSize)
+    if not parallel or len(glyphPaths) < parallelScanThreshold or numChunks < 2 or (os.cpu_count() or 1) < 2:
+        return scanGLIFFiles(glyphPaths, ufo2)
+
+    executor = _getScanExecutor(parallel)
+    chunks = [glyphPaths[i:i + parallelScanChunkSize]
+              for i in range(0, len(glyphPaths), parallelScanChunkSize)]
+    glyphInfos = []
+    for chunkResults in executor.map(scanGLIFFiles, chunks, itertools.repeat(ufo2)):
+        glyphInfos.extend(chunkResults)
+    return glyphInfos
+
+
+_scanExecutors = {}
+
+
+def _getScanExecutor(parallel):
+    executor = _scanExecutors.get(parallel)
+    if executor is None:
+        numWorkers = os.cpu_count() or 1
+        if parallel == "process":
+            # Processes are started on demand, and stay around for the next scan
+            executor = ProcessPoolExecutor(numWorkers, mp_context=multiprocessing.get_context("spawn"))
+        else:
+            executor = ThreadPoolExecutor(numWorkers)
+        _scanExecutors[parallel] = executor
+    return executor
+
+
+def _getGLIFFiles(glyphSet, glyphNames):
+    # Return the glyph folder, a dict with os.DirEntry objects for all files in
+    # it and a list with the os.DirEntry objects for the .glif files of
+    # glyphNames. Return None if that's not possible.
+    try:
+        folder = glyphSet.fs.getsyspath("/")
+    except Exception:
+        # NoSysPath, for example for .ufoz. Its class depends on whether
+        # fontTools uses the fs package or its own fallback.
+        return None
+    fileEntries = {entry.name: entry for entry in os.scandir(folder)}
+    glyphEntries = []
+    for glyphName in glyphNames:
+        entry = fileEntries.get(glyphSet.contents.get(glyphName))
+        if entry is None:
+            # Let glyphSet.getGLIF() raise the appropriate error
+            return None
+        glyphEntries.append(entry)
+    return folder, fileEntries, glyphEntries
+
+
+def mergeGlyphInfo(glyphNames, glyphInfos, ufoPath):
     widths = {}
     cmap = {}  # unicode: glyphName
     revCmap = {}
     anchors = {}  # glyphName: [(anchorName, x, y), ...]
     duplicateUnicodes = {}
-    if glyphNames is None:
-        glyphNames = sorted(glyphSet.keys())
-    for glyphName in glyphNames:
-        data = glyphSet.getGLIF(glyphName)
-        if b"<!--" in data:
-            # Fall back to proper parser, assuming this to be uncommon
-            # (This does not work for UFO 2)
-            width, unicodes, glyphAnchors = fetchUnicodesAndAnchors(data)
-        else:
-            # Fast route with regex
-            width = None
-            unicodes = []
-            glyphAnchors = []
-            for rawElement, tag, rawAttributes in _tagGLIFPattern.findall(data):
-                if tag == b"unicode":
-                    m = _unicodeAttributeGLIFPattern.match(rawAttributes)
-                    try:
-                        unicodes.append(int(m.group(1), 16))
-                    except ValueError:
-                        pass
-                elif tag == b"anchor":
-                    root = ET.fromstring(rawElement)
-                    glyphAnchors.append(_parseAnchorAttrs(root.attrib))
-                elif tag == b"advance":
-                    m = _widthAttributeGLIFPattern.search(rawAttributes)
-                    if m is not None:
-                        width = float(m.group(1))
-            if ufo2:
-                for rawElement in _ufo2AnchorPattern.findall(data):
-                    root = ET.fromstring(rawElement)
-                    glyphAnchors.append(_parseAnchorAttrs(root.attrib))
-
+    for glyphName, (width, unicodes, glyphAnchors) in zip(glyphNames, glyphInfos):
         widths[glyphName] = width
 
         uniqueUnicodes = []
@@ -158,60 +322,6 @@ def fetchGlyphInfo(glyphSet, ufoPath, glyphNames=None, ufo2=False):
     return widths, cmap, revCmap, anchors
 
 
-def fetchUnicodesAndAnchors(glif):
-    """
-    Get a list of unicodes listed in glif.
-    """
-    parser = FetchUnicodesAndAnchorsParser()
-    parser.parse(glif)
-    return parser.advanceWidth, parser.unicodes, parser.anchors
-
-
-def _parseNumber(s):
-    if not s:
-        return None
-    f = float(s)
-    i = int(f)
-    if i == f:
-        return i
-    return f
-
-
-def _parseAnchorAttrs(attrs):
-    return (
-        attrs.get("name"),
-        _parseNumber(attrs.get("x")),
-        _parseNumber(attrs.get("y")),
-        attrs.get("identifier"),
-    )
-
-
-class FetchUnicodesAndAnchorsParser(BaseGlifParser):
-
-    def __init__(self):
-        self.unicodes = []
-        self.anchors = []
-        self.advanceWidth = None
-        super().__init__()
-
-    def startElementHandler(self, name, attrs):
-        if self._elementStack and self._elementStack[-1] == "glyph":
-            if name == "unicode":
-                value = attrs.get("hex")
-                if value is not None:
-                    try:
-                        value = int(value, 16)
-                        if value not in self.unicodes:
-                            self.unicodes.append(value)
-                    except ValueError:
-                        pass
-            elif name == "anchor":
-                self.anchors.append(_parseAnchorAttrs(attrs))
-            elif name == "advance":
-                self.advanceWidth = _parseNumber(attrs.get("width"))
-        super().startElementHandler(name, attrs)
-
-
 class MinimalFontObject:
 
     # This class and its relatives implement a defcon-like font object, but
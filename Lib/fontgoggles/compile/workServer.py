@@ -1,46 +1,184 @@
+"""The compile worker process.
+
+Requests and responses are exchanged as length-prefixed pickled dicts, over
+stdin and (the original) stdout. Requests:
+
+    dict(type="call", id=requestID, func="module.function", args=[...])
+    dict(type="cancel", id=requestID)
+
+The worker sends dict(type="ready") once it has started up, and one
+response for each call request:
+
+    dict(type="result", id=requestID, ok=True/False, cancelled=True/False,
+         result=returnValue, stdout=text, stderr=text, error=tracebackText,
+         duration=seconds)
+
+Requests are handled in order, so a client can send several before reading
+the results. Output written by the called function is captured and returned
+in the response, other output goes to stderr.
+"""
+
+import contextlib
 import importlib
-import shlex
+import io
+import os
+import pickle
+import queue
 import signal
+import struct
 import sys
+import threading
+import time
 import traceback
 
 
-def ignoreSignal(sig, frame):
-    pass
+_headerFormat = ">I"
+headerSize = struct.calcsize(_headerFormat)
 
 
-def raiseKeyboardInterrupt(sig, frame):
-    raise KeyboardInterrupt()
+def packMessage(message):
+    data = pickle.dumps(message, pickle.HIGHEST_PROTOCOL)
+    return struct.pack(_headerFormat, len(data)) + data
 
 
-ERROR_MARKER = "---- ERROR ----"
-SUCCESS_MARKER = "---- SUCCESS ----"
+def unpackHeader(header):
+    return struct.unpack(_headerFormat, header)[0]
 
 
-def workServer():
-    signal.signal(signal.SIGINT, ignoreSignal)
+def writeMessage(f, message):
+    f.write(packMessage(message))
+    f.flush()
+
+
+def readMessage(f):
+    header = f.read(headerSize)
+    if len(header) < headerSize:
+        return None
+    size = unpackHeader(header)
+    data = f.read(size)
+    if len(data) < size:
+        return None
+    return pickle.loads(data)
+
+
+# Import these before announcing that we're ready, so the first compile
+# request doesn't pay for the imports of fontTools.feaLib, ufo2ft and varLib
+preloadModules = [
+    "fontgoggles.compile.ufoCompiler",
+    "fontgoggles.compile.dsCompiler",
+    "fontgoggles.compile.ttxCompiler",
+]
+
+
+def preload():
+    for moduleName in preloadModules:
+        try:
+            importlib.import_module(moduleName)
+        except Exception:
+            # Don't fail here, the error will be reported when the module is used
+            traceback.print_exc()
+
+
+class _RequestState:
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.cancelledIDs = set()
+        self.currentID = None
+        self.interruptible = False
+
+    def interruptHandler(self, sig, frame):
+        if self.interruptible:
+            raise KeyboardInterrupt()
+
+
+def _readRequests(protocolIn, requests, state):
+    # Runs in a thread, so we can receive cancel requests while busy
     while True:
-        input = sys.stdin.readline()
-        input = input.strip()
-        if not input:
+        message = readMessage(protocolIn)
+        if message is None:
+            requests.put(None)
             break
-        try:
+        if message["type"] == "cancel":
+            with state.lock:
+                state.cancelledIDs.add(message["id"])
+                if state.currentID == message["id"]:
+                    os.kill(os.getpid(), signal.SIGINT)
+        else:
+            requests.put(message)
+
+
+def handleRequest(message, state):
+    requestID = message["id"]
+    stdout = io.StringIO()
+    stderr = io.StringIO()
+    response = dict(type="result", id=requestID, ok=False, cancelled=False, result=None,
+                    stdout="", stderr="", error=None, duration=0)
+    with state.lock:
+        if requestID in state.cancelledIDs:
+            state.cancelledIDs.discard(requestID)
+            response["cancelled"] = True
+            return response
+        state.currentID = requestID
+    t = time.perf_counter()
+    try:
+        with contextlib.redirect_stdout(stdout), contextlib.redirect_stderr(stderr):
+            moduleName, funcName = message["func"].rsplit(".", 1)
+            module = importlib.import_module(moduleName)
+            func = getattr(module, funcName)
+            with state.lock:
+                # A cancel request that came in before we got here didn't
+                # interrupt us, so take care of it now
+                if requestID in state.cancelledIDs:
+                    raise KeyboardInterrupt()
+                state.interruptible = True
             try:
-                signal.signal(signal.SIGINT, raiseKeyboardInterrupt)
-                command, *args = shlex.split(input)
-                moduleName, funcName = command.rsplit(".", 1)
-                module = importlib.import_module(moduleName)
-                func = getattr(module, funcName)
-                func(*args)
+                result = func(*message["args"])
             finally:
-                signal.signal(signal.SIGINT, ignoreSignal)
-        except KeyboardInterrupt:
-            print(ERROR_MARKER)
-        except:
-            traceback.print_exc()
-            print(ERROR_MARKER)
-        else:
-            print(SUCCESS_MARKER)
+                state.interruptible = False
+    except KeyboardInterrupt:
+        response["cancelled"] = True
+    except BaseException:
+        response["error"] = traceback.format_exc()
+    else:
+        response["ok"] = True
+        response["result"] = result
+    response["duration"] = time.perf_counter() - t
+    with state.lock:
+        state.currentID = None
+        state.cancelledIDs.discard(requestID)
+    response["stdout"] = stdout.getvalue()
+    response["stderr"] = stderr.getvalue()
+    return response
+
+
+def workServer():
+    # Keep the original stdout for the protocol, and send anything else that
+    # gets written to it (say, by C code) to stderr
+    protocolOut = os.fdopen(os.dup(sys.stdout.fileno()), "wb")
+    os.dup2(sys.stderr.fileno(), sys.stdout.fileno())
+    protocolIn = sys.stdin.buffer
+
+    state = _RequestState()
+    signal.signal(signal.SIGINT, state.interruptHandler)
+    preload()
+    writeMessage(protocolOut, dict(type="ready"))
+
+    requests = queue.Queue()
+    reader = threading.Thread(target=_readRequests, args=(protocolIn, requests, state), daemon=True)
+    reader.start()
+    while True:
+        message = requests.get()
+        if message is None:
+            break
+        response = handleRequest(message, state)
+        try:
+            data = packMessage(response)
+        except Exception:
+            response.update(ok=False, result=None, error=traceback.format_exc())
+            data = packMessage(response)
+        protocolOut.write(data)
+        protocolOut.flush()
 
 
 if __name__ == "__main__":
@@ -1,7 +1,12 @@
+import asyncio
+import itertools
 from typing import Any, NamedTuple
 
+import numpy
 from ..misc.properties import cachedProperty
-from ..misc.hbShape import characterGlyphMapping
+from ..misc.hbShape import GlyphInfo, characterGlyphMappingArrays, mapIndices
+from ..misc.lruCache import LRUCache
+from ..misc.platform import getUseCocoa
 from . import mergeScriptsAndLanguages
 
 
@@ -14,6 +19,12 @@ class FontMetrics(NamedTuple):
 
 class BaseFont:
 
+    maxVarGlyphDrawingsSize = 64 * 1024 * 1024  # estimated bytes, for all other locations
+    maxInstanceGlyphDrawingsSize = 64 * 1024 * 1024  # estimated bytes, for prewarmed named instances
+    varLocationPrecision = 2  # decimals; locations that round the same share glyph drawings
+    prewarmChunkSize = 200  # glyphs per step of prewarmNamedInstances()
+    glyphRunCacheSize = 50000  # the maximum number of glyphs kept in the glyph run cache
+
     def __init__(self, fontPath, fontNumber, dataProvider=None):
         self.fontPath = fontPath
         self.fontNumber = fontNumber
@@ -21,8 +32,13 @@ class BaseFont:
         self.resetCache()
 
     def resetCache(self):
-        self._glyphDrawings = [{}, {}]  # cache for (outline, colorLayers) objects
-        self._currentVarLocation = None  # used to determine whether to purge the outline cache
+        self._purgeCaches()
+        self._currentVarLocation = None  # used to determine whether the location changed
+        self._varLocationKey = None  # None for the default location
+        shaper = getattr(self, "shaper", None)
+        if shaper is not None:
+            # Glyph advances or the cmap may have changed
+            shaper.clearCache()
         # Invalidate cached properties
         del self.unitsPerEm
         del self.colorPalettes
@@ -31,6 +47,7 @@ class BaseFont:
         del self.stylisticSetNames
         del self.scripts
         del self.axes
+        del self.namedInstances
 
     def close(self):
         pass
@@ -114,7 +131,30 @@ class BaseFont:
                 axisDict["hidden"] = axisDict["hidden"] and bool(axis.flags & 0x0001)
         return axes
 
+    @cachedProperty
+    def namedInstances(self):
+        """A list of (name, varLocation) tuples, one for each named instance."""
+        fvar = self.ttFont.get("fvar")
+        if fvar is None:
+            return []
+        name = self.ttFont["name"]
+        return [(name.getDebugName(instance.subfamilyNameID), dict(instance.coordinates))
+                for instance in fvar.instances]
+
     def getGlyphRunFromTextInfo(self, textInfo, colorPalettesIndex=0, **kwargs):
+        # Glyph runs are kept, so flipping back and forth between lines of a
+        # text file doesn't need to do any work
+        cacheKey = _makeGlyphRunCacheKey(textInfo, colorPalettesIndex, kwargs)
+        glyphs = None if cacheKey is None else self._glyphRuns.get(cacheKey)
+        if glyphs is None:
+            glyphs = self._getGlyphRunFromTextInfo(textInfo, colorPalettesIndex, **kwargs)
+            if cacheKey is not None:
+                self._glyphRuns[cacheKey] = glyphs
+        else:
+            self.setVarLocation(kwargs.get("varLocation"))
+        return glyphs
+
+    def _getGlyphRunFromTextInfo(self, textInfo, colorPalettesIndex=0, **kwargs):
         text = textInfo.text
         direction = textInfo.directionOverride
         script = textInfo.scriptOverride
@@ -125,8 +165,7 @@ class BaseFont:
         else:
             colorPalette = self.colorPalettes[colorPalettesIndex]
 
-        glyphs = GlyphsRun(len(text), self.unitsPerEm, direction in ("TTB", "BTT"), self.fontMetrics, colorPalette)
-
+        runs = []
         for segmentText, segmentScript, segmentBiDiLevel, firstCluster in textInfo.segments:
             if script is not None:
                 segmentScript = script
@@ -141,28 +180,51 @@ class BaseFont:
                                    script=segmentScript,
                                    language=language,
                                    **kwargs)
-            for gi in run:
-                gi.cluster += firstCluster
-            glyphs.extend(run)
-
-        x = y = 0
-        for gi in glyphs:
-            gi.pos = x + gi.dx, y + gi.dy
-            x += gi.ax
-            y += gi.ay
-        glyphs.endPos = (x, y)
-        return glyphs
+            runs.append((run, firstCluster))
+
+        return GlyphsRun.fromRuns(runs, len(text), self.unitsPerEm, direction in ("TTB", "BTT"),
+                                  self.fontMetrics, colorPalette)
 
     def getGlyphRun(self, text, *, features=None, varLocation=None,
                     direction=None, language=None, script=None,
                     colorLayers=False):
         self.setVarLocation(varLocation)
-        glyphInfo = self.shaper.shape(text, features=features, varLocation=varLocation,
-                                      direction=direction, language=language, script=script)
-        glyphNames = (gi.name for gi in glyphInfo)
-        for glyph, glyphDrawing in zip(glyphInfo, self.getGlyphDrawings(glyphNames, colorLayers)):
-            glyph.glyphDrawing = glyphDrawing
-        return glyphInfo
+        shapeResult = self.shaper.shapeToArrays(
+            text, features=features, varLocation=varLocation,
+            direction=direction, language=language, script=script)
+        return self._makeGlyphRun(text, shapeResult, direction, colorLayers)
+
+    def getGlyphRuns(self, texts, **kwargs):
+        """Shape many strings with the same settings. Returns a list of
+        GlyphsRun objects, see iterGlyphRuns().
+        """
+        return list(self.iterGlyphRuns(texts, **kwargs))
+
+    def iterGlyphRuns(self, texts, *, features=None, varLocation=None,
+                      direction=None, language=None, script=None,
+                      colorLayers=False):
+        """Shape each string in `texts` with the same settings, and yield
+        a GlyphsRun for each, as getGlyphRun() would return. The per-call
+        setup is only done once, which makes this suitable for shaping
+        large amounts of text.
+        """
+        self.setVarLocation(varLocation)
+        texts, textsToShape = itertools.tee(texts)
+        shapeResults = self.shaper.shapeMany(
+            textsToShape, features=features, varLocation=varLocation,
+            direction=direction, language=language, script=script)
+        for text, shapeResult in zip(texts, shapeResults):
+            yield self._makeGlyphRun(text, shapeResult, direction, colorLayers)
+
+    def _makeGlyphRun(self, text, shapeResult, direction, colorLayers):
+        gids, clusters, positions = shapeResult
+        glyphOrder = self.shaper.glyphOrder
+        glyphNames = [glyphOrder[gid] for gid in gids.tolist()]
+        glyphDrawings = list(self.getGlyphDrawings(glyphNames, colorLayers))
+        return GlyphsRun(len(text), self.unitsPerEm, direction in ("TTB", "BTT"),
+                         gids=gids, glyphNames=glyphNames, clusters=clusters,
+                         offsets=positions[:, :2], advances=positions[:, 2:],
+                         glyphDrawings=glyphDrawings)
 
     def setVarLocation(self, varLocation):
         axes = self.axes
@@ -170,20 +232,94 @@ class BaseFont:
             # subset to our own axes
             varLocation = {k: v for k, v in varLocation.items() if k in axes}
         if self._currentVarLocation != varLocation:
-            self._purgeCaches()
             self._currentVarLocation = varLocation
+            self._varLocationKey = self._getVarLocationKey(varLocation)
             self.varLocationChanged(varLocation)
 
+    def _getVarLocationKey(self, varLocation):
+        # Glyph drawings are cached per location, to make going back and
+        # forth between locations cheap. The key is None for the default
+        # location, else the location rounded to varLocationPrecision, so
+        # tiny slider movements don't fill the cache with near duplicates.
+        axes = self.axes
+        locationKey = []
+        for axisTag, value in sorted((varLocation or {}).items()):
+            value = round(value, self.varLocationPrecision)
+            if value != round(axes[axisTag]["defaultValue"], self.varLocationPrecision):
+                locationKey.append((axisTag, value))
+        return tuple(locationKey) or None
+
     def getGlyphDrawings(self, glyphNames, colorLayers=False):
         for glyphName in glyphNames:
-            glyphDrawing = self._glyphDrawings[colorLayers].get(glyphName)
+            cache, key = self._getGlyphDrawingCacheAndKey(glyphName, colorLayers)
+            glyphDrawing = cache.get(key)
             if glyphDrawing is None:
                 glyphDrawing = self._getGlyphDrawing(glyphName, colorLayers)
-                self._glyphDrawings[colorLayers][glyphName] = glyphDrawing
+                cache[key] = glyphDrawing
             yield glyphDrawing
 
+    def _getGlyphDrawingCacheAndKey(self, glyphName, colorLayers):
+        if self._varLocationKey is None:
+            return self._glyphDrawings[colorLayers], glyphName
+        key = (glyphName, self._varLocationKey, colorLayers)
+        if self._varLocationKey in self._instanceLocationKeys:
+            return self._instanceGlyphDrawings, key
+        return self._varGlyphDrawings, key
+
+    async def prewarmNamedInstances(self, glyphNames=None, colorLayers=False):
+        """Compute the glyph drawings (and their bounds) for `glyphNames`
+        at each of the named instances, and keep them, so switching to a
+        named instance is a cache lookup. `glyphNames` defaults to all glyphs.
+
+        This is meant to run as a background task: it yields to the event
+        loop after every `prewarmChunkSize` glyphs, leaving the current
+        location untouched in between. The names of the instances that are
+        done are added to the `warmNamedInstances` set. Drawings at the
+        default location go into the regular cache. The instance drawings
+        are kept in a cache of their own, limited to
+        `maxInstanceGlyphDrawingsSize`; prewarming stops once it is full.
+        """
+        if glyphNames is None:
+            glyphNames = self.shaper.glyphOrder
+        instanceGlyphDrawings = self._instanceGlyphDrawings
+        for instanceName, varLocation in self.namedInstances:
+            if instanceName in self.warmNamedInstances:
+                continue
+            for chunkStart in range(0, len(glyphNames), self.prewarmChunkSize):
+                if self._instanceGlyphDrawings is not instanceGlyphDrawings:
+                    return  # the caches were reset, we're out of date
+                if instanceGlyphDrawings.size >= instanceGlyphDrawings.maxSize:
+                    return  # don't evict what we just computed
+                currentVarLocation = self._currentVarLocation
+                self.setVarLocation(varLocation)
+                if self._varLocationKey is not None:
+                    self._instanceLocationKeys.add(self._varLocationKey)
+                try:
+                    glyphDrawings = self.getGlyphDrawings(
+                        glyphNames[chunkStart:chunkStart + self.prewarmChunkSize], colorLayers)
+                    for glyphDrawing in glyphDrawings:
+                        if getUseCocoa():
+                            glyphDrawing.bounds
+                finally:
+                    self.setVarLocation(currentVarLocation or {})
+                await asyncio.sleep(0)
+            self.warmNamedInstances.add(instanceName)
+
     def _purgeCaches(self):
+        # Caches for (outline, colorLayers) objects. The drawings for the
+        # default location are all kept, and apart from the others, so
+        # exploring the design space doesn't evict them. For the other
+        # locations, the most recently used ones are kept.
         self._glyphDrawings = [{}, {}]
+        self._varGlyphDrawings = LRUCache(self.maxVarGlyphDrawingsSize,
+                                          sizeFunc=lambda glyphDrawing: glyphDrawing.memorySize)
+        # Drawings at prewarmed named instances, with a budget of their own,
+        # so exploring the design space doesn't evict them either
+        self._instanceGlyphDrawings = LRUCache(self.maxInstanceGlyphDrawingsSize,
+                                               sizeFunc=lambda glyphDrawing: glyphDrawing.memorySize)
+        self._instanceLocationKeys = set()
+        self.warmNamedInstances = set()
+        self._glyphRuns = LRUCache(self.glyphRunCacheSize, sizeFunc=len)
 
     def _getGlyphDrawing(self, glyphName, colorLayers):
         raise NotImplementedError()
@@ -192,34 +328,103 @@ class BaseFont:
         self.shaper.setVarLocation(varLocation)
 
 
-class GlyphsRun(list):
+def _makeGlyphRunCacheKey(textInfo, colorPalettesIndex, kwargs):
+    cacheKey = (textInfo.text, textInfo.shouldApplyBiDi, textInfo.directionOverride,
+                textInfo.scriptOverride, textInfo.languageOverride, colorPalettesIndex,
+                tuple(sorted((key, tuple(sorted(value.items())) if isinstance(value, dict) else value)
+                             for key, value in kwargs.items())))
+    try:
+        hash(cacheKey)
+    except TypeError:
+        return None  # unhashable argument values, don't cache
+    return cacheKey
+
+
+class GlyphsRun:
+
+    """A run of shaped glyphs, stored as arrays: `gids` and `clusters`
+    contain one item per glyph, `offsets` (dx, dy), `advances` (ax, ay) and
+    `positions` are (n, 2) arrays. Indexing or iterating creates GlyphInfo
+    objects on demand. These are kept, so attributes that clients add (for
+    example `bounds`) persist.
+    """
 
-    def __init__(self, numChars, unitsPerEm, vertical, fontMetrics=None, colorPalette=None):
+    def __init__(self, numChars, unitsPerEm, vertical, fontMetrics=None, colorPalette=None, *,
+                 gids=None, glyphNames=None, clusters=None, offsets=None, advances=None,
+                 glyphDrawings=None):
         self.numChars = numChars
         self.unitsPerEm = unitsPerEm
         self.vertical = vertical
         self.fontMetrics = fontMetrics
         self._glyphToChars = None
         self._charToGlyphs = None
-        self.endPos = (0, 0)
         self.colorPalette = [] if colorPalette is None else colorPalette
 
+        self.gids = numpy.zeros(0, numpy.int32) if gids is None else gids
+        self.glyphNames = [] if glyphNames is None else glyphNames
+        self.clusters = numpy.zeros(0, numpy.int32) if clusters is None else clusters
+        self.offsets = numpy.zeros((0, 2), numpy.int32) if offsets is None else offsets
+        self.advances = numpy.zeros((0, 2), numpy.int32) if advances is None else advances
+        self.glyphDrawings = [None] * len(self.gids) if glyphDrawings is None else glyphDrawings
+        assert len(self.gids) == len(self.glyphNames) == len(self.clusters)
+        assert len(self.gids) == len(self.offsets) == len(self.advances) == len(self.glyphDrawings)
+
+        origins = numpy.cumsum(self.advances, axis=0)
+        if len(origins):
+            self.endPos = tuple(origins[-1].tolist())
+        else:
+            self.endPos = (0, 0)
+        self.positions = origins - self.advances + self.offsets
+        self._glyphInfos = [None] * len(self.gids)
+
+    @classmethod
+    def fromRuns(cls, runs, numChars, unitsPerEm, vertical, fontMetrics=None, colorPalette=None):
+        """Concatenate `runs`, a list of (run, firstCluster) tuples, into a
+        single GlyphsRun. The clusters of each run are offset by firstCluster.
+        """
+        if not runs:
+            return cls(numChars, unitsPerEm, vertical, fontMetrics, colorPalette)
+        clusters = [run.clusters + firstCluster for run, firstCluster in runs]
+        return cls(numChars, unitsPerEm, vertical, fontMetrics, colorPalette,
+                   gids=numpy.concatenate([run.gids for run, _ in runs]),
+                   glyphNames=[glyphName for run, _ in runs for glyphName in run.glyphNames],
+                   clusters=numpy.concatenate(clusters),
+                   offsets=numpy.concatenate([run.offsets for run, _ in runs]),
+                   advances=numpy.concatenate([run.advances for run, _ in runs]),
+                   glyphDrawings=[drawing for run, _ in runs for drawing in run.glyphDrawings])
+
+    def __len__(self):
+        return len(self._glyphInfos)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(len(self)))]
+        glyphInfo = self._glyphInfos[index]
+        if glyphInfo is None:
+            if index < 0:
+                index += len(self)
+            dx, dy = self.offsets[index].tolist()
+            ax, ay = self.advances[index].tolist()
+            glyphInfo = GlyphInfo(int(self.gids[index]), self.glyphNames[index],
+                                  int(self.clusters[index]), dx, dy, ax, ay)
+            glyphInfo.pos = tuple(self.positions[index].tolist())
+            glyphInfo.glyphDrawing = self.glyphDrawings[index]
+            self._glyphInfos[index] = glyphInfo
+        return glyphInfo
+
+    def __iter__(self):
+        for index in range(len(self)):
+            yield self[index]
+
     def mapGlyphsToChars(self, glyphIndices):
         if self._glyphToChars is None:
             self._calcMappings()
-        glyphToChars = self._glyphToChars
-        return {ci for gi in glyphIndices for ci in glyphToChars[gi]}
+        return set(mapIndices(self._glyphToChars, glyphIndices).tolist())
 
     def mapCharsToGlyphs(self, charIndices):
         if self._charToGlyphs is None:
             self._calcMappings()
-        charToGlyphs = self._charToGlyphs
-        return {gi for ci in charIndices for gi in charToGlyphs[ci]}
+        return set(mapIndices(self._charToGlyphs, charIndices).tolist())
 
     def _calcMappings(self):
-        clusters = [glyphInfo.cluster for glyphInfo in self]
-        self._glyphToChars, self._charToGlyphs = characterGlyphMapping(clusters, self.numChars)
-
-    @cachedProperty
-    def glyphNames(self):
-        return [glyphInfo.name for glyphInfo in self]
+        self._glyphToChars, self._charToGlyphs = characterGlyphMappingArrays(self.clusters, self.numChars)
@@ -7,7 +7,6 @@ import pathlib
 import pickle
 import re
 import sys
-import tempfile
 from types import SimpleNamespace
 import numpy
 from fontTools.pens.basePen import BasePen
@@ -22,6 +21,7 @@ from .glyphDrawing import EmptyDrawing, GlyphDrawing
 from .ufoFont import Glyph, NotDefGlyph, UFOState, extractIncludedFeatureFiles
 from ..compile.compilerPool import compileUFOToPath, compileDSToBytes, CompilerError
 from ..compile.dsCompiler import getTTPaths
+from ..compile.transport import TransferFolder, readTransferData, writeTransferData
 from ..misc.hbShape import HBShape
 from ..misc.properties import cachedProperty
 from ..misc.platform import platform
@@ -33,10 +33,15 @@ class DesignSpaceSourceError(CompilerError):
 
 class DSFont(BaseFont):
 
+    # Build an 'HVAR' table, so HarfBuzz can resolve the advances at any
+    # location by itself, instead of asking us to interpolate the glyphs.
+    useNativeAdvances = True
+
     def __init__(self, fontPath, fontNumber, dataProvider=None):
         super().__init__(fontPath, fontNumber)
         self.doc = None
         self._varGlyphs = {}
+        self._interpolator = VarGlyphInterpolator()
         self._normalizedLocation = {}
         self._sourceFontData = {}
         self._ufos = {}
@@ -45,6 +50,7 @@ class DSFont(BaseFont):
     def resetCache(self):
         super().resetCache()
         self._varGlyphs = {}
+        self._interpolator = VarGlyphInterpolator()
         del self.defaultInfo
         del self.defaultVerticalAdvance
         del self.defaultVerticalOriginY
@@ -54,7 +60,7 @@ class DSFont(BaseFont):
             docs = list(splitVariableFonts(DesignSpaceDocument.fromfile(self.fontPath)))
             self.nameInCollection, self.doc = docs[self.fontNumber]
 
-        with tempfile.TemporaryDirectory(prefix="fontgoggles_temp") as ttFolder:
+        with TransferFolder() as ttFolder:
             sourcePathToTTPath = getTTPaths(self.doc, ttFolder)
             ufosToCompile = []
             ttPaths = []
@@ -108,8 +114,7 @@ class DSFont(BaseFont):
                     continue
                 ttPath = sourcePathToTTPath[source.path]
                 if source.path in previousSourceData:
-                    with open(ttPath, "wb") as f:
-                        f.write(previousSourceData[source.path])
+                    writeTransferData(ttPath, previousSourceData[source.path])
                     self._sourceFontData[source.path] = previousSourceData[source.path]
                 else:
                     ufosToCompile.append(source.path)
@@ -127,7 +132,8 @@ class DSFont(BaseFont):
             )
 
             coros = [
-                compileUFOToPath(sourcePath, ttPath, not optimizeFeatureCompilation, output.write)
+                compileUFOToPath(sourcePath, ttPath, not optimizeFeatureCompilation, output.write,
+                                 shouldAddMetrics=self.useNativeAdvances)
                 for sourcePath, ttPath in compileJobs
             ]
 
@@ -151,15 +157,15 @@ class DSFont(BaseFont):
             for sourcePath, ttPath in zip(ufosToCompile, ttPaths):
                 # Store compiled tt data so we can reuse it to rebuild ourselves
                 # without recompiling the source.
-                with open(ttPath, "rb") as f:
-                    self._sourceFontData[sourcePath] = f.read()
+                self._sourceFontData[sourcePath] = readTransferData(ttPath)
 
             if not ufosToCompile and not self._needsVFRebuild:
                 # self.ttFont and self.shaper are still up-to-date
                 return
 
             vfFontData = await compileDSToBytes(
-                self.fontPath, self.fontNumber, ttFolder, optimizeFeatureCompilation, outputWriter
+                self.fontPath, self.fontNumber, ttFolder, optimizeFeatureCompilation, outputWriter,
+                shouldAddMetrics=self.useNativeAdvances,
             )
 
         f = io.BytesIO(vfFontData)
@@ -168,8 +174,12 @@ class DSFont(BaseFont):
         self.masterModel = pickle.loads(self.ttFont["MPcl"].data)
         assert len(self.masterModel.deltaWeights) == len(self.doc.sources)
 
+        if "HVAR" in self.ttFont:
+            getHorizontalAdvance = None
+        else:
+            getHorizontalAdvance = self._getHorizontalAdvance
         self.shaper = HBShape(vfFontData,
-                              getHorizontalAdvance=self._getHorizontalAdvance,
+                              getHorizontalAdvance=getHorizontalAdvance,
                               getVerticalAdvance=self._getVerticalAdvance,
                               getVerticalOrigin=self._getVerticalOrigin,
                               ttFont=self.ttFont)
@@ -203,6 +213,12 @@ class DSFont(BaseFont):
                     invalidateCaches = True
                 if needsGlyphUpdate or needsInfoUpdate:
                     invalidateCaches = True
+                if needsGlyphUpdate and self._advancesChanged(sourceKey):
+                    # The 'hmtx' and 'HVAR' tables need to be rebuilt
+                    if sourceLayerName is None:
+                        self._sourceFontData.pop(sourcePath, None)  # implies self._needsVFRebuild
+                    else:
+                        self._needsVFRebuild = True
                 if needsCmapUpdate:
                     # TODO: This could be done more efficiently like how UFOFont
                     # does it, if the changed source is the default source.
@@ -213,6 +229,18 @@ class DSFont(BaseFont):
             self.resetCache()
         return True
 
+    def _advancesChanged(self, sourceKey):
+        if not self.useNativeAdvances:
+            return False
+        sourcePath, sourceLayerName = sourceKey
+        changedWidths = self._ufos[sourceKey].changedWidths
+        sourceData = self._sourceFontData.get(sourcePath)
+        if sourceLayerName is not None or sourceData is None:
+            return bool(changedWidths)
+        ttFont = TTFont(io.BytesIO(sourceData), lazy=True)
+        widths = pickle.loads(ttFont["FGWd"].data)
+        return any(widths.get(glyphName) != width for glyphName, width in changedWidths.items())
+
     @cachedProperty
     def defaultInfo(self):
         info = SimpleNamespace()
@@ -241,6 +269,21 @@ class DSFont(BaseFont):
         else:
             return ascender
 
+    @cachedProperty
+    def namedInstances(self):
+        # The instances from the designspace document, which may include
+        # some that didn't make it into the 'fvar' table
+        axisTags = {axis.name: axis.tag for axis in self.doc.axes}
+        namedInstances = []
+        for instance in self.doc.instances:
+            varLocation = {axisTags[axisName]: value
+                           for axisName, value in instance.getFullUserLocation(self.doc).items()}
+            name = instance.styleName or instance.name
+            if name is None:
+                name = ", ".join(f"{axisTag}={value:g}" for axisTag, value in varLocation.items())
+            namedInstances.append((name, varLocation))
+        return namedInstances
+
     def varLocationChanged(self, varLocation):
         super().varLocationChanged(varLocation)
         self._normalizedLocation = normalizeLocation(self.doc, varLocation or {})
@@ -307,7 +350,7 @@ class DSFont(BaseFont):
             varGlyph = NotDefGlyph(self.unitsPerEm)
         else:
             varGlyph = VarGlyph(glyphName, self.masterModel, masterPoints, contours, tags,
-                                components, getSubGlyph)
+                                components, getSubGlyph, self._interpolator)
         return varGlyph
 
     def _getHorizontalAdvance(self, glyphName):
@@ -323,6 +366,21 @@ class DSFont(BaseFont):
         vOrgX, vOrgY = varGlyph.verticalOrigin
         return True, vOrgX, vOrgY
 
+    def getGlyphDrawings(self, glyphNames, colorLayers=False):
+        glyphNames = list(glyphNames)
+        # Interpolate the points of the glyphs we don't have a drawing for
+        # yet in a single pass
+        interpolatorKeys = []
+        for glyphName in glyphNames:
+            cache, key = self._getGlyphDrawingCacheAndKey(glyphName, colorLayers)
+            if key not in cache:
+                varGlyph = self._getVarGlyph(glyphName)
+                if isinstance(varGlyph, VarGlyph):
+                    interpolatorKeys.extend(varGlyph.iterInterpolatorKeys())
+        if interpolatorKeys:
+            self._interpolator.interpolate(interpolatorKeys, self._normalizedLocation)
+        return super().getGlyphDrawings(glyphNames, colorLayers)
+
     def _getGlyphDrawing(self, glyphName, colorLayers):
         try:
             varGlyph = self._getVarGlyph(glyphName)
@@ -375,9 +433,106 @@ def interpolateFromDeltas(model, varLocation, deltas):
 NUMPY_IN_PLACE = True  # dubious improvement
 
 
+class VarGlyphInterpolator:
+
+    """Interpolates the points of many glyphs at once. The deltas of all
+    glyphs that share a variation model are stored in a single matrix, with
+    one row per master support and the flattened points of the glyphs
+    side by side. The points of a batch of glyphs at a location are one
+    `scalars @ deltas[:, columns]` product, and the scalars are only
+    computed once per location.
+    """
+
+    def __init__(self):
+        self._groups = {}
+
+    def addDeltas(self, model, deltas):
+        """Add the deltas for a glyph, return a key for getPoints()."""
+        group = self._groups.get(model)
+        if group is None:
+            group = self._groups[model] = _DeltaGroup(model)
+        return group, group.addDeltas(deltas)
+
+    def interpolate(self, keys, varLocation):
+        """Compute the points of the glyphs with `keys` at the normalized
+        location `varLocation`, in one pass per variation model. The points
+        are kept until the location changes.
+        """
+        glyphIndices = defaultdict(list)
+        for group, glyphIndex in keys:
+            glyphIndices[group].append(glyphIndex)
+        for group, indices in glyphIndices.items():
+            group.interpolate(indices, varLocation)
+
+    def getPoints(self, key, varLocation):
+        """Return the interpolated points for the glyph with `key` at
+        the normalized location `varLocation`.
+        """
+        group, glyphIndex = key
+        return group.getPoints(glyphIndex, varLocation)
+
+
+class _DeltaGroup:
+
+    minCapacity = 256  # columns
+
+    def __init__(self, model):
+        self.model = model
+        self._offsets = [0]  # start index of each glyph in the flattened points
+        self._deltas = None  # (numSupports, capacity), grown as glyphs are added
+        self._varLocation = None
+        self._scalars = None
+        self._points = {}  # glyph index: points at _varLocation
+
+    def addDeltas(self, deltas):
+        numSupports = len(self.model.supports)
+        numPoints = len(deltas[0])
+        start = self._offsets[-1] * 2
+        end = start + numPoints * 2
+        capacity = 0 if self._deltas is None else self._deltas.shape[1]
+        if end > capacity:
+            newDeltas = numpy.zeros((numSupports, max(end, 2 * capacity, self.minCapacity)), coordinateType)
+            if self._deltas is not None:
+                newDeltas[:, :start] = self._deltas[:, :start]
+            self._deltas = newDeltas
+        # A non-interpolatable glyph only has a delta for the default master,
+        # its other deltas stay zero
+        for supportIndex, delta in enumerate(deltas):
+            self._deltas[supportIndex, start:end] = numpy.reshape(delta, -1)
+        self._offsets.append(self._offsets[-1] + numPoints)
+        return len(self._offsets) - 2
+
+    def interpolate(self, glyphIndices, varLocation):
+        if self._varLocation != varLocation:
+            self._varLocation = dict(varLocation)
+            self._scalars = numpy.array(self.model.getScalars(varLocation), coordinateType)
+            self._points = {}
+        glyphIndices = sorted({glyphIndex for glyphIndex in glyphIndices if glyphIndex not in self._points})
+        if not glyphIndices:
+            return
+        offsets = self._offsets
+        starts = numpy.array([offsets[glyphIndex] * 2 for glyphIndex in glyphIndices], numpy.intp)
+        counts = numpy.array([(offsets[glyphIndex + 1] - offsets[glyphIndex]) * 2 for glyphIndex in glyphIndices],
+                             numpy.intp)
+        # The columns of the requested glyphs, side by side
+        ends = numpy.cumsum(counts)
+        columns = numpy.repeat(starts - (ends - counts), counts) + numpy.arange(ends[-1], dtype=numpy.intp)
+        points = (self._scalars @ self._deltas[:, columns]).reshape(-1, 2)
+        pointEnds = (ends // 2).tolist()
+        pointStart = 0
+        for glyphIndex, pointEnd in zip(glyphIndices, pointEnds):
+            self._points[glyphIndex] = points[pointStart:pointEnd]
+            pointStart = pointEnd
+
+    def getPoints(self, glyphIndex, varLocation):
+        self.interpolate([glyphIndex], varLocation)
+        return self._points[glyphIndex]
+
+
 class VarGlyph:
 
-    def __init__(self, glyphName, masterModel, masterPoints, contours, tags, components, getSubGlyph):
+    def __init__(self, glyphName, masterModel, masterPoints, contours, tags, components, getSubGlyph,
+                 interpolator=None):
         self.model, masterPoints = masterModel.getSubModel(masterPoints)
         masterPoints = [numpy.array(pts, coordinateType) for pts in masterPoints]
         try:
@@ -386,6 +541,10 @@ class VarGlyph:
             # outlines are not compatible, fall back to the default master
             print(f"Glyph '{glyphName}' is not interpolatable", file=sys.stderr)
             self.deltas = [masterPoints[self.model.reverseMapping[0]]]
+        self._interpolator = interpolator
+        if interpolator is not None:
+            self._interpolatorKey = interpolator.addDeltas(self.model, self.deltas)
+            self.deltas = None  # The interpolator has them
         if components:
             self._contours = None
             self._tags = None
@@ -432,9 +591,22 @@ class VarGlyph:
             self._tags = numpy.concatenate(allTags)
         return self._tags
 
+    def iterInterpolatorKeys(self):
+        """Yield the interpolator keys of this glyph and of its components,
+        see VarGlyphInterpolator.interpolate().
+        """
+        if self._interpolator is not None:
+            yield self._interpolatorKey
+        for glyphName, transformation in self.components or ():
+            subGlyph = self._getSubGlyph(glyphName)
+            if isinstance(subGlyph, VarGlyph):
+                yield from subGlyph.iterInterpolatorKeys()
+
     def getPoints(self):
         if self._points is None:
-            if NUMPY_IN_PLACE:
+            if self._interpolator is not None:
+                self._points = self._interpolator.getPoints(self._interpolatorKey, self.varLocation)
+            elif NUMPY_IN_PLACE:
                 self._points = interpolateFromDeltas(self.model, self.varLocation, self.deltas)
             else:
                 self._points = self.model.interpolateFromDeltas(self.varLocation, self.deltas)
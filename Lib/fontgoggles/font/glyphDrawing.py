@@ -3,9 +3,15 @@ from ..misc.platform import platform
 from ..misc.properties import cachedProperty
 
 
+# Rough memory footprint estimates, for bounding the glyph drawing caches
+drawingOverhead = 200  # bytes
+pathElementSize = 48  # bytes
+
+
 class EmptyDrawing:
 
     bounds = None
+    memorySize = drawingOverhead
 
     def draw(self, colorPalette, defaultColor):
         pass
@@ -19,6 +25,10 @@ class GlyphDrawing:
     def __init__(self, path):
         self.path = path
 
+    @cachedProperty
+    def memorySize(self):
+        return drawingOverhead + pathElementSize * platform.pathElementCount(self.path)
+
     @cachedProperty
     def bounds(self):
         bounds = None
@@ -39,6 +49,11 @@ class GlyphLayersDrawing:
     def __init__(self, layers=None):
         self.layers = layers
 
+    @cachedProperty
+    def memorySize(self):
+        return drawingOverhead + sum(pathElementSize * platform.pathElementCount(path)
+                                     for path, colorID in self.layers)
+
     @cachedProperty
     def bounds(self):
         bounds = None
@@ -67,6 +82,9 @@ class GlyphLayersDrawing:
 
 
 class GlyphCOLRv1Drawing:
+
+    memorySize = drawingOverhead  # drawn on the fly, nothing to hold on to
+
     def __init__(self, glyphName, colorFont):
         self.glyphName = glyphName
         self.colorFont = colorFont
@@ -18,9 +18,10 @@ from fontTools.ufoLib.glifLib import Glyph as GLIFGlyph, CONTENTS_FILENAME
 from ufo2ft.constants import COLOR_LAYER_MAPPING_KEY, COLOR_PALETTES_KEY
 from .baseFont import BaseFont
 from .glyphDrawing import GlyphDrawing, GlyphLayersDrawing
-from ..compile.compilerPool import compileUFOToBytes
+from ..compile.compilerPool import compileUFOFeaturesToBytes, compileUFOToBytes
 from ..compile.ufoCompiler import fetchGlyphInfo
 from ..misc.hbShape import HBShape
+from ..misc.lruCache import LRUCache
 from ..misc.properties import cachedProperty
 from ..misc.platform import platform
 
@@ -28,6 +29,11 @@ from ..misc.platform import platform
 class UFOFont(BaseFont):
 
     ufoState = None
+    _needsFeaturesUpdate = False
+    maxCachedGlyphs = 2000
+    # Let the compiler add an 'hmtx' table, so HarfBuzz can look up the
+    # advances itself. We fall back to callbacks when glyph widths change.
+    useNativeAdvances = True
 
     def resetCache(self):
         super().resetCache()
@@ -43,24 +49,45 @@ class UFOFont(BaseFont):
 
     async def load(self, outputWriter):
         if hasattr(self, "reader"):
-            self._cachedGlyphs = {}
+            self._cachedGlyphs.clear()
+            if self._needsFeaturesUpdate:
+                await self._updateFeatures(outputWriter)
             return
         self._setupReaderAndGlyphSet()
         self.info = SimpleNamespace()
         self.reader.readInfo(self.info)
         self.lib = self.reader.readLib()
-        self._cachedGlyphs = {}
+        self._cachedGlyphs = LRUCache(self.maxCachedGlyphs)
         if self.ufoState is None:
             includedFeatureFiles = extractIncludedFeatureFiles(self.fontPath, self.reader)
             self.ufoState = UFOState(self.reader, self.glyphSet,
                                      getUnicodesAndAnchors=self._getUnicodesAndAnchors,
                                      includedFeatureFiles=includedFeatureFiles)
 
-        fontData = await compileUFOToBytes(self.fontPath, True, outputWriter)
+        fontData = await compileUFOToBytes(self.fontPath, True, outputWriter,
+                                           shouldAddMetrics=self.useNativeAdvances)
 
         f = io.BytesIO(fontData)
         self.ttFont = TTFont(f, lazy=True)
+        self._hasNativeAdvances = "hmtx" in self.ttFont
         self.shaper = self._getShaper(fontData)
+        # The advance widths as collected by the compiler, updated upon changes
+        self._glyphWidths = pickle.loads(self.ttFont["FGWd"].data)
+
+    async def _updateFeatures(self, outputWriter):
+        # Only recompile the features, reusing the rest of the current font
+        # and the glyph info tracked by self.ufoState
+        self._needsFeaturesUpdate = False
+        self.ufoState.includedFeatureFiles = extractIncludedFeatureFiles(self.fontPath, self.reader)
+        f = io.BytesIO()
+        self.ttFont.save(f, reorderTables=False)
+        fontData = await compileUFOFeaturesToBytes(self.fontPath, f.getvalue(), self._glyphWidths,
+                                                   self.ufoState.unicodes, self.ufoState.anchors,
+                                                   outputWriter)
+        self.ttFont = TTFont(io.BytesIO(fontData), lazy=True)
+        self._hasNativeAdvances = "hmtx" in self.ttFont  # The compiler updated it
+        self.shaper = self._getShaper(fontData)
+        self.resetCache()
 
     def updateFontPath(self, newFontPath):
         """This gets called when the source file was moved."""
@@ -77,27 +104,44 @@ class UFOFont(BaseFont):
 
         if externalFilePath:
             # Features need to be recompiled no matter what
-            return False
+            if not self._canUpdateFeatures():
+                return False
+            self._needsFeaturesUpdate = True
+            return True
 
         self.glyphSet.rebuildContents()
 
         self.ufoState = self.ufoState.newState()
         (needsFeaturesUpdate, needsGlyphUpdate, needsInfoUpdate,
          needsCmapUpdate, needsLibUpdate) = self.ufoState.getUpdateInfo()
+        changedWidths = self.ufoState.changedWidths
+        needsAdvancesUpdate = (self._hasNativeAdvances and
+                               any(self._glyphWidths.get(glyphName) != width
+                                   for glyphName, width in changedWidths.items()))
+        self._glyphWidths.update(changedWidths)
 
         if needsFeaturesUpdate:
-            return False
+            if not self._canUpdateFeatures():
+                return False
+            # The features will be recompiled by self.load()
+            self._needsFeaturesUpdate = True
 
         if needsInfoUpdate:
             # font.info changed, all we care about is a possibly change unitsPerEm
             self.info = SimpleNamespace()
             self.reader.readInfo(self.info)
 
+        if needsAdvancesUpdate:
+            # The 'hmtx' table is outdated, use callbacks for the advances
+            self._hasNativeAdvances = False
+
         if needsCmapUpdate:
             # The cmap changed. Let's update it in-place and only rebuild the shaper
             newCmap = {code: gn for gn, codes in self.ufoState.unicodes.items() for code in codes}
             fb = FontBuilder(font=self.ttFont)
             fb.setupCharacterMap(newCmap)
+
+        if needsCmapUpdate or needsAdvancesUpdate:
             f = io.BytesIO()
             self.ttFont.save(f, reorderTables=False)
             self.shaper = self._getShaper(f.getvalue())
@@ -111,6 +155,13 @@ class UFOFont(BaseFont):
 
         return True
 
+    def _canUpdateFeatures(self):
+        # The features can be recompiled separately if the glyph set didn't
+        # change, as the glyph order of the current font must stay valid.
+        glyphNames = set(self.glyphSet.keys())
+        glyphNames.add(".notdef")
+        return glyphNames == set(self.ttFont.getGlyphOrder())
+
     def _getUnicodesAndAnchors(self):
         unicodes = defaultdict(list)
         for code, gn in self.ttFont.getBestCmap().items():
@@ -119,8 +170,9 @@ class UFOFont(BaseFont):
         return unicodes, anchors
 
     def _getShaper(self, fontData):
+        getHorizontalAdvance = None if self._hasNativeAdvances else self._getHorizontalAdvance
         return HBShape(fontData,
-                       getHorizontalAdvance=self._getHorizontalAdvance,
+                       getHorizontalAdvance=getHorizontalAdvance,
                        getVerticalAdvance=self._getVerticalAdvance,
                        getVerticalOrigin=self._getVerticalOrigin,
                        ttFont=self.ttFont)
@@ -129,35 +181,53 @@ class UFOFont(BaseFont):
     def unitsPerEm(self):
         return self.info.unitsPerEm
 
-    def _getGlyph(self, glyphName, layerName=None):
-        glyph = self._cachedGlyphs.get((layerName, glyphName))
+    def _getGlyph(self, glyphName, layerName=None, needsOutline=True):
+        # The .glif data is parsed on demand, the outline is only drawn when
+        # it is needed. Only the most recently used glyphs are kept.
+        cacheKey = (layerName, glyphName)
+        glyph = self._cachedGlyphs.get(cacheKey)
         if glyph is None:
             if glyphName == ".notdef" and glyphName not in self.glyphSet:
                 # We need a .notdef glyph, so let's make one.
                 glyph = NotDefGlyph(self.info.unitsPerEm)
-                self._addOutlinePathToGlyph(glyph)
             else:
+                glyphSet = self.glyphSet if layerName is None else self.getLayerGlyphSet(layerName)
                 try:
-                    if layerName is None:
-                        glyph = self.glyphSet[glyphName]
+                    glyph = glyphSet[glyphName]
+                    if needsOutline:
+                        # This reads the glyph's attributes as well
+                        self._addOutlinePathToGlyph(glyph)
                     else:
-                        glyph = self.getLayerGlyphSet(layerName)[glyphName]
-                    self._addOutlinePathToGlyph(glyph)
+                        glyphSet.readGlyph(glyphName, glyph)
                 except Exception as e:
-                    # TODO: logging would be better but then capturing in mainWindow.py is harder
-                    print(f"Glyph '{glyphName}' could not be read: {e!r}", file=sys.stderr)
-                    glyph = self._getGlyph(".notdef")
-            self._cachedGlyphs[(layerName, glyphName)] = glyph
+                    self._reportGlyphError(glyphName, e)
+                    glyph = self._getGlyph(".notdef", needsOutline=needsOutline)
+            self._cachedGlyphs[cacheKey] = glyph
+        if needsOutline and glyph.outline is None:
+            try:
+                self._addOutlinePathToGlyph(glyph)
+            except Exception as e:
+                self._reportGlyphError(glyphName, e)
+                glyph = self._getGlyph(".notdef")
+                self._cachedGlyphs[cacheKey] = glyph
         return glyph
 
+    def _reportGlyphError(self, glyphName, error):
+        # TODO: logging would be better but then capturing in mainWindow.py is harder
+        print(f"Glyph '{glyphName}' could not be read: {error!r}", file=sys.stderr)
+
     def _addOutlinePathToGlyph(self, glyph):
         pen = platform.Pen(self.glyphSet)
         glyph.draw(pen)
         glyph.outline = pen.path
 
     def _getHorizontalAdvance(self, glyphName):
-        glyph = self._getGlyph(glyphName)
-        return glyph.width
+        width = self._glyphWidths.get(glyphName)
+        if width is None:
+            # Not scanned by the compiler (for example a generated .notdef),
+            # or the glyph has no advance
+            return self._getGlyph(glyphName, needsOutline=False).width
+        return width
 
     @cachedProperty
     def defaultVerticalAdvance(self):
@@ -177,14 +247,14 @@ class UFOFont(BaseFont):
             return ascender
 
     def _getVerticalAdvance(self, glyphName):
-        glyph = self._getGlyph(glyphName)
+        glyph = self._getGlyph(glyphName, needsOutline=False)
         vAdvance = glyph.height
         if vAdvance is None or vAdvance == 0:  # XXX default vAdv == 0 -> bad UFO spec
             vAdvance = self.defaultVerticalAdvance
         return -abs(vAdvance)
 
     def _getVerticalOrigin(self, glyphName):
-        glyph = self._getGlyph(glyphName)
+        glyph = self._getGlyph(glyphName, needsOutline=False)
         vOrgX = glyph.width / 2
         lib = getattr(glyph, "lib", {})
         vOrgY = lib.get("public.verticalOrigin")
@@ -226,6 +296,8 @@ class UFOFont(BaseFont):
 
 class NotDefGlyph:
 
+    outline = None
+
     def __init__(self, unitsPerEm):
         self.unitsPerEm = unitsPerEm
         self.width = unitsPerEm // 2
@@ -267,6 +339,7 @@ class Glyph(GLIFGlyph):
     width = 0
     height = None
     lib = {}  # readonly default!
+    outline = None
 
 
 def extractIncludedFeatureFiles(ufoPath, reader=None):
@@ -359,10 +432,11 @@ class UFOState:
             self.glyphModTimes, self.contentsModTime = getGlyphModTimes(glyphSet)
             self.fileModTimes = getFileModTimes(reader.fs.getsyspath("/"), ufoFilesToTrack)
         else:
-            self.glyphModTimes = set()
+            self.glyphModTimes = {}
             self.contentsModTime = None
-            self.fileModTimes = set()
+            self.fileModTimes = {}
         self.includedFeatureFiles = includedFeatureFiles
+        self.changedWidths = {}  # glyphName: width, for glyphs changed since the previous state
         self._previousState = previousState
 
     def newState(self):
@@ -384,7 +458,7 @@ class UFOState:
         assert prev is not None, "getUpdateInfo() is a one-shot method"  # Or: memoize
         self._previousState = None
 
-        changedFiles = {fileName for fileName, modTime in prev.fileModTimes ^ self.fileModTimes}
+        changedFiles = _diffModTimes(prev.fileModTimes, self.fileModTimes)
 
         needsInfoUpdate = FONTINFO_FILENAME in changedFiles
         needsLibUpdate = LIB_FILENAME in changedFiles
@@ -397,10 +471,10 @@ class UFOState:
         needsCmapUpdate = False
 
         if prev.glyphModTimes != self.glyphModTimes or prev.contentsModTime != self.contentsModTime:
-            changedGlyphNames = {glyphName for glyphName, mtime in prev.glyphModTimes ^ self.glyphModTimes}
+            changedGlyphNames = _diffModTimes(prev.glyphModTimes, self.glyphModTimes)
             deletedGlyphNames = {glyphName for glyphName in changedGlyphNames if glyphName not in self.glyphSet}
 
-            _, _, changedUnicodes, changedAnchors = fetchGlyphInfo(
+            self.changedWidths, _, changedUnicodes, changedAnchors = fetchGlyphInfo(
                 self.glyphSet,
                 self.reader.fs.getsyspath("/"),
                 changedGlyphNames - deletedGlyphNames,
@@ -463,14 +537,34 @@ def getModTime(path):
 
 def getGlyphModTimes(glyphSet):
     folder = glyphSet.fs.getsyspath("/")  # We don't support .ufoz here
-    contentsModTime = getModTime(os.path.join(folder, CONTENTS_FILENAME))
-    return {(glyphName, getModTime(os.path.join(folder, fileName)))
+    # One directory scan is a lot faster than a stat call per glyph name
+    fileModTimes = _scanModTimes(folder)
+    contentsModTime = fileModTimes.get(CONTENTS_FILENAME)
+    return {glyphName: fileModTimes.get(fileName)
             for glyphName, fileName in glyphSet.contents.items()}, contentsModTime
 
 
 def getFileModTimes(folder, fileNames):
-    return {(fileName, getModTime(os.path.join(folder, fileName)))
-            for fileName in fileNames}
+    fileModTimes = _scanModTimes(folder)
+    return {fileName: fileModTimes.get(fileName) for fileName in fileNames}
+
+
+def _scanModTimes(folder):
+    modTimes = {}
+    with os.scandir(folder) as it:
+        for entry in it:
+            try:
+                modTimes[entry.name] = entry.stat().st_mtime
+            except FileNotFoundError:
+                pass  # Deleted while we were scanning
+    return modTimes
+
+
+def _diffModTimes(prevModTimes, modTimes):
+    # Return the set of names that were added, removed or modified
+    changed = {name for name, modTime in modTimes.items() if prevModTimes.get(name, -1) != modTime}
+    changed.update(prevModTimes.keys() - modTimes.keys())
+    return changed
 
 
 if __name__ == "__main__":
@@ -3,6 +3,7 @@ import pathlib
 from AppKit import NSDocumentController
 from Foundation import NSObject, NSURL
 from vanilla.dialogs import getFile
+from ..compile.compilerPool import prewarmCompilerPool
 from ..font import sniffFontType, fileTypes
 from ..misc.decorators import suppressAndLogException
 from .document import FGDocument
@@ -12,6 +13,7 @@ class FGAppDelegate(NSObject):
 
     filesToOpen = None
     unicodePicker = None
+    prewarmTask = None
 
     def openDocument_(self, sender):
         result = getFile(allowsMultipleSelection=True,
@@ -24,6 +26,11 @@ class FGAppDelegate(NSObject):
         if result:
             self.application_openFiles_(None, result)
 
+    @suppressAndLogException
+    def applicationDidFinishLaunching_(self, notification):
+        # Start some compiler workers now, so opening the first UFO is faster
+        self.prewarmTask = prewarmCompilerPool()
+
     def applicationShouldOpenUntitledFile_(self, app):
         return True
 
@@ -98,6 +98,18 @@ class FGFontListView(AppKit.NSView):
         if not self.vanillaWrapper().keyDown(event):
             super().keyDown_(event)
 
+    def viewWillMoveToSuperview_(self, newSuperview):
+        notificationCenter = AppKit.NSNotificationCenter.defaultCenter()
+        notificationCenter.removeObserver_name_object_(self, AppKit.NSViewBoundsDidChangeNotification, None)
+        if newSuperview is not None and isinstance(newSuperview, AppKit.NSClipView):
+            newSuperview.setPostsBoundsChangedNotifications_(True)
+            notificationCenter.addObserver_selector_name_object_(
+                self, "clipViewBoundsChanged:", AppKit.NSViewBoundsDidChangeNotification, newSuperview)
+
+    @suppressAndLogException
+    def clipViewBoundsChanged_(self, notification):
+        self.vanillaWrapper().visibleRectChanged()
+
     def magnifyWithEvent_(self, event):
         if event.phase() in {AppKit.NSEventPhaseBegan, AppKit.NSEventPhaseMayBegin}:
             self._originalItemSize = self.vanillaWrapper().itemSize
@@ -280,7 +292,8 @@ class FontList(Group):
                  relativeVBaseline=0.5, relativeMargin=0.1,
                  showFontFileName=True, showMetrics=False, showBaseline=False,
                  selectionChangedCallback=None,
-                 glyphSelectionChangedCallback=None, arrowKeyCallback=None):
+                 glyphSelectionChangedCallback=None, arrowKeyCallback=None,
+                 visibleItemsChangedCallback=None):
         super().__init__((0, 0, width, 900))
         self.project = None  # Dummy, so we can set up other attrs first
         self.relativeFontSize = relativeFontSize
@@ -294,6 +307,7 @@ class FontList(Group):
         self._selectionChangedCallback = selectionChangedCallback
         self._glyphSelectionChangedCallback = glyphSelectionChangedCallback
         self._arrowKeyCallback = arrowKeyCallback
+        self._visibleItemsChangedCallback = visibleItemsChangedCallback
         self._lastItemClicked = None
         self.project = project
         self.projectProxy = projectProxy
@@ -428,6 +442,16 @@ class FontList(Group):
         for fontItemInfo in self.project.fonts:
             yield fontItemInfo, self.getFontItem(fontItemInfo.identifier)
 
+    def iterVisibleFontItemInfoAndItems(self):
+        visibleRect = self._nsObject.visibleRect()
+        for fontItemInfo, fontItem in self.iterFontItemInfoAndItems():
+            if AppKit.NSIntersectsRect(visibleRect, fontItem._nsObject.frame()):
+                yield fontItemInfo, fontItem
+
+    def visibleRectChanged(self):
+        if self._visibleItemsChangedCallback is not None:
+            self._visibleItemsChangedCallback(self)
+
     @hookedProperty
     def vertical(self):
         # Note that we heavily depend on hookedProperty's property that
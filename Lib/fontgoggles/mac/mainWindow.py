@@ -14,7 +14,7 @@ from vanilla import (ActionButton, CheckBox, EditText, Group, List, PopUpButton,
                      TextBox, TextEditor, VanillaBaseControl, Window, HorizontalLine)
 from vanilla.dialogs import getFile
 from fontTools.misc.arrayTools import offsetRect
-from fontgoggles.font import mergeAxes, mergeScriptsAndLanguages, mergeStylisticSetNames
+from fontgoggles.font import mergeAxes, mergeScriptsAndLanguages, mergeStylisticSetNames, sniffFontType
 from fontgoggles.font.baseFont import GlyphsRun
 from fontgoggles.mac.aligningScrollView import AligningScrollView
 from fontgoggles.mac.featureTagGroup import FeatureTagGroup
@@ -23,9 +23,9 @@ from fontgoggles.mac.fontList import FontList, fontItemMinimumSize, fontItemMaxi
 from fontgoggles.mac.misc import ClassNameIncrementer, makeTextCell
 from fontgoggles.mac.sliderGroup import SliderGroup, SliderPlus
 from fontgoggles.mac.vanillaTabsOld import Tabs
-from fontgoggles.compile.compilerPool import CompilerError
-from fontgoggles.misc.decorators import asyncTaskAutoCancel, suppressAndLogException
-from fontgoggles.misc.textInfo import TextInfo
+from fontgoggles.compile.compilerPool import CompilerError, getCompilerPool, prewarmCompilerPool
+from fontgoggles.misc.decorators import asyncTask, asyncTaskAutoCancel, suppressAndLogException
+from fontgoggles.misc.textInfo import TextInfo, TextInfoCache
 from fontgoggles.misc import opentypeTags
 
 
@@ -35,6 +35,9 @@ from fontgoggles.misc import opentypeTags
 # larger than strictly necessary for fitting all glyphs.
 fontListSizePadding = 120
 
+# Font types that need the compiler pool to load
+compiledFontTypes = {"ufo", "ufoz", "designspace", "ttx"}
+
 # Width of the sidebar with direction/alignment/script/language/features controls etc.
 sidebarWidth = 300
 
@@ -75,6 +78,9 @@ class FGMainWindowController(AppKit.NSWindowController, metaclass=ClassNameIncre
         self.observedPaths = {}
         self._callbackRecursionLock = 0
         self._previouslySingleSelectedItem = None
+        self.textInfoCache = TextInfoCache()  # for the lines of the text file
+        self.compileRequestKeys = set()
+        self.prewarmNamedInstancesTask = None
 
         characterListGroup = self.setupCharacterListGroup()
         glyphListGroup = self.setupGlyphListGroup()
@@ -135,6 +141,8 @@ class FGMainWindowController(AppKit.NSWindowController, metaclass=ClassNameIncre
         obs = getFileObserver()
         for path in self.observedPaths:
             obs.removeObserver(path, self._fileChanged)
+        self.cancelCompileRequests()
+        self.cancelPrewarmNamedInstances()
         self.__dict__.clear()
 
     def windowTitleForDocumentDisplayName_(self, displayName):
@@ -259,7 +267,8 @@ class FGMainWindowController(AppKit.NSWindowController, metaclass=ClassNameIncre
                                  showBaseline=self.project.uiSettings.fontListShowBaseline,
                                  selectionChangedCallback=self.fontListSelectionChangedCallback,
                                  glyphSelectionChangedCallback=self.fontListGlyphSelectionChangedCallback,
-                                 arrowKeyCallback=self.fontListArrowKeyCallback)
+                                 arrowKeyCallback=self.fontListArrowKeyCallback,
+                                 visibleItemsChangedCallback=self.fontListVisibleItemsChangedCallback)
         self._fontListScrollView = AligningScrollView((0, 0, 0, 0), self.fontList, drawBackground=True,
                                                       forwardDragAndDrop=True)
         self._fontListScrollView._nsObject.setBorderType_(AppKit.NSNoBorder)
@@ -473,6 +482,7 @@ class FGMainWindowController(AppKit.NSWindowController, metaclass=ClassNameIncre
         if any(change.op == "remove" for change in changeSet):
             self.fontList.purgeFontItems()
             self.project.purgeFonts()
+            self.cancelCompileRequests(self.project.fonts)
         fontItemsNeedingTextUpdate = self.fontList.refitFontItems()
         self.fontList.selection = self.project.fontSelection
         self.fontList.ensureFirstResponder()
@@ -495,10 +505,19 @@ class FGMainWindowController(AppKit.NSWindowController, metaclass=ClassNameIncre
         if not hasattr(self, "fontList"):
             # Window closed before we got to run
             return ()
+        self.cancelPrewarmNamedInstances()  # fonts may get reloaded
         coros = []
+        numSourceFonts = 0
         for fontItemInfo, fontItem in self.iterFontItemInfoAndItems():
             if fontItemInfo.font is None or fontItemInfo.wantsReload:
                 coros.append(self._loadFont(fontItemInfo, fontItem))
+                self.compileRequestKeys.add(fontItemInfo.compileRequestKey)
+                if sniffFontType(fontItemInfo.fontKey[0]) in compiledFontTypes:
+                    numSourceFonts += 1
+        if numSourceFonts:
+            # Start compiler workers while the fonts are being read
+            self.prewarmTask = prewarmCompilerPool(numSourceFonts)
+            self.updateCompilePriorities()
         await asyncio.gather(*coros)
         self._updateSidebarItems(*self._gatherSidebarInfo(self.project.fonts))
         if shouldRestoreSettings:
@@ -506,6 +525,50 @@ class FGMainWindowController(AppKit.NSWindowController, metaclass=ClassNameIncre
         else:
             self.setLanguagesFromScript()  # update the available languages
         self.fontListSelectionChangedCallback(self.fontList)
+        self.prewarmNamedInstancesTask = self.prewarmNamedInstances()
+
+    @objc.python_method
+    @asyncTask
+    async def prewarmNamedInstances(self):
+        # Build the glyph drawings at the named instances in the background,
+        # so picking one in the variations UI doesn't have to wait for them.
+        await asyncio.sleep(0.05)  # don't compete with the fonts being shown
+        colorLayers = self.project.textSettings.enableColor
+        for fontItemInfo in list(self.project.fonts):
+            font = fontItemInfo.font
+            if font is not None and font.namedInstances:
+                await font.prewarmNamedInstances(colorLayers=colorLayers)
+
+    @objc.python_method
+    def cancelPrewarmNamedInstances(self):
+        if self.prewarmNamedInstancesTask is not None:
+            self.prewarmNamedInstancesTask.cancel()
+            self.prewarmNamedInstancesTask = None
+
+    @objc.python_method
+    def fontListVisibleItemsChangedCallback(self, sender):
+        self.updateCompilePriorities()
+
+    @objc.python_method
+    def updateCompilePriorities(self):
+        # Fonts that are scrolled into view should be compiled first
+        pool = getCompilerPool()
+        visibleFontKeys = {fontItemInfo.fontKey for fontItemInfo, fontItem
+                           in self.fontList.iterVisibleFontItemInfoAndItems()}
+        for fontItemInfo in self.project.fonts:
+            pool.setPriority(fontItemInfo.compileRequestKey, int(fontItemInfo.fontKey in visibleFontKeys))
+            self.compileRequestKeys.add(fontItemInfo.compileRequestKey)
+
+    @objc.python_method
+    def cancelCompileRequests(self, keepFontItemInfos=()):
+        # Compile requests for fonts that were removed, or for a window that
+        # was closed, shouldn't keep waiting ahead of the others
+        pool = getCompilerPool()
+        keepKeys = {fontItemInfo.compileRequestKey for fontItemInfo in keepFontItemInfos}
+        for requestKey in self.compileRequestKeys - keepKeys:
+            pool.cancelPendingRequests(requestKey)
+            pool.setPriority(requestKey, 0)
+        self.compileRequestKeys &= keepKeys
 
     @objc.python_method
     async def _loadFont(self, fontItemInfo, fontItem):
@@ -621,11 +684,16 @@ class FGMainWindowController(AppKit.NSWindowController, metaclass=ClassNameIncre
             # Our window already closed, and our poor async task is too
             # late. Nothing left to do.
             return
-        self.textInfo = TextInfo(sender.get())
-        self.textInfo.shouldApplyBiDi = self.project.textSettings.shouldApplyBiDi
-        self.textInfo.directionOverride = self.project.textSettings.direction
-        self.textInfo.scriptOverride = self.project.textSettings.script
-        self.textInfo.languageOverride = self.project.textSettings.language
+        text = sender.get()
+        isTextFileLine = text == self.textEntry.getTextFileLine()
+        if isTextFileLine:
+            self.textInfo = self.textInfoCache.getTextInfo(text)
+        elif getattr(self, "textInfo", None) is None:
+            self.textInfo = TextInfo(text)
+        else:
+            # Only re-segment the part of the text that changed
+            self.textInfo.updateText(text)
+        self.setTextInfoSettings(self.textInfo)
         if self.project.textSettings.alignment is not None:
             align = self.project.textSettings.alignment
         else:
@@ -656,23 +724,52 @@ class FGMainWindowController(AppKit.NSWindowController, metaclass=ClassNameIncre
         if not updateCharacterList:
             self.characterList.setSelection(charSelection)
             self.characterListSelectionChangedCallback(self.characterList)
+        if isTextFileLine:
+            self.prefetchTextFileLines()
 
     @objc.python_method
-    def setFontItemText(self, fontItemInfo, fontItem):
-        font = fontItemInfo.font
-        if font is None:
-            return
+    def setTextInfoSettings(self, textInfo):
+        textInfo.shouldApplyBiDi = self.project.textSettings.shouldApplyBiDi
+        textInfo.directionOverride = self.project.textSettings.direction
+        textInfo.scriptOverride = self.project.textSettings.script
+        textInfo.languageOverride = self.project.textSettings.language
+
+    @objc.python_method
+    @asyncTaskAutoCancel
+    async def prefetchTextFileLines(self):
+        # Segment and shape the previous and next lines of the text file in
+        # the background, so stepping through the file shows them immediately.
+        # The fonts keep the glyph runs, see BaseFont.getGlyphRunFromTextInfo().
+        await asyncio.sleep(0.05)  # don't compete with the line that's being shown
+        for line in self.textEntry.getAdjacentTextFileLines():
+            textInfo = self.textInfoCache.getTextInfo(line)
+            self.setTextInfoSettings(textInfo)
+            for fontItemInfo, fontItem in self.iterFontItemInfoAndItems():
+                if fontItemInfo.font is None:
+                    continue
+                self.getGlyphRun(fontItemInfo.font, textInfo)
+                await asyncio.sleep(0)
+
+    @objc.python_method
+    def getGlyphRun(self, font, textInfo):
         stderr = io.StringIO()
         with contextlib.redirect_stderr(stderr):
-            glyphs = font.getGlyphRunFromTextInfo(self.textInfo,
+            glyphs = font.getGlyphRunFromTextInfo(textInfo,
                                                   features=self.project.textSettings.features,
                                                   varLocation=self.project.textSettings.varLocation,
                                                   colorLayers=self.project.textSettings.enableColor)
-        stderr = stderr.getvalue()
+        addBoundingBoxes(glyphs)
+        return glyphs, stderr.getvalue()
+
+    @objc.python_method
+    def setFontItemText(self, fontItemInfo, fontItem):
+        font = fontItemInfo.font
+        if font is None:
+            return
+        glyphs, stderr = self.getGlyphRun(font, self.textInfo)
         if stderr:
             fontItem.writeCompileOutput(stderr)
 
-        addBoundingBoxes(glyphs)
         fontItem.glyphs = glyphs
         charSelection = self.characterList.getSelection()
         if charSelection:
@@ -840,10 +937,10 @@ class FGMainWindowController(AppKit.NSWindowController, metaclass=ClassNameIncre
                 else:
                     charSelection = self.textInfo.mapToBiDi(charSelection)
                     if direction == -1:
-                        newCharselection = [max(0, min(charSelection) - 1)]
+                        newCharselection = [max(0, int(charSelection.min()) - 1)]
                     else:
-                        newCharselection = [min(len(self.characterList) - 1, max(charSelection) + 1)]
-                newCharselection = self.textInfo.mapFromBiDi(newCharselection)
+                        newCharselection = [min(len(self.characterList) - 1, int(charSelection.max()) + 1)]
+                newCharselection = self.textInfo.mapFromBiDi(newCharselection).tolist()
                 if event.modifierFlags() & AppKit.NSEventModifierFlagShift:
                     newCharselection = set(newCharselection + self.characterList.getSelection())
                 self.characterList.setSelection(newCharselection)
@@ -1343,6 +1440,24 @@ class TextEntryGroup(Group):
         self.textEntry.set(line)
         self.textEntry._target.callback(self.textEntry)
 
+    def getTextFileLine(self):
+        """Return the current line of the text file, or None if there's no
+        text file.
+        """
+        if self.textFilePath is None or not self.lines:
+            return None
+        return self.lines[self.textFileIndex]
+
+    def getAdjacentTextFileLines(self):
+        """Return the next and previous lines of the text file, the ones
+        nextTextLine() and previousTextLine() would show.
+        """
+        if self.textFilePath is None or not self.lines:
+            return []
+        numLines = len(self.lines)
+        indices = [(self.textFileIndex + 1) % numLines, (self.textFileIndex - 1) % numLines]
+        return [self.lines[index] for index in sorted(set(indices), key=indices.index)]
+
     def stepperCallback(self, sender):
         self.setTextFileIndex(len(self.lines) - 1 - sender.get())
 
@@ -1,9 +1,9 @@
-from collections import defaultdict
 import functools
 import io
-import itertools
+import numpy
 from fontTools.ttLib import TTFont
 import uharfbuzz as hb
+from .lruCache import LRUCache
 
 
 class GlyphInfo:
@@ -69,6 +69,9 @@ _HORIZONTAL_DESCENDER_OS2 = 1331983203  # HB_TAG ('O','d','s','c')
 
 class HBShape:
 
+    # The maximum number of glyphs kept in the shaping cache, per shaper
+    shapeCacheSize = 50000
+
     @classmethod
     def fromPath(cls, path, **kwargs):
         with open(path, "rb") as f:
@@ -85,6 +88,7 @@ class HBShape:
         self._fontNumber = fontNumber
         self.face = hb.Face(fontData, fontNumber)
         self.font = hb.Font(self.face)
+        self._parentFont = None
 
         if ttFont is None:
             f = io.BytesIO(self._fontData)
@@ -114,9 +118,31 @@ class HBShape:
                 self._funcs.set_glyph_v_advance_func(_getVerticalAdvanceFunc, self)
             if getVerticalOrigin is not None:
                 self._funcs.set_glyph_v_origin_func(_getVerticalOriginFunc, self)
+        elif getVerticalAdvance is not None or getVerticalOrigin is not None:
+            # Only the vertical metrics are ours: use a sub font, which falls
+            # back to the native HarfBuzz functions of its parent for the rest
+            self._parentFont = self.font
+            self.font = hb.Font(self._parentFont)
+            self._funcs = hb.FontFuncs.create()
+            if getVerticalAdvance is not None:
+                self._funcs.set_glyph_v_advance_func(_getVerticalAdvanceFunc, self)
+            if getVerticalOrigin is not None:
+                self._funcs.set_glyph_v_origin_func(_getVerticalOriginFunc, self)
         else:
             self._funcs = None
 
+        self._shapeCache = LRUCache(self.shapeCacheSize, sizeFunc=_shapeResultSize)
+
+    def clearCache(self):
+        """Discard all cached shaping results. This must be called when
+        the results of the glyph callbacks (advances, cmap) have changed.
+        """
+        self._shapeCache.clear()
+
+    @property
+    def cacheStatistics(self):
+        return self._shapeCache.statistics
+
     def getFontMetrics(self):
         xHeight = self.font.get_metric_position(hb.OTMetricsTag.X_HEIGHT)
         capHeight = self.font.get_metric_position(hb.OTMetricsTag.CAP_HEIGHT)
@@ -125,7 +151,13 @@ class HBShape:
         return xHeight, capHeight, ascender, descender
 
     def setVarLocation(self, varLocation):
+        self._setVariations(varLocation)
+
+    def _setVariations(self, varLocation):
         self.font.set_variations(varLocation)
+        if self._parentFont is not None:
+            # The sub font's native functions use the parent's variations
+            self._parentFont.set_variations(varLocation)
 
     def getFeatures(self, otTableTag):
         features = set()
@@ -175,22 +207,77 @@ class HBShape:
 
     def shape(self, text, *, features=None, varLocation=None,
               direction=None, language=None, script=None):
+        gids, clusters, positions = self.shapeToArrays(
+            text, features=features, varLocation=varLocation,
+            direction=direction, language=language, script=script)
+        glyphOrder = self.glyphOrder
+        return [GlyphInfo(gid, glyphOrder[gid], cluster, dx, dy, ax, ay)
+                for gid, cluster, (dx, dy, ax, ay)
+                in zip(gids.tolist(), clusters.tolist(), positions.tolist())]
+
+    def shapeToArrays(self, text, *, features=None, varLocation=None,
+                      direction=None, language=None, script=None):
+        """Shape `text` and return the result as three read-only arrays:
+        the glyph IDs, the clusters, and an (n, 4) array containing the
+        dx, dy, ax and ay values for each glyph.
+        """
         if features is None:
             features = {}
         if varLocation is None:
             varLocation = {}
 
-        self.font.set_variations(varLocation)
+        text = str(text)  # add_str() does not accept str subclasses
+        cacheKey = _makeCacheKey(text, features, varLocation, direction, language, script)
+        result = None if cacheKey is None else self._shapeCache.get(cacheKey)
+
+        if result is None:
+            self._setVariations(varLocation)
+            if self._funcs is not None:
+                self.font.funcs = self._funcs
+            buf = _newBuffer()
+            result = self._shapeBuffer(buf, text, features, direction, language, script)
+            if cacheKey is not None:
+                self._shapeCache[cacheKey] = result
+        return result
+
+    def shapeMany(self, texts, *, features=None, varLocation=None,
+                  direction=None, language=None, script=None):
+        """Shape each string in `texts` with the same settings, and yield a
+        (gids, clusters, positions) tuple for each, as shapeToArrays() does.
+
+        This is a generator: the variation location and font funcs are set
+        up once, and a single HarfBuzz buffer is reused for all strings, so
+        the shaper should not be used for anything else until the iteration
+        is complete.
+        """
+        if features is None:
+            features = {}
+        if varLocation is None:
+            varLocation = {}
 
+        self._setVariations(varLocation)
         if self._funcs is not None:
             self.font.funcs = self._funcs
 
-        buf = hb.Buffer.create()
-        buf.add_str(str(text))  # add_str() does not accept str subclasses
+        buf = None
+        for text in texts:
+            text = str(text)
+            cacheKey = _makeCacheKey(text, features, varLocation, direction, language, script)
+            result = None if cacheKey is None else self._shapeCache.get(cacheKey)
+            if result is None:
+                if buf is None:
+                    buf = _newBuffer()
+                else:
+                    buf.clear_contents()
+                result = self._shapeBuffer(buf, text, features, direction, language, script)
+                if cacheKey is not None:
+                    self._shapeCache[cacheKey] = result
+            yield result
+
+    def _shapeBuffer(self, buf, text, features, direction, language, script):
+        buf.add_str(text)
         buf.guess_segment_properties()
 
-        buf.cluster_level = hb.BufferClusterLevel.MONOTONE_CHARACTERS
-
         if direction is not None:
             buf.direction = direction
         if language is not None:
@@ -200,12 +287,46 @@ class HBShape:
 
         hb.shape(self.font, buf, features)
 
-        glyphOrder = self.glyphOrder
-        infos = []
-        for info, pos in zip(buf.glyph_infos, buf.glyph_positions):
-            infos.append(GlyphInfo(info.codepoint, glyphOrder[info.codepoint], info.cluster, *pos.position))
+        return _bufferToArrays(buf)
+
+
+def _newBuffer():
+    buf = hb.Buffer.create()
+    buf.cluster_level = hb.BufferClusterLevel.MONOTONE_CHARACTERS
+    return buf
+
+
+def _makeCacheKey(text, features, varLocation, direction, language, script):
+    cacheKey = (text, _freezeDict(features), _freezeDict(varLocation),
+                direction, language, script)
+    try:
+        hash(cacheKey)
+    except TypeError:
+        return None  # unhashable feature values, don't cache
+    return cacheKey
+
+
+def _shapeResultSize(result):
+    gids, clusters, positions = result
+    return len(gids)
+
+
+def _bufferToArrays(buf):
+    infos = buf.glyph_infos
+    numGlyphs = len(infos)
+    gids = numpy.fromiter((info.codepoint for info in infos), numpy.int32, numGlyphs)
+    clusters = numpy.fromiter((info.cluster for info in infos), numpy.int32, numGlyphs)
+    # glyph_positions is None for an empty buffer
+    positions = numpy.array([pos.position for pos in buf.glyph_positions or ()], numpy.int32)
+    positions = positions.reshape((numGlyphs, 4))
+    for a in (gids, clusters, positions):
+        # Results are shared through the cache, so guard against accidents
+        a.flags.writeable = False
+    return gids, clusters, positions
 
-        return infos
+
+def _freezeDict(d):
+    return tuple(sorted(d.items()))
 
 
 def characterGlyphMapping(clusters, numChars):
@@ -217,36 +338,77 @@ def characterGlyphMapping(clusters, numChars):
 
     "Each character belongs to the cluster that has the highest cluster
     value not larger than its initial cluster value.""
+
+    This returns the mappings as lists of lists, see
+    characterGlyphMappingArrays() for the array version.
     """
+    glyphToChars, charToGlyphs = characterGlyphMappingArrays(clusters, numChars)
+    return _mappingToLists(glyphToChars, False), _mappingToLists(charToGlyphs, True)
 
-    if clusters:
+
+def characterGlyphMappingArrays(clusters, numChars):
+    """Like characterGlyphMapping(), but returns both mappings in compressed
+    sparse row form: an (offsets, indices) tuple of arrays, where item i maps
+    to indices[offsets[i]:offsets[i + 1]]. Use mapIndices() to look up
+    several items at once.
+    """
+    clusters = numpy.asarray(clusters, numpy.intp)
+    numGlyphs = len(clusters)
+    if numGlyphs:
         if clusters[-1] != 0:
             assert clusters[0] == 0
 
-    clusterToChars = {}
-    charToCluster = {}
-    for cl, clNext in _pairs(sorted(set(clusters)), numChars):
-        chars = list(range(cl, clNext))
-        clusterToChars[cl] = chars
-        for char in chars:
-            charToCluster[char] = cl
-
-    glyphToChars = [clusterToChars[cl] for cl in clusters]
-
-    charToGlyphs = defaultdict(list)
-    for glyphIndex, charIndices in enumerate(glyphToChars):
-        for ci in charIndices:
-            charToGlyphs[ci].append(glyphIndex)
-
-    # assert sorted(charToGlyphs) == list(range(numChars)), charToGlyphs
-    charToGlyphs = [charToGlyphs[ci] for ci in sorted(charToGlyphs)]
+    clusterStarts = numpy.unique(clusters)
+    clusterEnds = numpy.append(clusterStarts[1:], numChars)
+
+    # Each glyph maps to all characters of its cluster
+    glyphClusters = numpy.searchsorted(clusterStarts, clusters)
+    glyphToChars = _makeMapping(clusterStarts[glyphClusters], clusterEnds[glyphClusters] - clusterStarts[glyphClusters])
+
+    # Each character maps to all glyphs of its cluster, in glyph order
+    # (characters before the first cluster don't map to any glyph)
+    charClusters = numpy.searchsorted(clusterStarts, numpy.arange(numChars), side="right") - 1
+    glyphCounts = numpy.bincount(glyphClusters, minlength=len(clusterStarts))
+    clusterGlyphOffsets = numpy.cumsum(glyphCounts) - glyphCounts
+    charGlyphOffsets = numpy.zeros(numChars, numpy.intp)
+    charGlyphCounts = numpy.zeros(numChars, numpy.intp)
+    inCluster = charClusters >= 0
+    charGlyphOffsets[inCluster] = clusterGlyphOffsets[charClusters[inCluster]]
+    charGlyphCounts[inCluster] = glyphCounts[charClusters[inCluster]]
+    offsets, positions = _makeMapping(charGlyphOffsets, charGlyphCounts)
+    glyphsByCluster = numpy.argsort(glyphClusters, kind="stable")
+    charToGlyphs = (offsets, glyphsByCluster[positions])
 
     return glyphToChars, charToGlyphs
 
 
-def _pairs(seq, sentinel):
-    it = itertools.chain(seq, (sentinel,))
-    prev = next(it)
-    for i in it:
-        yield prev, i
-        prev = i
+def mapIndices(mapping, indices):
+    """Return an array with all indices that the given indices map to, in a
+    mapping as returned by characterGlyphMappingArrays(). `indices` can be
+    an array, a range or any other iterable of ints.
+    """
+    offsets, mappedIndices = mapping
+    if not isinstance(indices, numpy.ndarray):
+        indices = numpy.fromiter(indices, numpy.intp)
+    starts = offsets[indices]
+    _, positions = _makeMapping(starts, offsets[indices + 1] - starts)
+    return mappedIndices[positions]
+
+
+def _makeMapping(starts, counts):
+    # Build CSR offsets for the runs of `counts` consecutive ints beginning
+    # at `starts`, plus the concatenated runs themselves
+    offsets = numpy.zeros(len(counts) + 1, numpy.intp)
+    numpy.cumsum(counts, out=offsets[1:])
+    runStarts = numpy.repeat(starts - offsets[:-1], counts)
+    return offsets, runStarts + numpy.arange(offsets[-1], dtype=numpy.intp)
+
+
+def _mappingToLists(mapping, skipEmpty):
+    offsets, indices = mapping
+    indices = indices.tolist()
+    offsets = offsets.tolist()
+    lists = [indices[start:end] for start, end in zip(offsets, offsets[1:])]
+    if skipEmpty:
+        lists = [item for item in lists if item]
+    return lists
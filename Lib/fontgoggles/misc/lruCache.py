@@ -0,0 +1,86 @@
+from collections import OrderedDict
+
+
+class LRUCache:
+
+    """Bounded mapping that discards the least recently used items once the
+    total size of its items exceeds `maxSize`. The size of an item is
+    determined by calling `sizeFunc(value)`; by default each item counts as 1.
+    Lookups through get() are counted in the `hits` and `misses` attributes.
+
+        >>> cache = LRUCache(4, sizeFunc=len)
+        >>> cache["a"] = "xx"
+        >>> cache["b"] = "y"
+        >>> cache.get("a")
+        'xx'
+        >>> cache["c"] = "zz"
+        >>> sorted(cache)
+        ['a', 'c']
+        >>> cache.get("b") is None
+        True
+        >>> cache.hits, cache.misses, cache.size
+        (1, 1, 4)
+    """
+
+    def __init__(self, maxSize, sizeFunc=None):
+        self.maxSize = maxSize
+        self.sizeFunc = sizeFunc
+        self._items = OrderedDict()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self._items)
+
+    def __iter__(self):
+        return iter(self._items)
+
+    def __contains__(self, key):
+        return key in self._items
+
+    def get(self, key, default=None):
+        item = self._items.get(key)
+        if item is None:
+            self.misses += 1
+            return default
+        self.hits += 1
+        self._items.move_to_end(key)
+        return item[0]
+
+    def __setitem__(self, key, value):
+        itemSize = 1 if self.sizeFunc is None else self.sizeFunc(value)
+        oldItem = self._items.pop(key, None)
+        if oldItem is not None:
+            self.size -= oldItem[1]
+        self._items[key] = (value, itemSize)
+        self.size += itemSize
+        # Always keep the most recent item, even if it exceeds maxSize by itself
+        while self.size > self.maxSize and len(self._items) > 1:
+            _, (_, discardedSize) = self._items.popitem(last=False)
+            self.size -= discardedSize
+
+    def pop(self, key, default=None):
+        item = self._items.pop(key, None)
+        if item is None:
+            return default
+        self.size -= item[1]
+        return item[0]
+
+    def clear(self):
+        self._items.clear()
+        self.size = 0
+
+    def resetStatistics(self):
+        self.hits = 0
+        self.misses = 0
+
+    @property
+    def statistics(self):
+        return dict(hits=self.hits, misses=self.misses, items=len(self._items),
+                    size=self.size, maxSize=self.maxSize)
+
+
+if __name__ == "__main__":
+    import doctest
+    doctest.testmod()
@@ -29,6 +29,10 @@ class PlatformCocoa:
 
         return makePathFromGlyph(font, gid)
 
+    @staticmethod
+    def pathElementCount(path):
+        return path.elementCount()
+
     @staticmethod
     def convertRect(r):
         from ..mac.drawing import rectFromNSRect
@@ -70,6 +74,10 @@ class PlatformGeneric:
         font.draw_glyph_with_pen(gid, rp)
         return rp
 
+    @staticmethod
+    def pathElementCount(path):
+        return len(path.value)
+
     @staticmethod
     def convertRect(r):
         raise NotImplementedError()
@@ -1,4 +1,5 @@
 import itertools
+import numpy
 from fontTools.unicodedata import script
 from unicodedata2 import category
 
@@ -20,41 +21,151 @@ from fontTools.unicodedata.OTTags import SCRIPT_EXCEPTIONS
 
 UNKNOWN_SCRIPT = {"Zinh", "Zyyy", "Zxxx"}
 
+bidiClasses = [
+    "L", "R", "AL", "EN", "ES", "ET", "AN", "CS", "NSM", "BN", "B", "S", "WS", "ON",
+    "LRE", "LRO", "RLE", "RLO", "PDF", "LRI", "RLI", "FSI", "PDI",
+    "",  # not known by unicodedata, see fix_bidi_type_for_unknown_chars()
+]
+# Texts with these need the full BiDi algorithm, as they may contain more than
+# one level run
+explicitBiDiClasses = ["LRE", "LRO", "RLE", "RLO", "PDF", "LRI", "RLI", "FSI", "PDI"]
+
+
+class CodePointTable:
+
+    """A lookup table for a character property, as a NumPy array indexed by
+    code point. The array holds indices into `values`. Entries are filled in
+    on first use, so the property function is called only once for each
+    code point, after which looking up the property for all characters of a
+    text is a single array operation.
+    """
+
+    unknown = 0xFF
+
+    def __init__(self, getProperty, values=()):
+        self.getProperty = getProperty
+        self.values = []
+        self._valueIndices = {}
+        for value in values:
+            self.getValueIndex(value)
+        self._table = numpy.full(0x110000, self.unknown, numpy.uint8)
+
+    def getValueIndex(self, value):
+        valueIndex = self._valueIndices.get(value)
+        if valueIndex is None:
+            valueIndex = len(self.values)
+            assert valueIndex < self.unknown
+            self.values.append(value)
+            self._valueIndices[value] = valueIndex
+        return valueIndex
+
+    def lookup(self, codePoints):
+        """Return an array with the value index for each code point."""
+        valueIndices = self._table[codePoints]
+        missing = valueIndices == self.unknown
+        if missing.any():
+            for codePoint in numpy.unique(codePoints[missing]).tolist():
+                self._table[codePoint] = self.getValueIndex(self.getProperty(chr(codePoint)))
+            valueIndices = self._table[codePoints]
+        return valueIndices
+
+
+scriptTable = CodePointTable(script, ["Zxxx"])
+categoryTable = CodePointTable(category)
+mirroredTable = CodePointTable(lambda ch: ch in MIRRORED, [False, True])
+bidiClassTable = CodePointTable(unicodedata2.bidirectional, bidiClasses)
+
+
+def getCodePoints(txt):
+    return numpy.frombuffer(txt.encode("utf-32-le", "surrogatepass"), numpy.uint32)
+
 
 def textSegments(txt):
-    scripts = detectScript(txt)
-    storage = getBiDiInfo(txt)
+    scripts, levels, baseLevel = textSegmentArrays(txt)
+    return segmentsFromArrays(txt, scripts, levels), baseLevel
+
+
+def textSegmentArrays(txt, baseLevel=None):
+    """Return an array with the script (as an index into scriptTable.values)
+    and an array with the BiDi level of each character, and the base level.
+    `baseLevel` can be passed for a part of a larger text, see
+    findSegmentationAnchor().
+    """
+    codePoints = getCodePoints(txt)
+    scripts = resolveScripts(codePoints)
+    levels, baseLevel = resolveBiDiLevels(txt, codePoints, baseLevel)
+    return scripts, levels, baseLevel
 
-    levels = [None] * len(txt)
-    for ch in storage['chars']:
-        levels[ch['index']] = ch['level']
 
-    prevLevel = storage['base_level']
-    for i, level in enumerate(levels):
-        if level is None:
-            levels[i] = prevLevel
+def segmentsFromArrays(txt, scripts, levels, start=0, end=None):
+    """Return the segments for txt[start:end], from the arrays returned by
+    textSegmentArrays(). `start` and `end` must be segment boundaries.
+    """
+    if end is None:
+        end = len(txt)
+    if start >= end:
+        return []
+    # A new segment starts where the (folded) script or the BiDi level changes
+    scriptKeys = numpy.array(
+        [_getScriptKeyIndex(scriptTag) for scriptTag in scriptTable.values])[scripts[start:end]]
+    rangeLevels = levels[start:end]
+    changes = (scriptKeys[1:] != scriptKeys[:-1]) | (rangeLevels[1:] != rangeLevels[:-1])
+    starts = (numpy.flatnonzero(changes) + start + 1).tolist()
+    segments = []
+    for index, nextIndex in zip([start] + starts, starts + [end]):
+        segments.append((txt[index:nextIndex], scriptTable.values[scripts[index]], int(levels[index]), index))
+    return segments
+
+
+def findSegmentationAnchor(txt, start, end, reverse=False):
+    """Return the index of the first (or with `reverse`, the last) anchor
+    character in txt[start:end], or None if there is none. An anchor has
+    a strong BiDi type (L, R or AL) and a script of its own, so the scripts
+    and BiDi levels of the characters following it don't depend on the
+    characters preceding it, and vice versa. This allows re-segmenting part
+    of a text, see TextInfo.replaceText(). Only valid for texts without
+    explicit BiDi formatting characters, see hasExplicitBiDi().
+    """
+    L, R, AL = _bidiClassIndices("L", "R", "AL")
+    unknownScripts = [scriptTable.getValueIndex(scr) for scr in sorted(UNKNOWN_SCRIPT)]
+    nonSpacingMark = categoryTable.getValueIndex("Mn")
+    chunkSize = 64
+    while start < end:
+        # Look at increasingly large chunks, starting next to the edit
+        if reverse:
+            chunkStart, chunkEnd = max(start, end - chunkSize), end
         else:
-            prevLevel = level
+            chunkStart, chunkEnd = start, min(end, start + chunkSize)
+        codePoints = getCodePoints(txt[chunkStart:chunkEnd])
+        isAnchor = (numpy.isin(bidiClassTable.lookup(codePoints), [L, R, AL]) &
+                    ~numpy.isin(scriptTable.lookup(codePoints), unknownScripts) &
+                    (categoryTable.lookup(codePoints) != nonSpacingMark))
+        anchors = numpy.flatnonzero(isAnchor)
+        if len(anchors):
+            return chunkStart + int(anchors[-1] if reverse else anchors[0])
+        if reverse:
+            end = chunkStart
+        else:
+            start = chunkEnd
+        chunkSize *= 2
+    return None
+
 
-    chars = list(zip(txt, scripts, levels))
+def hasExplicitBiDi(txt):
+    """Return True if `txt` contains explicit BiDi embeddings, overrides or
+    isolates.
+    """
+    classes = bidiClassTable.lookup(getCodePoints(txt))
+    return bool(numpy.isin(classes, _bidiClassIndices(*explicitBiDiClasses)).any())
 
-    runLenghts = []
-    for value, sub in itertools.groupby(
-        chars,
-        key=lambda item: (SCRIPT_EXCEPTIONS.get(item[1], item[1].lower()), item[2]),
-    ):
-        runLenghts.append(len(list(sub)))
 
-    segments = []
-    index = 0
-    for rl in runLenghts:
-        nextIndex = index + rl
-        segment = chars[index:nextIndex]
-        runChars = "".join(ch for ch, script, bidiLevel in segment)
-        _, script, bidiLevel = segment[0]
-        segments.append((runChars, script, bidiLevel, index))
-        index = nextIndex
-    return segments, storage['base_level']
+_scriptKeyIndices = {}
+
+
+def _getScriptKeyIndex(scriptTag):
+    # Scripts that map to the same OpenType tag don't start a new segment
+    scriptKey = SCRIPT_EXCEPTIONS.get(scriptTag, scriptTag.lower())
+    return _scriptKeyIndices.setdefault(scriptKey, len(_scriptKeyIndices))
 
 
 def reorderedSegments(segments, baseLevel):
@@ -72,41 +183,140 @@ def reorderedSegments(segments, baseLevel):
 
 
 def detectScript(txt):
-    charScript = [script(c) for c in txt]
-
-    for i, ch in enumerate(txt):
-        scr = charScript[i]
-        cat = category(ch)
-        # Non-spacing mark (Mn) should always inherit script
-        if scr in UNKNOWN_SCRIPT or cat == "Mn":
-            if i:
-                scr = charScript[i-1]
-            else:
-                scr = None
-            if ch in MIRRORED and cat == "Pe":
-                scr = None
-        charScript[i] = scr
-
-    # Any unknowns should be mapped to the _next_ script
-    prev = None
-    for i in range(len(txt) - 1, -1, -1):
-        if charScript[i] is None:
-            charScript[i] = prev
-        else:
-            prev = charScript[i]
-
-    # There may be unknowns at the end of the string, fall back to
-    # preceding script
-    prev = "Zxxx"  # last resort
-    for i in range(len(txt)):
-        if charScript[i] is None:
-            charScript[i] = prev
-        else:
-            prev = charScript[i]
+    return [scriptTable.values[scriptIndex] for scriptIndex in resolveScripts(getCodePoints(txt)).tolist()]
 
-    assert None not in charScript
 
-    return charScript
+def resolveScripts(codePoints):
+    """Return an array with the script for each code point, as an index into
+    scriptTable.values. Characters with an unknown or inherited script, and
+    non-spacing marks, take the script of the preceding character. Closing
+    brackets don't: they, and characters that have no preceding character,
+    take the script of the next character with a known script, or else the
+    script of the preceding one.
+    """
+    numChars = len(codePoints)
+    scripts = scriptTable.lookup(codePoints).astype(numpy.intp)
+    categories = categoryTable.lookup(codePoints)
+    inherits = numpy.isin(scripts, [scriptTable.getValueIndex(scr) for scr in sorted(UNKNOWN_SCRIPT)])
+    inherits |= categories == categoryTable.getValueIndex("Mn")
+    isClosingBracket = ((categories == categoryTable.getValueIndex("Pe")) &
+                        (mirroredTable.lookup(codePoints) == mirroredTable.getValueIndex(True)))
+    noScript = -1
+    scripts[inherits & isClosingBracket] = noScript
+    if numChars and inherits[0]:
+        scripts[0] = noScript
+        inherits[0] = False
+    inherits &= ~isClosingBracket
+    scripts = _fillForward(scripts, ~inherits, noScript)
+    known = scripts != noScript
+    scripts = numpy.where(known, scripts, _fillBackward(scripts, known, noScript))
+    known = scripts != noScript
+    return _fillForward(scripts, known, scriptTable.getValueIndex("Zxxx"))
+
+
+def resolveBiDiLevels(txt, codePoints, baseLevel=None):
+    """Return an array with the resolved BiDi level for each character, and
+    the base level. Texts without explicit embeddings, overrides or isolates
+    form a single level run, which we resolve with array operations, see
+    _resolveLevelRun(). Other texts go through getBiDiInfo(), and ignore
+    the `baseLevel` argument.
+    """
+    numChars = len(codePoints)
+    classes = bidiClassTable.lookup(codePoints).astype(numpy.intp)
+    if numpy.isin(classes, _bidiClassIndices(*explicitBiDiClasses)).any():
+        storage = getBiDiInfo(txt)
+        baseLevel = storage["base_level"]
+        levels = numpy.full(numChars, -1, numpy.intp)
+        for ch in storage["chars"]:
+            levels[ch["index"]] = ch["level"]
+        return _fillForward(levels, levels != -1, baseLevel), baseLevel
+
+    L, R, AL, BN, unknown = _bidiClassIndices("L", "R", "AL", "BN", "")
+    if baseLevel is None:
+        strong = numpy.flatnonzero(numpy.isin(classes, [L, R, AL]))
+        baseLevel = 0 if not len(strong) or classes[strong[0]] == L else 1
+    classes[classes == unknown] = L  # see fix_bidi_type_for_unknown_chars()
+    # X9: boundary neutrals are removed, and get the level of the preceding
+    # character
+    kept = classes != BN
+    levels = numpy.full(numChars, baseLevel, numpy.intp)
+    levels[kept] = _resolveLevelRun(classes[kept], baseLevel)
+    return _fillForward(levels, kept, baseLevel), baseLevel
+
+
+def _resolveLevelRun(classes, baseLevel):
+    # Rules W1-W7, N1-N2, I1-I2 and L1 of the BiDi algorithm, for a single
+    # level run at the base level, as python-bidi implements them
+    (L, R, AL, EN, ES, ET, AN, CS, NSM, B, S, WS, ON) = _bidiClassIndices(
+        "L", "R", "AL", "EN", "ES", "ET", "AN", "CS", "NSM", "B", "S", "WS", "ON")
+    sor = eor = embeddingDirection = R if baseLevel % 2 else L
+    # W1: non-spacing marks take the type of the preceding character
+    types = _fillForward(classes, classes != NSM, sor)
+    # W2: European numbers after Arabic letters become Arabic numbers
+    lastStrong = _fillForward(types, numpy.isin(types, [L, R, AL]), sor)
+    types[(types == EN) & (lastStrong == AL)] = AN
+    # W3
+    types[types == AL] = R
+    # W4: single separators between numbers
+    if len(types) > 2:
+        previous, current, following = types[:-2], types[1:-1], types[2:]
+        types[1:-1] = numpy.where(
+            (current == ES) & (previous == EN) & (following == EN), EN,
+            numpy.where((current == CS) & (previous == following) & numpy.isin(previous, [EN, AN]),
+                        previous, current))
+    # W5: terminators next to European numbers
+    isTerminator = types == ET
+    previous = _fillForward(types, ~isTerminator, -1)
+    following = _fillBackward(types, ~isTerminator, -1)
+    types[isTerminator & ((previous == EN) | (following == EN))] = EN
+    # W6
+    types[numpy.isin(types, [ET, ES, CS])] = ON
+    # W7: European numbers after L become L
+    lastStrong = _fillForward(types, numpy.isin(types, [L, R]), sor)
+    types[(types == EN) & (lastStrong == L)] = L
+    # N1, N2: neutrals take the surrounding direction, or the embedding
+    # direction; numbers count as R
+    isNeutral = numpy.isin(types, [B, S, WS, ON])
+    previous = _fillForward(types, ~isNeutral, sor)
+    following = _fillBackward(types, ~isNeutral, eor)
+    previous[numpy.isin(previous, [EN, AN])] = R
+    following[numpy.isin(following, [EN, AN])] = R
+    types = numpy.where(isNeutral, numpy.where(previous == following, previous, embeddingDirection), types)
+    # I1, I2
+    levels = numpy.full(len(types), baseLevel, numpy.intp)
+    if baseLevel % 2:
+        levels[types != R] += 1
+    else:
+        levels[types == R] += 1
+        levels[numpy.isin(types, [EN, AN])] += 2
+    # L1: separators, and whitespace before separators or at the end, are
+    # reset to the base level
+    isSeparator = numpy.isin(classes, [B, S])
+    isWhitespace = classes == WS
+    following = _fillBackward(classes, ~isWhitespace, -1)
+    levels[isSeparator | (isWhitespace & ((following == -1) | numpy.isin(following, [B, S])))] = baseLevel
+    return levels
+
+
+def _bidiClassIndices(*classNames):
+    return [bidiClassTable.getValueIndex(className) for className in classNames]
+
+
+def _fillForward(values, mask, default):
+    # Return a copy of `values` where the items for which `mask` is False are
+    # replaced by the nearest preceding item for which it is True, or by
+    # `default` if there is none
+    indices = numpy.where(mask, numpy.arange(len(values)), -1)
+    numpy.maximum.accumulate(indices, out=indices)
+    return numpy.where(indices >= 0, values[indices], default)
+
+
+def _fillBackward(values, mask, default):
+    # Like _fillForward(), but with the nearest following item
+    numValues = len(values)
+    indices = numpy.where(mask, numpy.arange(numValues), numValues)
+    indices = numpy.minimum.accumulate(indices[::-1])[::-1]
+    return numpy.where(indices < numValues, values[numpy.minimum(indices, numValues - 1)], default)
 
 
 # copied from bidi/algorthm.py and modified to be more useful for us.
@@ -1,4 +1,11 @@
-from .segmenting import textSegments, reorderedSegments
+import bisect
+import copy
+import numpy
+from .lruCache import LRUCache
+from .segmenting import (
+    findSegmentationAnchor, getCodePoints, hasExplicitBiDi, reorderedSegments,
+    segmentsFromArrays, textSegmentArrays,
+)
 
 
 alignments = dict(LTR="left", RTL="right", TTB="top", BTT="bottom")
@@ -20,25 +27,88 @@ class TextInfo:
     @text.setter
     def text(self, text):
         self._text = text
-        self._segments, self.baseLevel = textSegments(text)
-        self.reorderedSegments = reorderedSegments(self._segments, self.baseLevel)
+        self._scripts, self._levels, self.baseLevel = textSegmentArrays(text)
+        self._hasExplicitBiDi = hasExplicitBiDi(text)
+        self._setSegments(segmentsFromArrays(text, self._scripts, self._levels))
+
+    def updateText(self, text):
+        """Set the text, re-segmenting only the part that changed. See
+        replaceText().
+        """
+        start, oldEnd, newEnd = findChangedRange(self._text, text)
+        self.replaceText(start, oldEnd, text[start:newEnd])
+
+    def replaceText(self, start, end, newText):
+        """Replace text[start:end] with `newText`. Only the characters between
+        the nearest segmentation anchors around the edit (see
+        segmenting.findSegmentationAnchor()) get re-segmented, and only the
+        segments that overlap them are rebuilt, so typing in a long text is
+        cheap. The whole text is re-segmented if there is no anchor before
+        the edit, as the base level may change, or if the text contains
+        explicit BiDi formatting characters.
+        """
+        oldText = self._text
+        text = oldText[:start] + newText + oldText[end:]
+        windowStart = None
+        if not self._hasExplicitBiDi and not hasExplicitBiDi(newText):
+            windowStart = findSegmentationAnchor(text, 0, start, reverse=True)
+        if windowStart is None:
+            self.text = text
+            return
+
+        windowEnd = findSegmentationAnchor(text, start + len(newText), len(text))
+        windowEnd = len(text) if windowEnd is None else windowEnd + 1
+        delta = len(text) - len(oldText)
+        oldWindowEnd = windowEnd - delta
+        scripts, levels, _ = textSegmentArrays(text[windowStart:windowEnd], self.baseLevel)
+        self._scripts = numpy.concatenate(
+            [self._scripts[:windowStart], scripts, self._scripts[oldWindowEnd:]])
+        self._levels = numpy.concatenate(
+            [self._levels[:windowStart], levels, self._levels[oldWindowEnd:]])
+        self._text = text
 
-        toBiDi = {}
-        fromBiDi = {}
+        # Segment boundaries outside of the window are unaffected, so only
+        # the segments overlapping the window need to be rebuilt
+        segments = self._segments
+        firstSegmentIndex = bisect.bisect_right(segments, windowStart, key=_getFirstCluster) - 1
+        lastSegmentIndex = bisect.bisect_right(segments, oldWindowEnd - 1, key=_getFirstCluster) - 1
+        regionStart = segments[firstSegmentIndex][3]
+        if lastSegmentIndex + 1 < len(segments):
+            regionEnd = segments[lastSegmentIndex + 1][3] + delta
+        else:
+            regionEnd = len(text)
+        newSegments = segmentsFromArrays(text, self._scripts, self._levels, regionStart, regionEnd)
+        followingSegments = [
+            (segmentText, segmentScript, segmentBiDiLevel, firstCluster + delta)
+            for segmentText, segmentScript, segmentBiDiLevel, firstCluster
+            in segments[lastSegmentIndex + 1:]
+        ]
+        self._setSegments(segments[:firstSegmentIndex] + newSegments + followingSegments)
+
+    def _setSegments(self, segments):
+        self._segments = segments
+        self.reorderedSegments = reorderedSegments(segments, self.baseLevel)
+        # The BiDi mappings are only needed for selections, build them on demand
+        self._toBiDi = None
+        self._fromBiDi = None
+
+    def _buildBiDiMappings(self):
+        # The mappings are permutation arrays: fromBiDi lists the original
+        # character indices in BiDi order, toBiDi is its inverse
+        numChars = len(self._text)
+        fromBiDi = numpy.empty(numChars, numpy.int32)
         afterIndex = 0
         for segmentText, segmentScript, segmentBiDiLevel, firstCluster in self.reorderedSegments:
-            charIndices = [beforeIndex
-                           for beforeIndex in range(firstCluster, firstCluster + len(segmentText))]
+            segmentLength = len(segmentText)
+            charIndices = numpy.arange(firstCluster, firstCluster + segmentLength, dtype=numpy.int32)
             if segmentBiDiLevel % 2:
-                charIndices = reversed(charIndices)
+                charIndices = charIndices[::-1]
+            fromBiDi[afterIndex:afterIndex + segmentLength] = charIndices
+            afterIndex += segmentLength
 
-            for beforeIndex in charIndices:
-                toBiDi[beforeIndex] = afterIndex
-                fromBiDi[afterIndex] = beforeIndex
-                afterIndex += 1
-
-        assert len(toBiDi) == len(text)
-        assert len(fromBiDi) == len(text)
+        assert afterIndex == numChars
+        toBiDi = numpy.empty(numChars, numpy.int32)
+        toBiDi[fromBiDi] = numpy.arange(numChars, dtype=numpy.int32)
         self._toBiDi = toBiDi
         self._fromBiDi = fromBiDi
 
@@ -50,12 +120,20 @@ class TextInfo:
             return [(self._text, None, None, 0)]
 
     def mapToBiDi(self, charIndices):
-        toBiDi = self._toBiDi
-        return [toBiDi[charIndex] for charIndex in charIndices]
+        """Map character indices to their indices in BiDi order. Takes an
+        iterable or an array of indices, returns an array.
+        """
+        if self._toBiDi is None:
+            self._buildBiDiMappings()
+        return self._toBiDi[_asIndexArray(charIndices)]
 
     def mapFromBiDi(self, charIndices):
-        fromBiDi = self._fromBiDi
-        return [fromBiDi[charIndex] for charIndex in charIndices]
+        """Map indices in BiDi order back to character indices. Takes an
+        iterable or an array of indices, returns an array.
+        """
+        if self._fromBiDi is None:
+            self._buildBiDiMappings()
+        return self._fromBiDi[_asIndexArray(charIndices)]
 
     @property
     def baseDirection(self):
@@ -72,3 +150,53 @@ class TextInfo:
     def suggestedAlignment(self):
         alignments = dict(LTR="left", RTL="right", TTB="top", BTT="bottom")
         return alignments[self.direction]
+
+
+class TextInfoCache:
+
+    """Keeps the TextInfo objects for texts that are shown repeatedly, such
+    as the lines of a text file, so they are only segmented once. The total
+    length of the texts is bounded by `maxSize`.
+    """
+
+    def __init__(self, maxSize=1000000):
+        self._textInfos = LRUCache(maxSize, sizeFunc=lambda textInfo: len(textInfo.text) + 1)
+
+    def getTextInfo(self, text):
+        """Return a TextInfo for `text`. This is a copy, so setting its
+        attributes or its text does not affect the cached one.
+        """
+        textInfo = self._textInfos.get(text)
+        if textInfo is None:
+            textInfo = TextInfo(text)
+            self._textInfos[text] = textInfo
+        return copy.copy(textInfo)
+
+    def __contains__(self, text):
+        return text in self._textInfos
+
+
+def findChangedRange(oldText, newText):
+    """Return (start, oldEnd, newEnd), so that replacing oldText[start:oldEnd]
+    with newText[start:newEnd] turns `oldText` into `newText`.
+    """
+    oldCodePoints = getCodePoints(oldText)
+    newCodePoints = getCodePoints(newText)
+    commonLength = min(len(oldCodePoints), len(newCodePoints))
+    differences = numpy.flatnonzero(oldCodePoints[:commonLength] != newCodePoints[:commonLength])
+    start = int(differences[0]) if len(differences) else commonLength
+    commonLength -= start
+    differences = numpy.flatnonzero(oldCodePoints[len(oldCodePoints) - commonLength:][::-1] !=
+                                    newCodePoints[len(newCodePoints) - commonLength:][::-1])
+    suffixLength = int(differences[0]) if len(differences) else commonLength
+    return start, len(oldText) - suffixLength, len(newText) - suffixLength
+
+
+def _asIndexArray(indices):
+    if isinstance(indices, numpy.ndarray):
+        return indices
+    return numpy.fromiter(indices, numpy.intp)
+
+
+def _getFirstCluster(segment):
+    return segment[3]
@@ -6,6 +6,7 @@ import os
 import pathlib
 import sys
 import typing
+from .compile.compilerPool import compileRequestKey
 from .font import getOpener
 
 
@@ -141,6 +142,10 @@ class FontItemInfo:
     def unload(self):
         self._fontLoader.unloadFont(self.fontKey)
 
+    @property
+    def compileRequestKey(self):
+        return self._fontLoader.getCompileRequestKey(self.fontKey)
+
 
 class FontLoader:
 
@@ -159,6 +164,15 @@ class FontLoader:
         return fontData
 
     async def loadFont(self, fontKey, outputWriter):
+        # Compile requests made during loading can be prioritized by fontKey,
+        # see CompilerPool.setPriority()
+        token = compileRequestKey.set(self.getCompileRequestKey(fontKey))
+        try:
+            await self._loadFont(fontKey, outputWriter)
+        finally:
+            compileRequestKey.reset(token)
+
+    async def _loadFont(self, fontKey, outputWriter):
         font = self.fonts.get(fontKey)
         if font is not None:
             if fontKey in self.wantsReload:
@@ -172,6 +186,11 @@ class FontLoader:
             await font.load(outputWriter)
             self.fonts[fontKey] = font
 
+    def getCompileRequestKey(self, fontKey):
+        # Include the loader, so requests from different projects for the
+        # same font can be told apart
+        return id(self), fontKey
+
     def unloadFont(self, fontKey):
         self.fonts.pop(fontKey, None)  # discard
         self.cachedFontData = {}
@@ -0,0 +1,15 @@
+import os
+import pytest
+from fontgoggles.compile import compileCache, glyphInfoCache
+
+
+@pytest.fixture(autouse=True)
+def cacheFolder(tmp_path, monkeypatch):
+    # Keep the tests away from the user's cache folder, and from each other
+    folder = tmp_path / "fontgoggles_cache"
+    monkeypatch.setenv("FONTGOGGLES_CACHE_DIR", os.fspath(folder))
+    monkeypatch.setattr(compileCache, "_compileCache", None)
+    monkeypatch.setattr(compileCache, "_compileCacheInitialized", False)
+    monkeypatch.setattr(glyphInfoCache, "_glyphInfoCache", None)
+    monkeypatch.setattr(glyphInfoCache, "_glyphInfoCacheInitialized", False)
+    return folder
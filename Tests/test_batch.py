@@ -0,0 +1,49 @@
+import asyncio
+import sys
+from fontgoggles import batch
+from fontgoggles.batch import getFontKeys, shapeCorpus
+from fontgoggles.font import getOpener
+from testSupport import getFontPath
+
+
+def test_shapeCorpus():
+    fontPaths = [getFontPath("MutatorSans.ttf"), getFontPath("IBMPlexSans-Regular.ttf")]
+    lines = ["ABC", "", "fi", "CBA", "Hello", "A"]
+    varLocation = {"wght": 500}
+    results = list(shapeCorpus(fontPaths, lines, varLocation=varLocation,
+                               chunkSize=4, maxWorkers=2))
+    assert len(results) == len(fontPaths) * len(lines)
+
+    fontKeys = getFontKeys(fontPaths)
+    for fontIndex, fontKey in enumerate(fontKeys):
+        fontPath, fontNumber = fontKey
+        _, opener, _ = getOpener(fontPath)
+        font = opener(fontPath, fontNumber)
+        asyncio.run(font.load(sys.stderr.write))
+        fontResults = results[fontIndex * len(lines):(fontIndex + 1) * len(lines)]
+        for lineIndex, (line, result) in enumerate(zip(lines, fontResults)):
+            assert result.fontKey == fontKey
+            assert result.lineIndex == lineIndex
+            run = font.getGlyphRun(line, varLocation=varLocation)
+            assert result.glyphNames == run.glyphNames
+            assert result.clusters.tolist() == run.clusters.tolist()
+            assert result.advances.tolist() == run.advances.tolist()
+
+
+def test_getWarmFont_compilerWorkers(monkeypatch):
+    monkeypatch.setattr(batch, "maxWarmFonts", 1)
+    monkeypatch.setattr(batch, "_warmFonts", {})
+    monkeypatch.setattr(batch, "_workerLoop", None)
+    try:
+        batch._getWarmFont((getFontPath("MutatorSansBoldWide.ufo"), 0))
+        pool = getattr(batch._workerLoop, "__FG_compiler_pool")
+        assert pool.maxWorkers == 1
+        assert len(pool.workers) == 1
+        workers = list(pool.workers)
+        # Evicting the first font stops the idle compiler worker
+        batch._getWarmFont((getFontPath("MutatorSansLightWide.ufo"), 0))
+        assert list(batch._warmFonts) == [(getFontPath("MutatorSansLightWide.ufo"), 0)]
+        assert pool.workers == []
+        assert [worker.process.returncode for worker in workers] == [0]
+    finally:
+        batch._closeWorkerLoop()
@@ -0,0 +1,103 @@
+import os
+import shutil
+import pytest
+from fontTools.designspaceLib import DesignSpaceDocument
+from fontgoggles.compile import compilerPool
+from fontgoggles.compile.compileCache import (CompileCache, getCompileCache, setCompileCache,
+                                              getDSCacheKey, getUFOCacheKey)
+from fontgoggles.compile.compilerPool import compileUFOToBytes
+from fontgoggles.compile.dsCompiler import getTTPaths
+from fontgoggles.compile.transport import TransferFolder, writeTransferData
+from testSupport import getFontPath
+
+
+@pytest.fixture
+def compileCache(tmp_path):
+    savedCache = getCompileCache()
+    cache = CompileCache(tmp_path / "cache")
+    setCompileCache(cache)
+    yield cache
+    setCompileCache(savedCache)
+
+
+def test_compileCache_lru(tmp_path):
+    cache = CompileCache(tmp_path / "cache", maxSize=2500)
+    cache.put("a", b"a" * 1000, "")
+    cache.put("b", b"b" * 1000, "some output")
+    assert cache.get("b") == (b"b" * 1000, "some output")
+    os.utime(cache._getPath("a"), (0, 0))
+    os.utime(cache._getPath("b"), (1, 1))
+    assert cache.get("a") == (b"a" * 1000, "")  # "a" is now most recently used
+    cache.put("c", b"c" * 1000, "")
+    assert cache.get("b") is None
+    assert cache.get("a") is not None
+    assert cache.get("c") is not None
+    cache.clear()
+    assert cache.get("a") is None
+
+
+def test_compileCache_pruneTempFiles(tmp_path):
+    cache = CompileCache(tmp_path / "cache")
+    cache.put("a", b"a", "")
+    oldTempPath = tmp_path / "cache" / "fontgoggles_temp_old"
+    newTempPath = tmp_path / "cache" / "fontgoggles_temp_new"
+    oldTempPath.write_bytes(b"partial")
+    newTempPath.write_bytes(b"partial")
+    os.utime(oldTempPath, (0, 0))
+    cache.prune()
+    assert not oldTempPath.exists()
+    assert newTempPath.exists()
+    assert cache.get("a") == (b"a", "")
+
+
+def test_getUFOCacheKey(tmp_path):
+    ufoPath = tmp_path / "test.ufo"
+    shutil.copytree(getFontPath("MutatorSansBoldWide.ufo"), ufoPath)
+    key = getUFOCacheKey(ufoPath, True)
+    assert key == getUFOCacheKey(ufoPath, True)
+    assert key != getUFOCacheKey(ufoPath, False)
+    glifPath = ufoPath / "glyphs" / "A_.glif"
+    glifPath.write_bytes(glifPath.read_bytes().replace(b'<unicode hex="0041"/>', b""))
+    assert key != getUFOCacheKey(ufoPath, True)
+
+
+def test_getUFOCacheKey_fileStamps(tmp_path):
+    ufoPath = tmp_path / "test.ufo"
+    shutil.copytree(getFontPath("MutatorSansBoldWide.ufo"), ufoPath)
+    key = getUFOCacheKey(ufoPath, True)
+    glifPath = ufoPath / "glyphs" / "A_.glif"
+    st = glifPath.stat()
+    # The .glif files are only read again if their modification time or
+    # size changed
+    glifPath.write_bytes(glifPath.read_bytes().replace(b'<unicode hex="0041"/>', b'<unicode hex="0061"/>'))
+    os.utime(glifPath, ns=(st.st_atime_ns, st.st_mtime_ns))
+    assert key == getUFOCacheKey(ufoPath, True)
+    os.utime(glifPath, ns=(st.st_atime_ns, st.st_mtime_ns + 1000))
+    assert key != getUFOCacheKey(ufoPath, True)
+
+
+def test_getDSCacheKey():
+    dsPath = getFontPath("MutatorSans.designspace")
+    doc = DesignSpaceDocument.fromfile(dsPath)
+    keys = []
+    for masterData in [b"test", b"test", b"changed"]:
+        with TransferFolder() as ttFolder:
+            ttPaths = getTTPaths(doc, ttFolder)
+            for ttPath in ttPaths.values():
+                writeTransferData(ttPath, masterData)
+            keys.append(getDSCacheKey(dsPath, 0, ttFolder, True))
+    assert keys[0] == keys[1]
+    assert keys[0] != keys[2]
+
+
+@pytest.mark.asyncio
+async def test_compileUFOToBytes_cached(compileCache, monkeypatch):
+    ufoPath = getFontPath("MutatorSansBoldWide.ufo")
+    fontData = await compileUFOToBytes(ufoPath, True, None)
+    assert len(os.listdir(compileCache.folder)) == 1
+
+    def getCompilerPool():
+        raise AssertionError("the compiler should not be called")
+
+    monkeypatch.setattr(compilerPool, "getCompilerPool", getCompilerPool)
+    assert fontData == await compileUFOToBytes(ufoPath, True, None)
@@ -1,3 +1,4 @@
+import numpy
 import pytest
 import sys
 from fontTools.ufoLib import UFOReader
@@ -87,3 +88,128 @@ async def test_DSFont_getOutline(ufoFileName, fontNumber, expectedBounds):
     await font.load(sys.stderr.write)
     drawing, *_ = font.getGlyphDrawings(["A"])
     assert expectedBounds == drawing.path.bounds()
+
+
+@pytest.mark.asyncio
+async def test_DSFont_nativeAdvances(monkeypatch):
+    dsPath = getFontPath("MutatorSans.designspace")
+    font = DSFont(dsPath, 0)
+    await font.load(sys.stderr.write)
+    assert "HVAR" in font.ttFont
+    assert font.shaper.getHorizontalAdvance is None
+    monkeypatch.setattr(DSFont, "useNativeAdvances", False)
+    fontWithCallbacks = DSFont(dsPath, 0)
+    await fontWithCallbacks.load(sys.stderr.write)
+    assert "HVAR" not in fontWithCallbacks.ttFont
+    text = "ABCS"  # S has sparse layer sources
+    for location in [{}, dict(wght=1000), dict(wdth=1000), dict(wght=400, wdth=700), dict(wght=1000, wdth=1000)]:
+        advances = [gi.ax for gi in font.getGlyphRun(text, varLocation=location)]
+        expectedAdvances = [gi.ax for gi in fontWithCallbacks.getGlyphRun(text, varLocation=location)]
+        # HVAR deltas are rounded, the callbacks truncate the interpolated advances
+        assert [abs(a - b) <= 1 for a, b in zip(advances, expectedAdvances)] == [True] * len(text)
+
+
+@pytest.mark.asyncio
+async def test_DSFont_batchedInterpolation():
+    dsPath = getFontPath("MutatorSans.designspace")
+    font = DSFont(dsPath, 0)
+    await font.load(sys.stderr.write)
+    unbatchedFont = DSFont(dsPath, 0)
+    await unbatchedFont.load(sys.stderr.write)
+    unbatchedFont._interpolator = None
+    glyphNames = ["A", "B", "C", "S", "Aacute", "dot"]  # S has sparse layer sources
+    for location in [{}, dict(wght=1000), dict(wdth=250, wght=600), dict(wght=1000, wdth=1000)]:
+        font.setVarLocation(location)
+        unbatchedFont.setVarLocation(location)
+        list(font.getGlyphDrawings(glyphNames))
+        for glyphName in glyphNames:
+            points = font._getVarGlyph(glyphName).getPoints()
+            expectedPoints = unbatchedFont._getVarGlyph(glyphName).getPoints()
+            assert numpy.allclose(points, expectedPoints)
+    # The deltas matrix grows as glyphs are added
+    allGlyphNames = font.shaper.glyphOrder
+    list(font.getGlyphDrawings(allGlyphNames))
+    for glyphName in allGlyphNames:
+        varGlyph = font._getVarGlyph(glyphName)
+        if hasattr(varGlyph, "getPoints"):
+            assert numpy.allclose(varGlyph.getPoints(), unbatchedFont._getVarGlyph(glyphName).getPoints())
+    # The deltas of the glyphs that share a model are stored together
+    groups = font._interpolator._groups
+    assert len(groups) < len(glyphNames)
+    # Only the points of the requested glyphs are computed
+    font.setVarLocation(dict(wght=700))
+    list(font.getGlyphDrawings(["B"]))
+    numPointGlyphs = sum(len(group._points) for group in groups.values()
+                         if group._varLocation == font._normalizedLocation)
+    assert numPointGlyphs == 1
+
+
+@pytest.mark.asyncio
+async def test_DSFont_glyphDrawingsCache():
+    dsPath = getFontPath("MutatorSans.designspace")
+    font = DSFont(dsPath, 0)
+    await font.load(sys.stderr.write)
+    glyphNames = ["A", "B", "C"]
+    defaultDrawings = list(font.getGlyphDrawings(glyphNames))
+    font.setVarLocation(dict(wght=1000))
+    boldDrawings = list(font.getGlyphDrawings(glyphNames))
+    assert [a is not b for a, b in zip(defaultDrawings, boldDrawings)] == [True] * 3
+    font.setVarLocation(dict(wght=500))
+    list(font.getGlyphDrawings(glyphNames))
+    # Revisiting a location reuses its drawings, tiny differences are rounded away
+    font.setVarLocation(dict(wght=1000.0001))
+    assert [a is b for a, b in zip(boldDrawings, font.getGlyphDrawings(glyphNames))] == [True] * 3
+    # An explicit default location is the default location
+    font.setVarLocation(dict(wght=0, wdth=0))
+    assert [a is b for a, b in zip(defaultDrawings, font.getGlyphDrawings(glyphNames))] == [True] * 3
+    # The default location drawings are not evicted by the others
+    font._varGlyphDrawings.maxSize = 0
+    for weight in range(100, 1000, 100):
+        font.setVarLocation(dict(wght=weight))
+        list(font.getGlyphDrawings(glyphNames))
+    assert len(font._varGlyphDrawings) == 1
+    font.setVarLocation({})
+    assert [a is b for a, b in zip(defaultDrawings, font.getGlyphDrawings(glyphNames))] == [True] * 3
+    # They are not evicted at all
+    assert font._glyphDrawings == [dict(zip(glyphNames, defaultDrawings)), {}]
+
+
+@pytest.mark.asyncio
+async def test_DSFont_prewarmNamedInstances():
+    dsPath = getFontPath("MutatorSans.designspace")
+    font = DSFont(dsPath, 0)
+    await font.load(sys.stderr.write)
+    instanceNames = [name for name, varLocation in font.namedInstances]
+    assert instanceNames[:4] == ["LightCondensed", "BoldCondensed", "LightWide", "BoldWide"]
+    assert font.namedInstances[1][1] == dict(wdth=0, wght=1000)
+    font.setVarLocation(dict(wght=300))
+    drawing, = font.getGlyphDrawings(["A"])
+    font.prewarmChunkSize = 2
+    await font.prewarmNamedInstances(["A", "B", "C"])
+    assert font.warmNamedInstances == set(instanceNames)
+    # The current location is left alone
+    assert font._currentVarLocation == dict(wght=300)
+    assert list(font.getGlyphDrawings(["A"])) == [drawing]
+    # Switching to a named instance doesn't build new drawings
+    font.setVarLocation(dict(wdth=1000, wght=1000))
+    font._getGlyphDrawing = None
+    drawings = list(font.getGlyphDrawings(["A", "B", "C"]))
+    assert [font._instanceGlyphDrawings.get((glyphName, font._varLocationKey, False))
+            for glyphName in "ABC"] == drawings
+    font.resetCache()
+    assert font.warmNamedInstances == set()
+
+
+@pytest.mark.asyncio
+async def test_DSFont_prewarmNamedInstancesBounded():
+    dsPath = getFontPath("MutatorSans.designspace")
+    font = DSFont(dsPath, 0)
+    await font.load(sys.stderr.write)
+    font.maxInstanceGlyphDrawingsSize = 1
+    font.resetCache()
+    font.prewarmChunkSize = 1
+    await font.prewarmNamedInstances(["A", "B", "C"])
+    # Prewarming stops once the instance cache is full; the first instance
+    # is at the default location, which uses the regular cache
+    assert len(font._instanceGlyphDrawings) == 1
+    assert font.warmNamedInstances == {"LightCondensed"}
@@ -1,5 +1,8 @@
+import shutil
 import sys
 import pytest
+from fontTools.ufoLib import UFOReaderWriter
+from fontgoggles.font import ufoFont
 from fontgoggles.font import getOpener, sniffFontType, sortedFontPathsAndNumbers
 from fontgoggles.misc.textInfo import TextInfo
 from testSupport import getFontPath, testDataFolder
@@ -348,6 +351,63 @@ async def test_getGlyphRunFromTextInfo(text, expectedGlyphNames, expectedPositio
     assert expectedPositions == positions
 
 
+@pytest.mark.asyncio
+async def test_getGlyphRunFromTextInfo_arrays():
+    fontPath = getFontPath('IBMPlexSansArabic-Regular.ttf')
+    numFonts, opener, getSortInfo = getOpener(fontPath)
+    font = opener(fontPath, 0)
+    await font.load(None)
+    textInfo = TextInfo("fit \u062D\u062A\u0649")
+    glyphs = font.getGlyphRunFromTextInfo(textInfo)
+    assert glyphs.gids.tolist() == [g.gid for g in glyphs]
+    assert glyphs.clusters.tolist() == [g.cluster for g in glyphs]
+    assert glyphs.positions.tolist() == [list(g.pos) for g in glyphs]
+    assert glyphs.advances.sum(axis=0).tolist() == list(glyphs.endPos)
+    assert glyphs.glyphNames == [g.name for g in glyphs]
+    # Per-glyph objects are created once, so client attributes persist
+    glyphs[0].bounds = (1, 2, 3, 4)
+    assert glyphs[0].bounds == (1, 2, 3, 4)
+    assert glyphs[-1] is glyphs[len(glyphs) - 1]
+
+
+@pytest.mark.asyncio
+async def test_getGlyphRunFromTextInfo_cache():
+    fontPath = getFontPath("MutatorSans.designspace")
+    numFonts, opener, getSortInfo = getOpener(fontPath)
+    font = opener(fontPath, 0)
+    await font.load(None)
+    textInfo = TextInfo("ABC")
+    glyphs = font.getGlyphRunFromTextInfo(textInfo, varLocation=dict(wght=1000))
+    assert font.getGlyphRunFromTextInfo(TextInfo("ABC"), varLocation=dict(wght=1000)) is glyphs
+    otherGlyphs = font.getGlyphRunFromTextInfo(textInfo, varLocation=dict(wght=500))
+    assert otherGlyphs is not glyphs
+    assert otherGlyphs.advances.tolist() != glyphs.advances.tolist()
+    # A cache hit still sets the location
+    assert font.getGlyphRunFromTextInfo(textInfo, varLocation=dict(wght=1000)) is glyphs
+    assert font._currentVarLocation == dict(wght=1000)
+    textInfo.directionOverride = "RTL"
+    assert font.getGlyphRunFromTextInfo(textInfo, varLocation=dict(wght=1000)) is not glyphs
+    font.resetCache()
+    assert font.getGlyphRunFromTextInfo(TextInfo("ABC"), varLocation=dict(wght=1000)) is not glyphs
+
+
+@pytest.mark.asyncio
+async def test_getGlyphRuns():
+    fontPath = getFontPath("MutatorSans.designspace")
+    numFonts, opener, getSortInfo = getOpener(fontPath)
+    font = opener(fontPath, 0)
+    await font.load(None)
+    texts = ["ABC", "", "CAB"]
+    location = dict(wght=1000)
+    runs = font.getGlyphRuns(iter(texts), varLocation=location)
+    assert [run.glyphNames for run in runs] == [["A", "B", "C"], [], ["C", "A", "B"]]
+    for text, run in zip(texts, runs):
+        expectedRun = font.getGlyphRun(text, varLocation=location)
+        assert run.numChars == len(text)
+        assert run.advances.tolist() == expectedRun.advances.tolist()
+        assert [g.glyphDrawing for g in run] == [g.glyphDrawing for g in expectedRun]
+
+
 @pytest.mark.asyncio
 async def test_mapGlyphsToChars():
     text = "عربي بِّ"
@@ -390,3 +450,67 @@ async def test_verticalGlyphMetricsFromUFO():
     assert expectedAY == ay
     assert expectedDX == dx
     assert expectedDY == dy
+
+
+@pytest.mark.asyncio
+async def test_ufoFeaturesUpdate(tmp_path, monkeypatch):
+    fontPath = tmp_path / "test.ufo"
+    shutil.copytree(getFontPath("MutatorSansBoldWide.ufo"), fontPath)
+    numFonts, opener, getSortInfo = getOpener(fontPath)
+    font = opener(fontPath, 0)
+    await font.load(None)
+    advances = [g.ax for g in font.getGlyphRunFromTextInfo(TextInfo("AB"))]
+
+    writer = UFOReaderWriter(fontPath, validate=False)
+    kerning = writer.readKerning()
+    kerning["A", "B"] = -500
+    writer.writeKerning(kerning)
+
+    async def compileUFOToBytes(*args, **kwargs):
+        raise AssertionError("the font should not be fully recompiled")
+
+    monkeypatch.setattr(ufoFont, "compileUFOToBytes", compileUFOToBytes)
+    assert font.canReloadWithChange(None)
+    await font.load(None)
+    assert [g.ax for g in font.getGlyphRunFromTextInfo(TextInfo("AB"))] == [advances[0] - 500, advances[1]]
+    assert "cmap" in font.ttFont
+    assert "FGAx" in font.ttFont
+
+
+@pytest.mark.asyncio
+async def test_ufoGlyphCache():
+    fontPath = getFontPath("MutatorSansBoldWide.ufo")
+    numFonts, opener, getSortInfo = getOpener(fontPath)
+    font = opener(fontPath, 0)
+    font.maxCachedGlyphs = 2
+    await font.load(None)
+    glyphs = font.shaper.shape("ABCD")
+    assert [g.ax for g in glyphs] == [1290, 1270, 1374, 1316]
+    # Advances come from the compiled font, no .glif files were read
+    assert len(font._cachedGlyphs) == 0
+    font.getGlyphRunFromTextInfo(TextInfo("ABCD"))
+    assert sorted(font._cachedGlyphs) == [(None, "C"), (None, "D")]
+
+
+@pytest.mark.asyncio
+async def test_ufoNativeAdvances(tmp_path):
+    fontPath = tmp_path / "test.ufo"
+    shutil.copytree(getFontPath("MutatorSansBoldWide.ufo"), fontPath)
+    numFonts, opener, getSortInfo = getOpener(fontPath)
+    font = opener(fontPath, 0)
+    await font.load(None)
+    assert "hmtx" in font.ttFont
+    assert font.shaper.getHorizontalAdvance is None
+    assert [g.ax for g in font.shaper.shape("AB")] == [1290, 1270]
+
+    writer = UFOReaderWriter(fontPath, validate=False)
+    glyphSet = writer.getGlyphSet()
+    glyph = glyphSet["A"]
+    glyphSet.readGlyph("A", glyph)
+    glyph.width = 1000
+    glyphSet.writeGlyph("A", glyph, glyph.drawPoints)
+    assert font.canReloadWithChange(None)
+    await font.load(None)
+    # The 'hmtx' table is outdated, so the advances come from callbacks
+    assert font.shaper.getHorizontalAdvance is not None
+    assert [g.ax for g in font.shaper.shape("AB")] == [1000, 1270]
@@ -1,5 +1,6 @@
+import numpy
 import pytest
-from fontgoggles.misc.hbShape import HBShape, characterGlyphMapping
+from fontgoggles.misc.hbShape import HBShape, characterGlyphMapping, characterGlyphMappingArrays, mapIndices
 from testSupport import getFontPath
 
 
@@ -98,3 +99,44 @@ def test_characterGlyphMapping(clusters, numChars, expectedGlyphToChars, expecte
     glyphToChars, charToGlyphs = characterGlyphMapping(clusters, numChars)
     assert glyphToChars == expectedGlyphToChars
     assert charToGlyphs == expectedCharToGlyphs
+
+
+@pytest.mark.parametrize("clusters,numChars,expectedGlyphToChars,expectedCharToGlyphs", clusterTestData)
+def test_characterGlyphMappingArrays(clusters, numChars, expectedGlyphToChars, expectedCharToGlyphs):
+    glyphToChars, charToGlyphs = characterGlyphMappingArrays(numpy.array(clusters, numpy.int32), numChars)
+    for glyphIndex, charIndices in enumerate(expectedGlyphToChars):
+        assert mapIndices(glyphToChars, [glyphIndex]).tolist() == charIndices
+    for charIndex, glyphIndices in enumerate(expectedCharToGlyphs):
+        assert mapIndices(charToGlyphs, numpy.array([charIndex])).tolist() == glyphIndices
+    assert set(mapIndices(glyphToChars, range(len(clusters))).tolist()) == set(range(numChars))
+
+
+def test_shape_cache():
+    s = HBShape.fromPath(getFontPath("IBMPlexSans-Regular.ttf"))
+    glyphs1 = s.shape("fierce")
+    glyphs2 = s.shape("fierce")
+    assert s.cacheStatistics["misses"] == 1
+    assert s.cacheStatistics["hits"] == 1
+    assert [repr(g) for g in glyphs1] == [repr(g) for g in glyphs2]
+    # We must get fresh GlyphInfo objects, as clients modify them
+    assert all(g1 is not g2 for g1, g2 in zip(glyphs1, glyphs2))
+    glyphs3 = s.shape("fierce", features=dict(liga=False))
+    assert [g.name for g in glyphs3] == ["f", "i", "e", "r", "c", "e"]
+    assert s.cacheStatistics["misses"] == 2
+    s.clearCache()
+    s.shape("fierce")
+    assert s.cacheStatistics["misses"] == 3
+    assert s.cacheStatistics["items"] == 1
+
+
+def test_shapeMany():
+    s = HBShape.fromPath(getFontPath("IBMPlexSans-Regular.ttf"))
+    texts = ["Type", "fierce", "12/34", "fierce"]
+    results = list(s.shapeMany(texts, features=dict(liga=False)))
+    assert len(results) == len(texts)
+    for text, (gids, clusters, positions) in zip(texts, results):
+        expectedGlyphs = s.shape(text, features=dict(liga=False))
+        assert gids.tolist() == [g.gid for g in expectedGlyphs]
+        assert clusters.tolist() == [g.cluster for g in expectedGlyphs]
+        assert positions.tolist() == [[g.dx, g.dy, g.ax, g.ay] for g in expectedGlyphs]
+    assert [s.glyphOrder[gid] for gid in results[1][0]] == ["f", "i", "e", "r", "c", "e"]
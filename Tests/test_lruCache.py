@@ -0,0 +1,33 @@
+from fontgoggles.misc.lruCache import LRUCache
+
+
+def test_lruCache():
+    cache = LRUCache(3)
+    cache["a"] = 1
+    cache["b"] = 2
+    cache["c"] = 3
+    assert cache.get("a") == 1
+    cache["d"] = 4
+    assert sorted(cache) == ["a", "c", "d"]
+    assert cache.get("b") is None
+    assert (cache.hits, cache.misses) == (1, 1)
+    assert cache.pop("c") == 3
+    assert len(cache) == 2
+    cache.clear()
+    assert len(cache) == 0
+    assert cache.size == 0
+
+
+def test_lruCache_sizeFunc():
+    cache = LRUCache(10, sizeFunc=len)
+    cache["a"] = "x" * 4
+    cache["b"] = "x" * 4
+    assert cache.size == 8
+    cache["a"] = "x" * 2
+    assert cache.size == 6
+    cache["c"] = "x" * 5
+    assert sorted(cache) == ["a", "c"]
+    assert cache.size == 7
+    # The most recent item is kept, even if it is too large by itself
+    cache["d"] = "x" * 20
+    assert list(cache) == ["d"]
@@ -1,5 +1,7 @@
+import asyncio
 import pathlib
 import pytest
+from fontgoggles.compile.compilerPool import getCompilerPool
 from fontgoggles.font import iterFontNumbers
 from fontgoggles.project import Project
 from testSupport import getFontPath
@@ -54,6 +56,28 @@ async def test_project_purgeFonts():
     assert list(pr._fontLoader.fonts) == []
 
 
+@pytest.mark.asyncio
+async def test_project_compileRequestKey():
+    pool = getCompilerPool()
+    pool.setLimits(maxWorkers=1)
+    await pool.prewarm(1)
+    worker = await pool.getWorker()  # Keep the only worker busy
+    fontPath = getFontPath("MutatorSansBoldWide.ufo")
+    projects = [Project(), Project()]
+    for pr in projects:
+        pr.addFont(fontPath, 0)
+    requestKeys = [pr.fonts[0].compileRequestKey for pr in projects]
+    assert requestKeys[0] != requestKeys[1]
+    tasks = [asyncio.create_task(pr.loadFonts()) for pr in projects]
+    while pool.occupancy["waiting"] < 2:
+        await asyncio.sleep(0.01)
+    pool.cancelPendingRequests(requestKeys[0])
+    pool._releaseWorker(worker)
+    await asyncio.gather(*tasks, return_exceptions=True)
+    assert tasks[0].cancelled()
+    assert projects[1].fonts[0].font is not None
+
+
 def test_project_dump_load(tmpdir):
     destPath = pathlib.Path(tmpdir / "test.gggls")
     pr = Project()
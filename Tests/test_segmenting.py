@@ -1,6 +1,8 @@
 from collections import deque
 import pytest
-from fontgoggles.misc.segmenting import getBiDiInfo, detectScript, textSegments
+from fontgoggles.misc.segmenting import (
+    getBiDiInfo, getCodePoints, detectScript, resolveBiDiLevels, textSegments,
+)
 
 
 testData = [
@@ -171,3 +173,30 @@ def test_textSegments(testString, expectedBaseLevel, expectedSegments):
     assert len(segments) == len(expectedSegments)
     for segment, expectedSegment in zip(segments, expectedSegments):
         assert segment == expectedSegment
+
+
+testDataBiDiLevels = [
+    "",
+    "abc def",
+    "\u0627\u064f\u0633 (abc) 12% 3.4 ",
+    "a \u05d0\u05b7 1+2 \u05d1, $5\t\u0627 1,2\n\u0627\u200d\u0628 ",
+    "\u0661\u0662 \u0627 -12,5 \u1FF0\u200b \u0300x",
+    "\u0627 \u202babc\u202c 12",  # explicit embedding, handled by getBiDiInfo()
+]
+
+
+@pytest.mark.parametrize("testString", testDataBiDiLevels)
+def test_resolveBiDiLevels(testString):
+    storage = getBiDiInfo(testString)
+    expectedLevels = [None] * len(testString)
+    for ch in storage["chars"]:
+        expectedLevels[ch["index"]] = ch["level"]
+    prevLevel = storage["base_level"]
+    for i, level in enumerate(expectedLevels):
+        if level is None:
+            expectedLevels[i] = prevLevel
+        else:
+            prevLevel = level
+    levels, baseLevel = resolveBiDiLevels(testString, getCodePoints(testString))
+    assert baseLevel == storage["base_level"]
+    assert levels.tolist() == expectedLevels
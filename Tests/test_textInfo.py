@@ -1,5 +1,5 @@
 import pytest
-from fontgoggles.misc.textInfo import TextInfo
+from fontgoggles.misc.textInfo import TextInfo, TextInfoCache, findChangedRange
 
 
 testData = [
@@ -21,3 +21,67 @@ def test_textInfo(text, shouldApplyBiDi, baseLevel, baseDirection, alignment, se
     assert baseDirection == ti.baseDirection
     assert alignment == ti.suggestedAlignment
     assert segments == ti.segments
+
+
+testDataReplaceText = [
+    ("abc", 3, 3, "d"),
+    ("abc \u062D\u062A\u0649 def", 4, 7, "123"),
+    ("abc \u062D\u062A\u0649 def", 11, 11, " \u05D0"),
+    ("\u062D\u062A\u0649 abc", 0, 1, "x"),  # changes the base level
+    ("abc (\u062D\u062A\u0649) 12 def\nghi", 14, 14, "\u0649"),
+    ("abc \u202B\u062D\u062A\u0649\u202C def", 5, 5, "x"),  # explicit embedding
+    ("", 0, 0, "abc"),
+    ("abc def", 0, 7, ""),
+]
+
+
+@pytest.mark.parametrize("text,start,end,newText", testDataReplaceText)
+def test_textInfo_replaceText(text, start, end, newText):
+    expectedText = text[:start] + newText + text[end:]
+    expected = TextInfo(expectedText)
+    ti = TextInfo(text)
+    ti.replaceText(start, end, newText)
+    assert ti.text == expectedText
+    assert ti.baseLevel == expected.baseLevel
+    assert ti.segments == expected.segments
+    assert ti.mapToBiDi(range(len(expectedText))).tolist() == expected.mapToBiDi(range(len(expectedText))).tolist()
+    assert ti.mapFromBiDi(range(len(expectedText))).tolist() == expected.mapFromBiDi(range(len(expectedText))).tolist()
+    ti = TextInfo(text)
+    ti.updateText(expectedText)
+    assert ti.text == expectedText
+    assert ti.segments == expected.segments
+
+
+def test_findChangedRange():
+    assert findChangedRange("abcdef", "abXYef") == (2, 4, 4)
+    assert findChangedRange("abc", "abcd") == (3, 3, 4)
+    assert findChangedRange("aaa", "aa") == (2, 3, 2)
+    assert findChangedRange("abc", "abc") == (3, 3, 3)
+    assert findChangedRange("", "abc") == (0, 0, 3)
+
+
+def test_textInfoCache():
+    cache = TextInfoCache(maxSize=10)
+    textInfo = cache.getTextInfo("abc")
+    assert textInfo.segments == [("abc", "Latn", 0, 0)]
+    assert "abc" in cache
+    textInfo.directionOverride = "RTL"
+    textInfo.updateText("abcd")
+    otherTextInfo = cache.getTextInfo("abc")
+    assert otherTextInfo is not textInfo
+    assert otherTextInfo.text == "abc"
+    assert otherTextInfo.directionOverride is None
+    cache.getTextInfo("0123456789")
+    assert "abc" not in cache
+
+
+def test_textInfo_biDiMappings():
+    ti = TextInfo("abc العربية 123 def")
+    ti.shouldApplyBiDi = True
+    numChars = len(ti.text)
+    toBiDi = ti.mapToBiDi(range(numChars))
+    assert sorted(toBiDi.tolist()) == list(range(numChars))
+    assert toBiDi.tolist() != list(range(numChars))
+    assert ti.mapFromBiDi(toBiDi).tolist() == list(range(numChars))
+    assert ti.mapToBiDi({5}).tolist() == [toBiDi[5]]
+    assert ti.mapFromBiDi([]).tolist() == []
@@ -0,0 +1,39 @@
+import io
+import pytest
+from fontTools.ttLib import TTFont
+from fontgoggles.compile.compilerPool import compileTTXToBytes
+from fontgoggles.compile.compileCache import getCompileCache, setCompileCache
+from fontgoggles.compile.transport import (TransferFolder, isSharedMemoryPath, readTransferData,
+                                           saveFont, transferPath, writeTransferData)
+from testSupport import getFontPath
+
+
+@pytest.mark.parametrize("useSharedMemory", [True, False])
+def test_transferData(useSharedMemory):
+    with TransferFolder(useSharedMemory) as folder:
+        path = transferPath(folder, "test.ttf")
+        assert isSharedMemoryPath(path) == useSharedMemory
+        writeTransferData(path, b"abc")
+        assert readTransferData(path) == b"abc"
+        writeTransferData(path, b"abcdef" * 1000)
+        assert readTransferData(path) == b"abcdef" * 1000
+        ttFont = TTFont(getFontPath("MutatorSans.ttf"))
+        fontPath = transferPath(folder, "font.ttf")
+        saveFont(ttFont, fontPath)
+        assert readTransferData(fontPath)[:4] == b"\x00\x01\x00\x00"
+    with pytest.raises(FileNotFoundError):
+        readTransferData(path)
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("useSharedMemory", [True, False])
+async def test_compileTTXToBytes_transport(useSharedMemory, monkeypatch):
+    savedCache = getCompileCache()
+    setCompileCache(None)
+    monkeypatch.setattr(TransferFolder, "useSharedMemoryDefault", useSharedMemory)
+    try:
+        fontData = await compileTTXToBytes(getFontPath("QuadTest-Regular.ttx"), None)
+    finally:
+        setCompileCache(savedCache)
+    ttFont = TTFont(io.BytesIO(fontData))
+    assert "glyf" in ttFont
@@ -1,9 +1,13 @@
 import asyncio
 import os
+import shutil
 import pytest
 from fontTools.ufoLib import UFOReader
+from fontgoggles.compile import compilerPool, ufoCompiler, workServer
 from fontgoggles.compile.ufoCompiler import fetchGlyphInfo
-from fontgoggles.compile.compilerPool import compileUFOToPath
+from fontgoggles.compile.glyphInfoCache import GlyphInfoCache, getGlyphInfoCache, setGlyphInfoCache
+from fontgoggles.compile.compilerPool import (CompilerError, CompilerPool, CompilerWorker, compileRequestKey,
+                                              compileUFOToPath, getCompilerPool, prewarmCompilerPool)
 from testSupport import getFontPath
 
 
@@ -36,6 +40,74 @@ def test_ufoCharacterMapping_glyphNames():
     assert anchors == {"A": [("top", 645, 815, None)]}
 
 
+@pytest.mark.parametrize("parallel", ["thread", "process"])
+def test_ufoCharacterMapping_parallel(parallel, monkeypatch):
+    ufoPath = getFontPath("MutatorSansBoldWideMutated.ufo")
+    reader = UFOReader(ufoPath)
+    expected = fetchGlyphInfo(reader.getGlyphSet(), ufoPath, parallel=False)
+    monkeypatch.setattr(ufoCompiler, "parallelScanThreshold", 0)
+    monkeypatch.setattr(ufoCompiler, "parallelScanChunkSize", 3)
+    monkeypatch.setattr(os, "cpu_count", lambda: 4)
+    assert fetchGlyphInfo(reader.getGlyphSet(), ufoPath, parallel=parallel) == expected
+    # The executor is reused
+    executor = ufoCompiler._scanExecutors[parallel]
+    assert fetchGlyphInfo(reader.getGlyphSet(), ufoPath, parallel=parallel) == expected
+    assert ufoCompiler._scanExecutors[parallel] is executor
+
+
+def test_compileUFOToPath_scanThreads(tmp_path, monkeypatch):
+    # Compile workers don't start scan processes of their own
+    monkeypatch.setattr(ufoCompiler, "parallelScanThreshold", 0)
+    monkeypatch.setattr(ufoCompiler, "parallelScanChunkSize", 3)
+    monkeypatch.setattr(ufoCompiler, "_scanExecutors", {})
+    monkeypatch.setattr(os, "cpu_count", lambda: 4)
+    ttPath = tmp_path / "test.ttf"
+    ufoCompiler.compileUFOToPath(getFontPath("MutatorSansBoldWideMutated.ufo"), ttPath, False)
+    assert ttPath.exists()
+    assert list(ufoCompiler._scanExecutors) == ["thread"]
+
+
+def test_ufoCharacterMapping_serialByDefault(monkeypatch):
+    ufoPath = getFontPath("MutatorSansBoldWideMutated.ufo")
+    reader = UFOReader(ufoPath)
+    monkeypatch.setattr(ufoCompiler, "parallelScanThreshold", 0)
+    monkeypatch.setattr(ufoCompiler, "parallelScanChunkSize", 3)
+    monkeypatch.setattr(ufoCompiler, "_getScanExecutor", None)
+    widths, cmap, revCmap, anchors = fetchGlyphInfo(reader.getGlyphSet(), ufoPath)
+    assert cmap[0x0041] == "A"
+
+
+def test_fetchGlyphInfo_index(tmp_path, monkeypatch):
+    ufoPath = tmp_path / "test.ufo"
+    shutil.copytree(getFontPath("MutatorSansBoldWide.ufo"), ufoPath)
+    reader = UFOReader(ufoPath)
+    expected = fetchGlyphInfo(reader.getGlyphSet(), ufoPath)
+
+    scannedFiles = []
+
+    def scanGLIFFiles(paths, ufo2=False):
+        scannedFiles.extend(os.path.basename(path) for path in paths)
+        return originalScanGLIFFiles(paths, ufo2)
+
+    originalScanGLIFFiles = ufoCompiler.scanGLIFFiles
+    monkeypatch.setattr(ufoCompiler, "scanGLIFFiles", scanGLIFFiles)
+    savedCache = getGlyphInfoCache()
+    setGlyphInfoCache(GlyphInfoCache(tmp_path / "index"))
+    try:
+        assert fetchGlyphInfo(reader.getGlyphSet(), ufoPath, useIndex=True) == expected
+        assert len(scannedFiles) == len(reader.getGlyphSet())
+        del scannedFiles[:]
+        assert fetchGlyphInfo(reader.getGlyphSet(), ufoPath, useIndex=True) == expected
+        assert scannedFiles == []
+        glifPath = ufoPath / "glyphs" / "A_.glif"
+        glifPath.write_bytes(glifPath.read_bytes().replace(b'<unicode hex="0041"/>', b""))
+        widths, cmap, revCmap, anchors = fetchGlyphInfo(reader.getGlyphSet(), ufoPath, useIndex=True)
+        assert scannedFiles == ["A_.glif"]
+        assert 0x0041 not in cmap
+    finally:
+        setGlyphInfoCache(savedCache)
+
+
 @pytest.mark.asyncio
 async def test_compileUFOToPath(tmpdir):
     ufoPath = getFontPath("MutatorSansBoldWideMutated.ufo")
@@ -68,3 +140,192 @@ async def test_compileUFOToPathMultiple(tmpdir):
     results = await asyncio.gather(*coros)
     assert results == [None] * len(results)
     assert [(os.stat(p).st_size > 0) for p in ttPaths] == [True] * len(results)
+
+
+@pytest.mark.asyncio
+async def test_compilerPool_prewarm(tmpdir):
+    pool = CompilerPool(maxWorkers=3)
+    assert not pool.isReady
+    await pool.prewarm(2)
+    assert pool.isReady
+    assert pool.numReadyWorkers == 2
+    ttPath = tmpdir / "test.ttf"
+    await pool.callFunction("fontgoggles.compile.ttxCompiler.compileTTXToPath",
+                            [os.fspath(getFontPath("QuadTest-Regular.ttx")), os.fspath(ttPath)], None)
+    assert ttPath.exists()
+    assert len(pool.workers) == 2
+    await pool.prewarm(10)
+    assert pool.numReadyWorkers == 3
+
+
+@pytest.mark.asyncio
+async def test_compilerPool_prewarmOverlapping():
+    pool = CompilerPool(maxWorkers=4)
+    await asyncio.gather(pool.prewarm(2), pool.prewarm(2))
+    assert pool.occupancy == dict(workers=2, busy=0, idle=2, starting=0, waiting=0, maxWorkers=4)
+    await asyncio.gather(prewarmCompilerPool(1), prewarmCompilerPool(1))
+    assert len(getCompilerPool().workers) == 1
+
+
+@pytest.mark.asyncio
+async def test_compilerPool_limits():
+    pool = CompilerPool(maxWorkers=4, minWorkers=1, idleTimeout=0.2)
+    assert pool.maxWorkers == 4
+    assert CompilerPool().maxWorkers == os.cpu_count()
+    await pool.prewarm(3)
+    assert pool.occupancy == dict(workers=3, busy=0, idle=3, starting=0, waiting=0, maxWorkers=4)
+    pool.setLimits(maxWorkers=2)
+    assert pool.occupancy["workers"] == 2
+    await asyncio.sleep(0.5)
+    # Idle workers were retired, except minWorkers
+    assert pool.occupancy["workers"] == 1
+
+
+@pytest.mark.asyncio
+async def test_compilerPool_priority():
+    pool = CompilerPool(maxWorkers=1)
+    await pool.prewarm(1)
+    worker = await pool.getWorker()
+    order = []
+
+    async def request(key):
+        compileRequestKey.set(key)
+        worker = await pool.getWorker()
+        order.append(key)
+        pool._releaseWorker(worker)
+
+    tasks = [asyncio.create_task(request(key)) for key in ["a", "b", "c", "d"]]
+    await asyncio.sleep(0)
+    assert pool.occupancy["waiting"] == 4
+    pool.setPriority("b", 1)
+    pool.setPriority("c", 2)
+    pool.cancelPendingRequests("d")
+    pool._releaseWorker(worker)
+    await asyncio.gather(*tasks, return_exceptions=True)
+    assert order == ["c", "b", "a"]
+    assert tasks[3].cancelled()
+    assert pool.occupancy["idle"] == 1
+
+
+@pytest.mark.asyncio
+async def test_compilerPool_workerDied():
+    pool = CompilerPool(maxWorkers=1)
+    await pool.prewarm(1)
+    worker, = pool.workers
+    task1 = asyncio.create_task(pool.callFunction("time.sleep", [10], None))
+    await asyncio.sleep(0.2)
+    task2 = asyncio.create_task(pool.callFunction("math.sqrt", [16], None))
+    await asyncio.sleep(0)
+    assert pool.occupancy["waiting"] == 1
+    worker.process.kill()
+    with pytest.raises(RuntimeError):
+        await task1
+    # A new worker was started for the waiting request
+    assert await asyncio.wait_for(task2, 20) == 4.0
+    assert worker not in pool.workers
+    assert pool.occupancy == dict(workers=1, busy=0, idle=1, starting=0, waiting=0, maxWorkers=1)
+
+
+@pytest.mark.asyncio
+async def test_compilerPool_raiseMaxWorkers():
+    pool = CompilerPool(maxWorkers=1)
+    await pool.prewarm(1)
+    worker = await pool.getWorker()
+    task = asyncio.create_task(pool.callFunction("math.sqrt", [9], None))
+    await asyncio.sleep(0)
+    assert pool.occupancy["waiting"] == 1
+    pool.setLimits(maxWorkers=2)
+    assert await asyncio.wait_for(task, 20) == 3.0
+    assert len(pool.workers) == 2
+    pool._releaseWorker(worker)
+
+
+@pytest.mark.parametrize("numJobs, maxWorkers", [(5, 5), (40, 64), (8, 3)])
+@pytest.mark.asyncio
+async def test_compilerPool_coldStartConcurrency(monkeypatch, numJobs, maxWorkers):
+    busy = []
+    peakBusy = []
+
+    class FakeWorker:
+        isReady = False
+        isAlive = True
+        lastUsed = 0
+
+        async def start(self):
+            await asyncio.sleep(0.05)
+            self.isReady = True
+
+        async def callFunction(self, func, args, outputWriter):
+            busy.append(self)
+            peakBusy.append(len(busy))
+            await asyncio.sleep(0.1)
+            busy.remove(self)
+            return dict(ok=True, result=None, duration=0.1)
+
+        def stop(self):
+            pass
+
+    monkeypatch.setattr(compilerPool, "CompilerWorker", FakeWorker)
+    pool = CompilerPool(maxWorkers=maxWorkers)
+    await asyncio.gather(*(pool.callFunction("test", [], None) for i in range(numJobs)))
+    # Each simultaneous request starts a worker of its own, up to maxWorkers
+    assert max(peakBusy) == min(numJobs, maxWorkers)
+    assert len(pool.workers) == min(numJobs, maxWorkers)
+
+
+@pytest.mark.asyncio
+async def test_compilerWorker_protocol():
+    worker = CompilerWorker()
+    await worker.start()
+    output = []
+    # Several requests can be in flight
+    responses = await asyncio.gather(
+        worker.callFunction("math.sqrt", [16], output.append),
+        worker.callFunction("builtins.print", ["---- SUCCESS ----"], output.append),
+        worker.callFunction("math.sqrt", ["x"], output.append),
+    )
+    assert [r["ok"] for r in responses] == [True, True, False]
+    assert responses[0]["result"] == 4.0
+    assert responses[1]["stdout"] == "---- SUCCESS ----\n"
+    assert "TypeError" in responses[2]["error"]
+    assert output[0] == "---- SUCCESS ----\n"
+    assert all(r["duration"] >= 0 for r in responses)
+
+    # Cancel a long-running request, the worker should remain usable
+    task = asyncio.create_task(worker.callFunction("time.sleep", [10], output.append))
+    await asyncio.sleep(0.2)
+    task.cancel()
+    with pytest.raises(asyncio.CancelledError):
+        await asyncio.wait_for(task, 2)
+    response = await worker.callFunction("math.sqrt", [9], output.append)
+    assert response["result"] == 3.0
+    worker.stop()
+
+
+def test_workServer_earlyCancel(monkeypatch):
+    state = workServer._RequestState()
+    importModule = workServer.importlib.import_module
+
+    def cancelWhileImporting(moduleName):
+        # The cancel request arrives after the request started, but before
+        # it can be interrupted
+        assert state.currentID == 1
+        with state.lock:
+            state.cancelledIDs.add(1)
+        return importModule(moduleName)
+
+    monkeypatch.setattr(workServer.importlib, "import_module", cancelWhileImporting)
+    response = workServer.handleRequest(dict(type="call", id=1, func="time.sleep", args=[10]), state)
+    assert response["cancelled"]
+    assert response["duration"] < 5
+    assert state.cancelledIDs == set()
+
+
+@pytest.mark.asyncio
+async def test_compilerPool_callFunction():
+    pool = CompilerPool(maxWorkers=1)
+    assert await pool.callFunction("math.sqrt", [25], None) == 5.0
+    output = []
+    with pytest.raises(CompilerError):
+        await pool.callFunction("math.sqrt", ["x"], output.append)
+    assert "TypeError" in "".join(output)
@@ -83,3 +83,16 @@ def test_getUpdateInfo(tmpdir):
     assert needsGlyphUpdate
     assert not needsInfoUpdate
     assert not needsCmapUpdate
+    assert state.changedWidths == {"A": widths["A"] + 123}
+
+    glyphSet.deleteGlyph("B")
+    glyphSet.writeContents()
+    glyphSet.rebuildContents()
+
+    state = state.newState()
+    (needsFeaturesUpdate, needsGlyphUpdate, needsInfoUpdate, needsCmapUpdate,
+     needsLibUpdate) = state.getUpdateInfo()
+    assert needsGlyphUpdate
+    assert needsCmapUpdate
+    assert "B" not in state.unicodes
+    assert "B" not in state.glyphModTimes